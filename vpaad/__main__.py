@@ -8,17 +8,24 @@ from getpass import getpass
 
 import click
 
+# Only modules that import nothing heavy are imported here, so that --help
+# and light commands start quickly. Each command imports the rest itself.
 from vpaad.configuration import set_up_logging
-from vpaad.historical_data_fetcher import create_historical_data_fetcher
-from vpaad.volume_tracker import add_volume_trackers
-from vpaad import ig
-from vpaad.emailer import Emailer
+from vpaad.constants import (
+    CANDLE_RES_TO_TIMEDELTA, HISTORY_DATA_POINTS_PER_WEEK,
+    HISTORY_REQUEST_BURST, HISTORY_REQUESTS_PER_MINUTE, INITIATION_TIMEOUT,
+    INITIATION_WORKERS, OVERFLOW_POLICIES, REGRESSION_THRESHOLD,
+    START_TIME_MULIPLIER, STARTUP_BUDGET, SWEEP_LONG_WICK_PERCENTAGES,
+    SWEEP_NUMBERS_OF_STDS, SWEEP_SHORT_WICK_PERCENTAGES, SWEEP_SORT_COLUMNS,
+    SWEEP_STRONG_WICK_PERCENTAGES, SWEEP_WINDOWS)
 
 LOGGER = logging.getLogger("vpaad")
 
 
 def create_emailer(notification_config, send_emails):
     if send_emails:
+        from vpaad.emailer import Emailer
+
         print("Please enter your e-mail account's password.")
         password = getpass()
         return Emailer(notification_config, password)
@@ -41,6 +48,8 @@ def search(config, term):
     """
     Search market database for given term
     """
+    from vpaad import ig
+
     cfg_json = {}
     with open(config, "r") as cfg_file:
         cfg_json = json.load(cfg_file)
@@ -63,6 +72,21 @@ def search(config, term):
     help="When set --rhistory, set to use real historical data to "
          "determine thresholds. Otherwise, use user-defined parameters "
          "to interpolate initial thresholds.")
+@click.option(
+    "--history-cache",
+    default=None,
+    help="Directory in which to cache real historical data between runs, so "
+         "that only candles missed since the last run are fetched.")
+@click.option(
+    "--fetch-rate",
+    default=HISTORY_REQUESTS_PER_MINUTE,
+    type=click.IntRange(HISTORY_REQUEST_BURST + 1),
+    help="Most requests for real historical data to make in a minute.")
+@click.option(
+    "--data-points",
+    default=HISTORY_DATA_POINTS_PER_WEEK,
+    help="Weekly allowance of real historical data points, until IG says "
+         "how much of it is left.")
 @click.option(
     "--send-emails/--no-emails",
     default=False,
@@ -72,14 +96,97 @@ def search(config, term):
     default=True,
     help="When True, pre-calculate thresholds before looking at new candles. "
          "Otherwise, do it on the fly.")
+@click.option(
+    "--init-workers",
+    default=INITIATION_WORKERS,
+    help="How many volume trackers may fetch historical data at the same "
+         "time when starting up.")
+@click.option(
+    "--init-timeout",
+    default=INITIATION_TIMEOUT,
+    help="Seconds after which a volume tracker that is still fetching its "
+         "historical data is dropped.")
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of threads adding candles to the volume trackers. When 0, "
+         "candles are added on the stream listener's thread.")
+@click.option(
+    "--shards",
+    default=0,
+    help="Number of processes, each with its share of the markets, adding "
+         "candles to the volume trackers. Overrides --workers.")
+@click.option(
+    "--queue-size",
+    default=10000,
+    help="Maximum number of candles queued for each worker or shard.")
+@click.option(
+    "--overflow",
+    default="block",
+    type=click.Choice(OVERFLOW_POLICIES),
+    help="What to do with a new candle when a worker's queue is full.")
+@click.option(
+    "--record",
+    default=None,
+    help="File to append every received stream event to, for replaying "
+         "later with vpaad replay.")
+@click.option(
+    "--archive",
+    default=None,
+    help="Directory of a candle archive to append every completed candle "
+         "to.")
+@click.option(
+    "--archive-history/--no-archive-history",
+    default=False,
+    help="When set, initiate the volume trackers from the 5 minute candles "
+         "in --archive rather than fetching their history. Overrides "
+         "--rhistory.")
+@click.option(
+    "--metrics-port",
+    default=None,
+    type=int,
+    help="Port on which to serve metrics to this machine, in the Prometheus "
+         "text format.")
+@click.option(
+    "--checkpoint",
+    default=None,
+    help="File to save the state of the volume trackers to every few "
+         "minutes and on exit, and to restore them from on start.")
 @click.option(
     "--debug/--no-debug",
     default=False,
     help="When set, log debug loggin to stdout")
-def monitor(config, rhistory, send_emails, pre, debug):
+def monitor(
+        config, rhistory, history_cache, fetch_rate, data_points,
+        send_emails, pre, init_workers, init_timeout, workers, shards,
+        queue_size, overflow, record, archive, archive_history,
+        metrics_port, checkpoint, debug):
     """
     Run the main VPA anomaly detection procedure.
     """
+    from vpaad import ig
+    from vpaad.archive import (
+        ArchiveHistoricalDataFetcher, ArchiveWriter, CandleArchive)
+    from vpaad.checkpoint import (
+        CHECKPOINT_INTERVAL, load_checkpoint, save_checkpoint)
+    from vpaad.fetch_scheduler import DataPointAllowance, FetchScheduler
+    from vpaad.historical_data_fetcher import create_historical_data_fetcher
+    from vpaad.history_cache import CachingHistoricalDataFetcher
+    from vpaad.ingestion import CandleDispatcher
+    from vpaad.metrics import SUMMARY_INTERVAL, MetricsServer, log_summary
+    from vpaad.replay import CandleRecorder
+    from vpaad.sharding import ShardedDispatcher
+    from vpaad.volume_tracker import (
+        add_volume_trackers, track_last_candle_ages)
+
+    if checkpoint and shards:
+        raise click.UsageError(
+            "--checkpoint can't be used with --shards, as the shards' volume "
+            "trackers are in other processes.")
+    if archive_history and not archive:
+        raise click.UsageError("--archive-history needs --archive.")
+    if archive_history:
+        rhistory = False
     set_up_logging(debug)
     cfg_json = {}
     with open(config, "r") as cfg_file:
@@ -97,27 +204,80 @@ def monitor(config, rhistory, send_emails, pre, debug):
         ig_stream_service, credentials)
 
     emailer = create_emailer(notification_config, send_emails)
+    recorder = CandleRecorder(record) if record else None
+    candle_archive = CandleArchive(archive) if archive else None
+    archive_writer = None
+    if candle_archive is not None:
+        archive_writer = ArchiveWriter(candle_archive)
+        archive_writer.start()
+    dispatcher = None
+    if shards:
+        dispatcher = ShardedDispatcher(shards, queue_size)
+    elif workers:
+        dispatcher = CandleDispatcher(workers, queue_size, overflow)
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = MetricsServer(metrics_port)
+        metrics_server.start()
+    volume_trackers = None
+    fetch_scheduler = None
     try:
         # Connect to account
         ig_stream_service.connect(account_id)
+        allowance = DataPointAllowance(data_points) if rhistory else None
         historical_data_fetcher = create_historical_data_fetcher(
-            interpolated_hd_params, ig_service, rhistory)
+            interpolated_hd_params, ig_service, rhistory, allowance)
+        if rhistory:
+            fetch_scheduler = FetchScheduler(
+                historical_data_fetcher, fetch_rate, allowance=allowance)
+            fetch_scheduler.start()
+            historical_data_fetcher = fetch_scheduler
+        if rhistory and history_cache:
+            historical_data_fetcher = CachingHistoricalDataFetcher(
+                historical_data_fetcher, history_cache)
+        if archive_history:
+            historical_data_fetcher = ArchiveHistoricalDataFetcher(
+                candle_archive)
         callbacks = () if emailer is None else (emailer.add_email_to_queue,)
-        add_volume_trackers(
+        volume_trackers = add_volume_trackers(
             ig_service,
             ig_stream_service,
             markets,
             historical_data_fetcher,
             callbacks,
-            pre)
+            pre,
+            max_workers=init_workers,
+            initiate_timeout=init_timeout,
+            shared_history=rhistory or archive_history,
+            recorder=recorder,
+            dispatcher=dispatcher,
+            rules=cfg_json.get("rules"),
+            archive_writer=archive_writer,
+            checkpoint=load_checkpoint(checkpoint) if checkpoint else None)
+        # Sharded trackers get their candles in other processes
+        if not shards:
+            track_last_candle_ages(volume_trackers)
 
         if emailer:
             emailer.start()
 
         print("Press Ctrl-C to exit.\n")
 
+        last_summary = last_checkpoint = time.time()
         while True:
             time.sleep(10)
+            if dispatcher:
+                dispatcher.log_metrics()
+            if time.time() - last_summary >= SUMMARY_INTERVAL:
+                log_summary()
+                last_summary = time.time()
+            if (checkpoint and
+                    time.time() - last_checkpoint >= CHECKPOINT_INTERVAL):
+                try:
+                    save_checkpoint(checkpoint, volume_trackers)
+                except (IOError, OSError):
+                    LOGGER.exception("Could not save a checkpoint.")
+                last_checkpoint = time.time()
 
     except KeyboardInterrupt:
         print("Ctrl-C received.")
@@ -127,12 +287,368 @@ def monitor(config, rhistory, send_emails, pre, debug):
     finally:
         # Disconnecting
         ig_stream_service.disconnect()
+        if dispatcher:
+            dispatcher.stop()
+        if checkpoint and volume_trackers is not None:
+            # Don't let a failed save keep the rest from being shut down
+            try:
+                save_checkpoint(checkpoint, volume_trackers)
+            except (IOError, OSError):
+                LOGGER.exception("Could not save a checkpoint.")
+        if fetch_scheduler:
+            fetch_scheduler.stop()
         if emailer:
             emailer.stop()
+        if recorder:
+            recorder.close()
+        if archive_writer:
+            archive_writer.stop()
+        if metrics_server:
+            metrics_server.stop()
+
+
+@click.command()
+@click.option(
+    "--config",
+    default="config.json",
+    help="The location of the vpaad config JSON file.")
+@click.option(
+    "--events",
+    default=None,
+    help="Event log written by vpaad monitor --record to replay.")
+@click.option(
+    "--synthetic",
+    default=0,
+    help="Instead of a log, replay this many synthetic 5 minute candles for "
+         "each configured market.")
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="Random seed for the synthetic candles.")
+@click.option(
+    "--speed",
+    default=0.0,
+    help="Replay at this multiple of real time. When 0, replay as fast as "
+         "possible.")
+@click.option(
+    "--pre/--no-pre",
+    default=False,
+    help="When True, pre-calculate thresholds from the interpolated "
+         "historical data parameters before replaying.")
+@click.option(
+    "--shards",
+    default=0,
+    help="Replay through this many volume tracker processes.")
+@click.option(
+    "--archive",
+    default=None,
+    help="Directory of a candle archive whose 5 minute candles to "
+         "pre-calculate thresholds from, rather than the interpolated "
+         "historical data parameters.")
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    help="When set, log debug loggin to stdout")
+def replay(
+        config, events, synthetic, seed, speed, pre, shards, archive, debug):
+    """
+    Replay recorded or synthetic stream events through the volume trackers
+    and report their throughput.
+    """
+    from vpaad.archive import ArchiveHistoricalDataFetcher, CandleArchive
+    from vpaad.historical_data_fetcher import create_historical_data_fetcher
+    from vpaad.replay import (
+        generate_synthetic_events, read_events, replay_events)
+    from vpaad.sharding import ShardedDispatcher
+    from vpaad.volume_tracker import (
+        create_volume_trackers, initiate_volume_trackers)
+
+    if debug:
+        set_up_logging(debug)
+    cfg_json = {}
+    with open(config, "r") as cfg_file:
+        cfg_json = json.load(cfg_file)
+
+    markets = cfg_json["markets"]
+    if events:
+        stream_events = read_events(events)
+    elif synthetic:
+        stream_events = generate_synthetic_events(
+            [market["epic"] for market in markets], synthetic, seed=seed)
+    else:
+        raise click.UsageError("Either --events or --synthetic is needed.")
+
+    if archive:
+        historical_data_fetcher = ArchiveHistoricalDataFetcher(
+            CandleArchive(archive))
+    else:
+        historical_data_fetcher = create_historical_data_fetcher(
+            cfg_json.get("interpolated_hd_params"), None, False)
+    anomalies = []
+    volume_trackers = create_volume_trackers(
+        markets, None, historical_data_fetcher,
+        (anomalies.append,), pre, cfg_json.get("rules"))
+    initiate_volume_trackers(
+        volume_trackers,
+        historical_data_fetcher=historical_data_fetcher if archive else None)
+
+    dispatcher = ShardedDispatcher(shards) if shards else None
+    result = replay_events(
+        volume_trackers, stream_events, speed, anomalies, dispatcher)
+    print(result.summary())
+    for report in anomalies:
+        print(report.render("compact"))
+
+
+@click.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "--resolution",
+    "resolutions",
+    multiple=True,
+    default=("5MINUTE", "15MINUTE", "30MINUTE", "HOUR"),
+    type=click.Choice(sorted(CANDLE_RES_TO_TIMEDELTA)),
+    help="Resolution to look for anomalies at. Can be given several times.")
+@click.option(
+    "--base",
+    default="5MINUTE",
+    type=click.Choice(sorted(CANDLE_RES_TO_TIMEDELTA)),
+    help="Resolution of the candles in the files. Cache and archive files "
+         "at other resolutions are skipped.")
+@click.option(
+    "--window",
+    default=START_TIME_MULIPLIER,
+    help="Number of candles the volume and spread stats are taken over.")
+@click.option(
+    "--config",
+    default=None,
+    help="A vpaad config JSON file whose anomaly rules to use, along with "
+         "the rules of its markets.")
+@click.option(
+    "--output",
+    default=None,
+    help="CSV file to write the anomalies to. Otherwise they are printed.")
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    help="When set, log debug loggin to stdout")
+def backtest(paths, resolutions, base, window, config, output, debug):
+    """
+    Look for anomalies in historical candles from CSV, Parquet or history
+    cache files, or directories of them.
+
+    CSV and Parquet files need a time column first, then Open, High, Low,
+    Close and Volume columns. They hold the candles of the epic they are
+    named after, unless they have an Epic column.
+    """
+    from vpaad.backtest import read_histories, run_backtest
+
+    if debug:
+        set_up_logging(debug)
+    cfg_json = {}
+    if config:
+        with open(config, "r") as cfg_file:
+            cfg_json = json.load(cfg_file)
+
+    result = run_backtest(
+        read_histories(paths, base), resolutions, base, window,
+        rules=cfg_json.get("rules"), markets=cfg_json.get("markets", ()))
+    print(result.summary())
+    if output:
+        result.anomalies.to_csv(output)
+    elif len(result.anomalies):
+        print("")
+        print(result.anomalies.to_string())
+
+
+@click.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "--resolution",
+    "resolutions",
+    multiple=True,
+    default=("5MINUTE", "15MINUTE", "30MINUTE", "HOUR"),
+    type=click.Choice(sorted(CANDLE_RES_TO_TIMEDELTA)),
+    help="Resolution to look for anomalies at. Can be given several times.")
+@click.option(
+    "--base",
+    default="5MINUTE",
+    type=click.Choice(sorted(CANDLE_RES_TO_TIMEDELTA)),
+    help="Resolution of the candles in the files. Cache and archive files "
+         "at other resolutions are skipped.")
+@click.option(
+    "--window",
+    "windows",
+    multiple=True,
+    default=SWEEP_WINDOWS,
+    help="Number of candles the volume stats are taken over. Can be given "
+         "several times.")
+@click.option(
+    "--stds",
+    "numbers_of_stds",
+    multiple=True,
+    default=SWEEP_NUMBERS_OF_STDS,
+    help="Standard deviations above the mean from which volume is high. "
+         "Can be given several times.")
+@click.option(
+    "--strong-wick",
+    multiple=True,
+    default=SWEEP_STRONG_WICK_PERCENTAGES,
+    help="Fraction of a candle's height from which a wick is strong. Can "
+         "be given several times.")
+@click.option(
+    "--long-wick",
+    multiple=True,
+    default=SWEEP_LONG_WICK_PERCENTAGES,
+    help="Fraction of a candle's height from which a wick is long. Can be "
+         "given several times.")
+@click.option(
+    "--short-wick",
+    multiple=True,
+    default=SWEEP_SHORT_WICK_PERCENTAGES,
+    help="Fraction of a candle's height under which a wick is short. Can "
+         "be given several times.")
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of processes to share the combinations out over.")
+@click.option(
+    "--per-epic/--overall",
+    default=False,
+    help="When set, rank the combinations for each epic separately.")
+@click.option(
+    "--sort",
+    default="Hits",
+    type=click.Choice(SWEEP_SORT_COLUMNS),
+    help="Column to rank the combinations by.")
+@click.option(
+    "--output",
+    default=None,
+    help="CSV file to write the table to. Otherwise it is printed.")
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    help="When set, log debug loggin to stdout")
+def sweep(
+        paths, resolutions, base, windows, numbers_of_stds, strong_wick,
+        long_wick, short_wick, workers, per_epic, sort, output, debug):
+    """
+    Count the anomalies found in historical candles with every combination
+    of the given thresholds, to choose settings for each market.
+    """
+    from vpaad.backtest import read_histories
+    from vpaad.sweep import run_sweep
+
+    if debug:
+        set_up_logging(debug)
+    table = run_sweep(
+        read_histories(paths, base), resolutions, base, windows,
+        numbers_of_stds, strong_wick, long_wick, short_wick, workers=workers,
+        per_epic=per_epic, sort_by=sort)
+    if output:
+        table.to_csv(output, index=False)
+    else:
+        print(table.to_string(index=False))
+
+
+@click.command("archive")
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "--to",
+    "directory",
+    required=True,
+    help="Directory of the candle archive to append the candles to.")
+@click.option(
+    "--resolution",
+    default="5MINUTE",
+    type=click.Choice(sorted(CANDLE_RES_TO_TIMEDELTA)),
+    help="Resolution of the candles in the files. Cache and archive files "
+         "at other resolutions are skipped.")
+def archive_history(paths, directory, resolution):
+    """
+    Append candles from CSV, Parquet and history cache files to a candle
+    archive. Candles already archived are skipped.
+    """
+    from vpaad.archive import CandleArchive
+    from vpaad.backtest import read_histories
+
+    archive = CandleArchive(directory)
+    for epic, df in sorted(read_histories(paths, resolution).items()):
+        added = archive.append_frame(epic, resolution, df)
+        print("{} ({}): {} candles added, {} archived".format(
+            epic, resolution, added, len(archive.series(epic, resolution))))
+
+
+@click.command()
+@click.option(
+    "--quick/--full",
+    default=False,
+    help="When set, run the benchmarks at smaller scales.")
+@click.option(
+    "--repeat",
+    default=5,
+    help="How many times each benchmark is run. The fastest run is kept.")
+@click.option(
+    "--only",
+    default=None,
+    help="Only run benchmarks whose name contains this.")
+@click.option(
+    "--output",
+    default=None,
+    help="File to save the results to, as JSON.")
+@click.option(
+    "--compare",
+    default=None,
+    help="JSON results of a previous run to compare against. Exits with an "
+         "error when a benchmark has regressed.")
+@click.option(
+    "--threshold",
+    default=REGRESSION_THRESHOLD,
+    help="Slow down relative to the compared results from which a "
+         "benchmark counts as a regression.")
+@click.option(
+    "--startup-budget",
+    default=STARTUP_BUDGET,
+    help="Seconds each command may take to start. Exits with an error when "
+         "one takes longer.")
+def benchmark(quick, repeat, only, output, compare, threshold,
+              startup_budget):
+    """
+    Benchmark candles, volume trackers, historical data fetchers and the
+    start up of each command.
+    """
+    from vpaad.benchmark import (
+        compare_results, format_comparison, format_results, load_results,
+        over_startup_budget, run_benchmarks, save_results)
+
+    results = run_benchmarks(quick, repeat, only)
+    print(format_results(results))
+    if output:
+        save_results(results, output)
+
+    over_budget = over_startup_budget(results, startup_budget)
+    for name, seconds in over_budget:
+        print("{} took {:.3f}s, over the {:.3f}s budget".format(
+            name, seconds, startup_budget))
+
+    if compare:
+        comparison = compare_results(results, load_results(compare), threshold)
+        print("")
+        print(format_comparison(comparison))
+        if any(regression for _, _, _, _, regression in comparison):
+            raise SystemExit(1)
+    if over_budget:
+        raise SystemExit(1)
 
 
 cli.add_command(search)
 cli.add_command(monitor)
+cli.add_command(replay)
+cli.add_command(backtest)
+cli.add_command(sweep)
+cli.add_command(archive_history)
+cli.add_command(benchmark)
 
 
 if __name__ == '__main__':
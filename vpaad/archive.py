@@ -0,0 +1,276 @@
+# -*- coding:utf-8 -*-
+"""
+An on-disk archive of candles, for years of history of many epics.
+
+Each epic and resolution has a file of fixed width records, oldest first,
+and a file of just their times, in epoch milliseconds, to search. Both are
+opened with np.memmap, so a range of time is found with a binary search of
+the times and returned as a slice of the mapped records: nothing is read
+until it is used, and nothing is copied.
+
+Records are written before their times, so a crash mid-append leaves at
+most a partial record past the last indexed time, which is cut off when the
+series is next opened.
+
+A running monitor archives its candles through an ArchiveWriter, which
+appends them from its own thread so that the stream listener never waits
+on the disk.
+"""
+import logging
+import os
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy as np
+import pandas as pd
+
+from vpaad.constants import HISTORICAL_RES_TO_CANDLE_RES
+from vpaad.historical_data_fetcher import IHistoricalDataFetcher
+from vpaad.times import from_epoch_ms, to_epoch_ms
+
+LOGGER = logging.getLogger(__name__)
+
+RECORD_DTYPE = np.dtype([
+    ("time", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+])
+TIME_DTYPE = np.dtype(np.int64)
+RECORD_FILE_EXTENSION = ".candles"
+TIME_FILE_EXTENSION = ".times"
+
+_STOP = object()
+
+
+def _map(path, dtype, count):
+    if not count:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class ArchiveSeries(object):
+    """
+    The archived candles of one epic at one resolution.
+    """
+    def __init__(self, record_path, time_path):
+        self._record_path = record_path
+        self._time_path = time_path
+        self._lock = threading.Lock()
+        for path in (record_path, time_path):
+            if not os.path.exists(path):
+                open(path, "ab").close()
+        self._repair()
+        times = self.times()
+        self._last_time = int(times[-1]) if len(times) else None
+
+    def _repair(self):
+        count = len(self)
+        for path, dtype in ((self._record_path, RECORD_DTYPE),
+                            (self._time_path, TIME_DTYPE)):
+            if os.path.getsize(path) != count * dtype.itemsize:
+                LOGGER.warning("Truncating %s to %d candles", path, count)
+                with open(path, "r+b") as archive_file:
+                    archive_file.truncate(count * dtype.itemsize)
+
+    def __len__(self):
+        return min(
+            os.path.getsize(self._record_path) // RECORD_DTYPE.itemsize,
+            os.path.getsize(self._time_path) // TIME_DTYPE.itemsize)
+
+    def times(self):
+        """Map the times of the candles, in epoch milliseconds."""
+        return _map(self._time_path, TIME_DTYPE, len(self))
+
+    def records(self):
+        """Map all of the candles."""
+        return _map(self._record_path, RECORD_DTYPE, len(self))
+
+    @property
+    def last_time(self):
+        return self._last_time
+
+    def range(self, start=None, end=None):
+        """
+        Map the candles from start up to, but not including, end, both in
+        epoch milliseconds.
+        """
+        count = len(self)
+        times = _map(self._time_path, TIME_DTYPE, count)
+        first = 0 if start is None else int(
+            np.searchsorted(times, start, side="left"))
+        last = count if end is None else int(
+            np.searchsorted(times, end, side="left"))
+        return _map(self._record_path, RECORD_DTYPE, count)[first:last]
+
+    def append(self, times, opens, highs, lows, closes, volumes):
+        """
+        Append candles, which must be in time order. Those no later than
+        the last archived candle are skipped. Returns how many were added.
+        """
+        times = np.asarray(times, dtype=np.int64)
+        with self._lock:
+            last_time = self.last_time
+            new = slice(None) if last_time is None else slice(
+                int(np.searchsorted(times, last_time, side="right")), None)
+            records = np.empty(len(times[new]), dtype=RECORD_DTYPE)
+            records["time"] = times[new]
+            for name, values in (
+                    ("open", opens), ("high", highs), ("low", lows),
+                    ("close", closes), ("volume", volumes)):
+                records[name] = np.asarray(values, dtype=np.float64)[new]
+            if not len(records):
+                return 0
+
+            with open(self._record_path, "ab") as record_file:
+                record_file.write(records.tobytes())
+            with open(self._time_path, "ab") as time_file:
+                time_file.write(records["time"].tobytes())
+            self._last_time = int(records["time"][-1])
+            return len(records)
+
+
+class CandleArchive(object):
+    """
+    A directory of ArchiveSeries, one per epic and candle resolution.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        self._series = {}
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _path(self, epic, resolution, extension):
+        filename = "{}_{}{}".format(epic, resolution, extension)
+        return os.path.join(self._directory, filename.replace(os.sep, "_"))
+
+    def series(self, epic, resolution):
+        key = (epic, resolution)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = ArchiveSeries(
+                    self._path(epic, resolution, RECORD_FILE_EXTENSION),
+                    self._path(epic, resolution, TIME_FILE_EXTENSION))
+            return self._series[key]
+
+    def keys(self):
+        """The (epic, resolution) of every series in the archive."""
+        return sorted(
+            tuple(filename[:-len(RECORD_FILE_EXTENSION)].rsplit("_", 1))
+            for filename in os.listdir(self._directory)
+            if filename.endswith(RECORD_FILE_EXTENSION))
+
+    def append_frame(self, epic, resolution, df):
+        """
+        Append the candles of a DataFrame with a DatetimeIndex and Open,
+        High, Low, Close and Volume columns.
+        """
+        return self.series(epic, resolution).append(
+            to_epoch_ms(df.index), df["Open"].values, df["High"].values,
+            df["Low"].values, df["Close"].values, df["Volume"].values)
+
+    def append_event(self, event):
+        """
+        Append the candle of a CHART stream event, if it is complete.
+        """
+        values = event["values"]
+        if values["CONS_END"] != u"1":
+            return 0
+        _, epic, resolution = event["name"].split(":")
+        return self.series(epic, resolution).append(
+            [int(float(values["UTM"]))], [values["BID_OPEN"]],
+            [values["BID_HIGH"]], [values["BID_LOW"]], [values["BID_CLOSE"]],
+            [values["CONS_TICK_COUNT"]])
+
+    def range(self, epic, resolution, start=None, end=None):
+        """
+        Map the candles of an epic from start up to, but not including, end,
+        given as naive UTC datetimes.
+        """
+        return self.series(epic, resolution).range(
+            None if start is None else to_epoch_ms(start),
+            None if end is None else to_epoch_ms(end))
+
+    def frame(self, epic, resolution, start=None, end=None):
+        """
+        Copy the candles of an epic in a range of time into a DataFrame, as
+        returned by historical data fetchers.
+        """
+        records = self.range(epic, resolution, start, end)
+        df = pd.DataFrame({
+            "Open": records["open"],
+            "High": records["high"],
+            "Low": records["low"],
+            "Close": records["close"],
+            "Volume": records["volume"],
+        }, index=from_epoch_ms(records["time"]))
+        df.index.name = "Time"
+        return df
+
+
+class ArchiveWriter(object):
+    """
+    Appends the completed candles of stream events to a CandleArchive from
+    its own thread. Candles submitted before stop() are all written.
+    """
+    def __init__(self, archive):
+        self._archive = archive
+        self._queue = Queue()
+        self._thread = None
+
+    def start(self):
+        LOGGER.info("Archiving candles to: %s", self._archive.directory)
+        self._thread = threading.Thread(
+            target=self._write, name="ArchiveWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, event):
+        """
+        Queue the candle of a CHART stream event, if it is complete.
+        """
+        if event["values"]["CONS_END"] == u"1":
+            self._queue.put(event)
+
+    def _write(self):
+        while True:
+            event = self._queue.get()
+            if event is _STOP:
+                return
+            try:
+                self._archive.append_event(event)
+            except Exception:
+                LOGGER.exception("Could not archive %s", event["name"])
+
+
+class ArchiveHistoricalDataFetcher(IHistoricalDataFetcher):
+    """
+    Serves historical data from a CandleArchive rather than from IG.
+    """
+    def __init__(self, archive):
+        self._archive = archive
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        df = self._archive.frame(
+            epic, HISTORICAL_RES_TO_CANDLE_RES[resolution], start_time,
+            pd.Timestamp(end_time) + pd.Timedelta(milliseconds=1))
+        df["AbsSpread"] = (df["Open"] - df["Close"]).abs()
+        return df
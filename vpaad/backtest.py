@@ -0,0 +1,317 @@
+# -*- coding:utf-8 -*-
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from vpaad.archive import CandleArchive, RECORD_FILE_EXTENSION
+from vpaad.candle import (
+    aggregate_candles, calculate_wicks, classify_shapes,
+    classify_spread_volume)
+from vpaad.constants import (
+    CANDLE_RES_TO_TIMEDELTA, CANDLE_TYPES, HISTORICAL_RES_TO_CANDLE_RES,
+    SHAPE_TYPES, SPREAD_TYPES, START_TIME_MULIPLIER, VOLUME_TYPES)
+from vpaad.history_cache import CACHE_FILE_EXTENSION, read_cache_file
+from vpaad.patterns import detect_patterns, pattern_names
+from vpaad.rolling_stats import rolling_mean_std
+from vpaad.rules import RuleSet, market_rules, z_scores
+from vpaad.times import from_epoch_ms, to_epoch_ms
+from vpaad.volume_tracker import DEFAULT_RULE_SET
+
+LOGGER = logging.getLogger(__name__)
+
+PRICE_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+HISTORY_FILE_EXTENSIONS = (
+    ".csv", ".parquet", CACHE_FILE_EXTENSION, RECORD_FILE_EXTENSION)
+
+
+def _file_resolution(path):
+    """
+    The candle resolution of a cache or archive file, which are named after
+    their epic and resolution, or None for other files.
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    if extension == CACHE_FILE_EXTENSION:
+        resolution = stem.rsplit("_", 1)[-1]
+        return HISTORICAL_RES_TO_CANDLE_RES.get(resolution, resolution)
+    if extension == RECORD_FILE_EXTENSION:
+        return stem.rsplit("_", 1)[-1]
+    return None
+
+
+def _read_history_file(path):
+    """
+    Read the candles of one file, returning (epic, DataFrame) pairs. CSV and
+    Parquet files hold one epic, named after the file, unless they have an
+    Epic column. Cache and archive files are named after their epic and
+    resolution.
+    """
+    filename = os.path.basename(path)
+    stem, extension = os.path.splitext(filename)
+
+    if extension == CACHE_FILE_EXTENSION:
+        df, _, _ = read_cache_file(path)
+        return [(stem.rsplit("_", 1)[0], df)]
+
+    if extension == RECORD_FILE_EXTENSION:
+        epic, resolution = stem.rsplit("_", 1)
+        archive = CandleArchive(os.path.dirname(path) or ".")
+        return [(epic, archive.frame(epic, resolution))]
+
+    if extension == ".parquet":
+        df = pd.read_parquet(path)
+        if not isinstance(df.index, pd.DatetimeIndex):
+            df = df.set_index(df.columns[0])
+    else:
+        df = pd.read_csv(path, index_col=0)
+    df.index = pd.to_datetime(df.index)
+
+    if "Epic" in df.columns:
+        return [
+            (epic, epic_df.drop(columns="Epic"))
+            for epic, epic_df in df.groupby("Epic", sort=True)
+        ]
+    return [(stem, df)]
+
+
+def read_histories(paths, resolution=None):
+    """
+    Read candles from CSV, Parquet, history cache and archive files, or
+    directories of them. Returns a dict of DataFrames, with Open, High, Low,
+    Close and Volume columns and a DatetimeIndex, by epic.
+
+    When resolution is given, cache and archive files of other resolutions
+    are skipped; CSV and Parquet files are taken to be at it. Otherwise an
+    epic's files must all be of the same resolution, or ValueError is
+    raised, since their candles can't be mixed.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, filename)
+                for filename in sorted(os.listdir(path))
+                if filename.endswith(HISTORY_FILE_EXTENSIONS))
+        else:
+            files.append(path)
+
+    histories = {}
+    resolutions = {}
+    for path in files:
+        file_resolution = _file_resolution(path)
+        if (resolution is not None and file_resolution is not None and
+                file_resolution != resolution):
+            LOGGER.info("Skipping %s, not at %s", path, resolution)
+            continue
+        for epic, df in _read_history_file(path):
+            if file_resolution is not None:
+                found = resolutions.setdefault(epic, file_resolution)
+                if found != file_resolution:
+                    raise ValueError(
+                        "Candles of {} are at both {} and {}. Give the "
+                        "resolution to read.".format(
+                            epic, found, file_resolution))
+            df = df[list(PRICE_COLUMNS)]
+            if epic in histories:
+                df = pd.concat((histories[epic], df))
+            histories[epic] = df
+    for epic, df in histories.items():
+        df = df.sort_index()
+        histories[epic] = df[~df.index.duplicated(keep="last")]
+    return histories
+
+
+def backtest_candles(
+        times, opens, highs, lows, closes, volumes,
+        window=START_TIME_MULIPLIER, warm_up=None, rules=None):
+    """
+    Find the candles a VolumeTracker with the given RuleSet would report as
+    anomalies, for all of them at once. Each candle is weighed against the
+    stats of the window of candles up to and including it. Candles in the
+    first warm_up (by default window) aren't reported, as their window
+    isn't full yet.
+
+    Returns a DataFrame of the anomalies, indexed by time, with the names of
+    the rules each matched and the patterns each completed.
+    """
+    if rules is None:
+        rules = DEFAULT_RULE_SET
+    times = np.asarray(times, dtype=np.int64)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    if warm_up is None:
+        warm_up = window
+
+    spreads, spread_types, upper, lower = calculate_wicks(
+        opens, highs, lows, closes)
+    shape_types = classify_shapes(upper, lower)
+    spread_sizes = np.abs(spreads)
+
+    volume_means, volume_stds = rolling_mean_std(volumes, window)
+    spread_means, spread_stds = rolling_mean_std(spread_sizes, window)
+    volume_weights, spread_weights = classify_spread_volume(
+        volumes, spread_sizes, (volume_means, volume_stds),
+        (spread_means, spread_stds))
+    patterns = detect_patterns(
+        highs, lows, closes, volumes, shape_types, volume_weights,
+        spread_weights, spread_types, spread_means)
+
+    matches = rules.match_arrays((
+        shape_types, volume_weights, spread_weights, spread_types,
+        z_scores(volumes, volume_means, volume_stds),
+        z_scores(spread_sizes, spread_means, spread_stds), upper, lower,
+        patterns))
+    if matches:
+        is_anomaly = np.logical_or.reduce(matches)
+    else:
+        is_anomaly = np.zeros(len(times), dtype=bool)
+    is_anomaly[:warm_up] = False
+    rows = np.flatnonzero(is_anomaly)
+    # Object arrays, so the columns are still strings when empty
+    matched_rules = np.array([
+        ",".join(name for name, matched in zip(rules.names, row) if matched)
+        for row in zip(*[match[rows] for match in matches])], dtype=object)
+
+    return pd.DataFrame({
+        "Open": np.asarray(opens, dtype=np.float64)[rows],
+        "High": np.asarray(highs, dtype=np.float64)[rows],
+        "Low": np.asarray(lows, dtype=np.float64)[rows],
+        "Close": np.asarray(closes, dtype=np.float64)[rows],
+        "Volume": volumes[rows],
+        "ShapeType": np.asarray(SHAPE_TYPES)[shape_types[rows]],
+        "VolumeWeight": np.asarray(VOLUME_TYPES)[volume_weights[rows]],
+        "SpreadWeight": np.asarray(SPREAD_TYPES)[spread_weights[rows]],
+        "SpreadType": np.asarray(CANDLE_TYPES)[spread_types[rows]],
+        "VolumeMean": volume_means[rows],
+        "VolumeStd": volume_stds[rows],
+        "SpreadMean": spread_means[rows],
+        "SpreadStd": spread_stds[rows],
+        "Rules": matched_rules if matches else np.full(
+            len(rows), "", dtype=object),
+        "Patterns": np.array([
+            ",".join(pattern_names(mask)) for mask in patterns[rows]],
+            dtype=object),
+    }, index=from_epoch_ms(times[rows]))
+
+
+def candles_at_resolutions(df, resolutions, base_resolution="5MINUTE"):
+    """
+    Yield the candles of a DataFrame of base_resolution candles at each of
+    the resolutions, aggregating them into the coarser ones, as (resolution,
+    (times, opens, highs, lows, closes, volumes)) with times in epoch
+    milliseconds.
+    """
+    times = to_epoch_ms(df.index)
+    columns = [df[column].values.astype(np.float64)
+               for column in PRICE_COLUMNS]
+    base_timedelta = CANDLE_RES_TO_TIMEDELTA[base_resolution]
+
+    for resolution in resolutions:
+        timedelta = CANDLE_RES_TO_TIMEDELTA[resolution]
+        if timedelta < base_timedelta:
+            raise ValueError(
+                "Cannot make {} candles from {} candles.".format(
+                    resolution, base_resolution))
+        if timedelta == base_timedelta:
+            yield resolution, tuple([times] + columns)
+        else:
+            yield resolution, aggregate_candles(
+                times, *columns, timedelta=timedelta,
+                sub_timedelta=base_timedelta)
+
+
+def backtest_epic(
+        df, resolutions, base_resolution="5MINUTE",
+        window=START_TIME_MULIPLIER, warm_up=None, rules=None):
+    """
+    Backtest the candles of one epic, at base_resolution, at each of the
+    resolutions, with a RuleSet. Returns dicts of the anomalies and of the
+    number of candles by resolution.
+    """
+    anomalies = {}
+    candle_counts = {}
+    for resolution, candles in candles_at_resolutions(
+            df, resolutions, base_resolution):
+        anomalies[resolution] = backtest_candles(
+            *candles, window=window, warm_up=warm_up, rules=rules)
+        candle_counts[resolution] = len(candles[0])
+    return anomalies, candle_counts
+
+
+class BacktestResult(object):
+    """
+    The anomalies found by a backtest, and how many candles matched each
+    rule for each epic and resolution.
+    """
+    def __init__(self, anomalies, stats, elapsed):
+        self.anomalies = anomalies
+        self.stats = stats
+        self.elapsed = elapsed
+
+    @property
+    def candle_count(self):
+        return int(self.stats["Candles"].sum()) if len(self.stats) else 0
+
+    def summary(self):
+        lines = [
+            "Epics: {}".format(
+                len(self.stats.index.unique("Epic")) if len(self.stats)
+                else 0),
+            "Candles: {}".format(self.candle_count),
+            "Anomalies: {}".format(len(self.anomalies)),
+            "Elapsed: {:.3f}s".format(self.elapsed),
+        ]
+        if len(self.stats):
+            lines.extend(("", self.stats.to_string()))
+        return "\n".join(lines)
+
+
+def run_backtest(
+        histories, resolutions, base_resolution="5MINUTE",
+        window=START_TIME_MULIPLIER, warm_up=None, rules=None, markets=()):
+    """
+    Backtest the histories of many epics, given as a dict of DataFrames by
+    epic. Each epic is backtested with the rules, by name, overridden by
+    those of its market in markets, as in the config.
+    """
+    start = time.perf_counter()
+    markets_by_epic = {market["epic"]: market for market in markets}
+    anomaly_frames = []
+    stats = []
+    for epic, df in sorted(histories.items()):
+        rule_set = RuleSet(
+            market_rules(rules, markets_by_epic.get(epic, {})))
+        anomalies, candle_counts = backtest_epic(
+            df, resolutions, base_resolution, window, warm_up, rule_set)
+        for resolution in resolutions:
+            resolution_anomalies = anomalies[resolution]
+            rule_counts = resolution_anomalies["Rules"].str.split(
+                ",").explode().value_counts()
+            stats.append(dict(
+                {
+                    "Epic": epic,
+                    "Resolution": resolution,
+                    "Candles": candle_counts[resolution],
+                    "Anomalies": len(resolution_anomalies),
+                },
+                **{name: int(rule_counts.get(name, 0))
+                   for name in rule_set.names}))
+            resolution_anomalies.insert(0, "Resolution", resolution)
+            resolution_anomalies.insert(0, "Epic", epic)
+            anomaly_frames.append(resolution_anomalies)
+            LOGGER.debug(
+                "%s (%s): %d anomalies in %d candles", epic, resolution,
+                len(resolution_anomalies), candle_counts[resolution])
+
+    if anomaly_frames:
+        all_anomalies = pd.concat(anomaly_frames)
+    else:
+        all_anomalies = pd.DataFrame()
+    all_anomalies.index.name = "Time"
+    stats_df = pd.DataFrame(stats)
+    if len(stats_df):
+        stats_df = stats_df.set_index(["Epic", "Resolution"]).fillna(
+            0).astype(int)
+    return BacktestResult(
+        all_anomalies, stats_df, time.perf_counter() - start)
@@ -0,0 +1,392 @@
+# -*- coding:utf-8 -*-
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from vpaad.backtest import run_backtest
+from vpaad.candle import Candle, CandleAggregator, CompositeCandle
+from vpaad import metrics
+from vpaad.constants import (
+    REGRESSION_THRESHOLD, START_TIME_MULIPLIER, STARTUP_BUDGET)
+from vpaad.historical_data_fetcher import (
+    InterpolatedHistoricalDataFetcher, condense_historic_data)
+from vpaad.synthetic import generate_candles
+from vpaad.volume_tracker import VolumeTracker
+
+TRACKER_COUNTS = (1, 100, 1000)
+WINDOWS = (START_TIME_MULIPLIER, 1000, 10000)
+QUICK_TRACKER_COUNTS = (1, 10)
+QUICK_WINDOWS = (START_TIME_MULIPLIER, 1000)
+
+# Commands whose start up, up to printing their help, is timed. None is the
+# CLI itself
+ENTRY_POINTS = (
+    None, "search", "monitor", "replay", "backtest", "sweep", "archive",
+    "benchmark")
+# Modules too slow to import for an entry point to import just to start
+HEAVY_MODULES = ("numpy", "pandas", "trading_ig")
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIVE_MINUTES_MS = 5 * 60 * 1000
+START_UTM = 1500000000000
+
+
+def make_candle_data(count, seed=0):
+    """
+    Build count 5 minute candles of synthetic.generate_candles in the form
+    of stream event values.
+    """
+    df = generate_candles(
+        count, pd.Timestamp(START_UTM, unit="ms"), seed=seed)
+    return [
+        {
+            "BID_OPEN": float(row.Open),
+            "BID_CLOSE": float(row.Close),
+            "BID_HIGH": float(row.High),
+            "BID_LOW": float(row.Low),
+            "CONS_TICK_COUNT": float(row.Volume),
+            "UTM": START_UTM + i * FIVE_MINUTES_MS,
+        }
+        for i, row in enumerate(df.itertuples())
+    ]
+
+
+def make_ig_prices(count, seed=0):
+    """
+    Build a prices DataFrame shaped like the one returned by IG's historical
+    prices API.
+    """
+    rng = np.random.RandomState(seed)
+    columns = pd.MultiIndex.from_tuples(
+        [(side, price) for side in ("bid", "ask")
+         for price in ("Open", "High", "Low", "Close")] +
+        [("last", price) for price in ("Open", "High", "Low", "Close")] +
+        [("last", "Volume")])
+    return pd.DataFrame(
+        rng.uniform(100.0, 110.0, (count, len(columns))), columns=columns)
+
+
+def _time(function, repeat):
+    """
+    Call function repeat times and return the timings, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def cli_command(entry_point, *options):
+    command = [sys.executable] + list(options) + ["-m", "vpaad"]
+    if entry_point:
+        command.append(entry_point)
+    return command + ["--help"]
+
+
+def imported_modules(entry_point):
+    """
+    Return the modules imported when an entry point starts, with the
+    seconds each took to import, including its own imports.
+    """
+    process = subprocess.run(
+        cli_command(entry_point, "-X", "importtime"), cwd=ROOT_DIRECTORY,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1e6
+    return modules
+
+
+def bench_cli_startup(entry_point):
+    command = cli_command(entry_point)
+
+    def run():
+        subprocess.run(
+            command, cwd=ROOT_DIRECTORY, stdout=subprocess.DEVNULL,
+            check=True)
+    return run
+
+
+def bench_candle(count):
+    candle_data = make_candle_data(count)
+
+    def run():
+        for data in candle_data:
+            Candle(data)
+    return run
+
+
+def bench_composite_candle(count):
+    candle_data = make_candle_data(count)
+    timedelta = datetime.timedelta(minutes=15)
+
+    def run():
+        composite_candle = CompositeCandle(timedelta)
+        for data in candle_data:
+            composite_candle.add_5min_candle(data)
+            if composite_candle.complete:
+                composite_candle = CompositeCandle(timedelta)
+    return run
+
+
+def bench_candle_aggregator(count):
+    candle_data = make_candle_data(count)
+
+    def run():
+        aggregator = CandleAggregator(
+            "EPIC", ("5MINUTE", "15MINUTE", "30MINUTE", "HOUR"))
+        for data in candle_data:
+            aggregator.add(data)
+    return run
+
+
+def bench_volume_tracker(tracker_count, window, count):
+    candles = [Candle(data) for data in make_candle_data(window + count)]
+    volume_trackers = []
+    for i in range(tracker_count):
+        vt = VolumeTracker(
+            "Benchmark", "EPIC.{}".format(i), "5MINUTE", None, None,
+            pre_calculate=False, window=window)
+        for candle in candles[:window]:
+            vt._add_candle(candle)
+        volume_trackers.append(vt)
+    new_candles = candles[window:]
+
+    def run():
+        for candle in new_candles:
+            for vt in volume_trackers:
+                vt._add_candle(candle)
+    return run
+
+
+def bench_metrics(count):
+    """
+    The instrumentation of a candle: timing it, and counting it by label.
+    """
+    registry = metrics.Registry()
+    latency = metrics.histogram(
+        "latency_seconds", "", ("resolution",), registry=registry).labels(
+            "5MINUTE")
+    events = metrics.counter("events_total", "", ("epic",), registry=registry)
+
+    def run():
+        for _ in range(count):
+            start = time.perf_counter()
+            events.labels("EPIC").inc()
+            latency.observe(time.perf_counter() - start)
+    return run
+
+
+def bench_condense_historic_data(count):
+    prices = make_ig_prices(count)
+
+    def run():
+        condense_historic_data(prices)
+    return run
+
+
+def bench_interpolated_fetch(count):
+    fetcher = InterpolatedHistoricalDataFetcher({
+        "EPIC": {
+            "5Min": {
+                "volume": {"mean": 100.0, "std": 30.0},
+                "spread": {"mean": 5.0, "std": 2.0},
+            }
+        }
+    })
+    end_time = datetime.datetime(2020, 1, 6, 12, 0)
+    start_time = end_time - datetime.timedelta(minutes=5) * count
+
+    def run():
+        fetcher.fetch("EPIC", "5Min", start_time, end_time)
+    return run
+
+
+def bench_synthetic_candles(count):
+    start = datetime.datetime(2020, 1, 6)
+
+    def run():
+        generate_candles(count, start, seed=0)
+    return run
+
+
+def bench_backtest(epic_count, count):
+    histories = {}
+    for i in range(epic_count):
+        candle_data = make_candle_data(count, seed=i)
+        histories["EPIC.{}".format(i)] = pd.DataFrame(
+            {
+                "Open": [data["BID_OPEN"] for data in candle_data],
+                "High": [data["BID_HIGH"] for data in candle_data],
+                "Low": [data["BID_LOW"] for data in candle_data],
+                "Close": [data["BID_CLOSE"] for data in candle_data],
+                "Volume": [data["CONS_TICK_COUNT"] for data in candle_data],
+            },
+            index=pd.to_datetime(
+                [data["UTM"] for data in candle_data], unit="ms"))
+
+    def run():
+        run_backtest(histories, ("5MINUTE", "15MINUTE", "30MINUTE", "HOUR"))
+    return run
+
+
+def benchmarks(quick=False):
+    """
+    Return (name, number of operations, setup) for every benchmark, where
+    setup returns the function to time. Quick mode uses smaller scales.
+    """
+    tracker_counts = QUICK_TRACKER_COUNTS if quick else TRACKER_COUNTS
+    windows = QUICK_WINDOWS if quick else WINDOWS
+    candle_count = 100 if quick else 1000
+
+    yield ("candle", candle_count, partial(bench_candle, candle_count))
+    yield (
+        "composite_candle", candle_count,
+        partial(bench_composite_candle, candle_count))
+    yield (
+        "candle_aggregator", candle_count,
+        partial(bench_candle_aggregator, candle_count))
+    for tracker_count in tracker_counts:
+        count = max(candle_count // tracker_count, 10)
+        yield (
+            "volume_tracker_add_candle[trackers={},window={}]".format(
+                tracker_count, START_TIME_MULIPLIER),
+            count * tracker_count,
+            partial(
+                bench_volume_tracker, tracker_count, START_TIME_MULIPLIER,
+                count))
+    for window in windows:
+        if window == START_TIME_MULIPLIER:
+            continue
+        yield (
+            "volume_tracker_add_candle[trackers=1,window={}]".format(window),
+            candle_count,
+            partial(bench_volume_tracker, 1, window, candle_count))
+    yield (
+        "metrics_per_candle", candle_count,
+        partial(bench_metrics, candle_count))
+    for window in windows:
+        yield (
+            "condense_historic_data[rows={}]".format(window), 1,
+            partial(bench_condense_historic_data, window))
+    yield (
+        "interpolated_fetch[rows={}]".format(START_TIME_MULIPLIER), 1,
+        partial(bench_interpolated_fetch, START_TIME_MULIPLIER))
+    synthetic_rows = 100000 if quick else 1000000
+    yield (
+        "synthetic_candles[rows={}]".format(synthetic_rows), synthetic_rows,
+        partial(bench_synthetic_candles, synthetic_rows))
+    backtest_rows = 10000 if quick else 100000
+    yield (
+        "backtest[epics=10,rows={}]".format(backtest_rows),
+        10 * backtest_rows,
+        partial(bench_backtest, 10, backtest_rows))
+    for entry_point in ENTRY_POINTS:
+        yield (
+            "cli_startup[{}]".format(entry_point or "vpaad"), 1,
+            partial(bench_cli_startup, entry_point))
+
+
+def run_benchmarks(quick=False, repeat=5, only=None):
+    """
+    Run the benchmarks, optionally only those with names containing only,
+    and return their results.
+    """
+    results = {}
+    for name, operations, setup in benchmarks(quick):
+        if only and only not in name:
+            continue
+        timings = _time(setup(), repeat)
+        results[name] = {
+            "operations": operations,
+            "repeat": repeat,
+            "min": min(timings),
+            "median": float(np.median(timings)),
+            "per_operation": min(timings) / operations,
+        }
+    return {
+        "metadata": {
+            "time": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare results with baseline results, benchmark by benchmark. Returns a
+    list of (name, baseline time, current time, ratio, is regression) for
+    every benchmark found in both.
+    """
+    comparison = []
+    baseline_results = baseline["results"]
+    for name, result in sorted(results["results"].items()):
+        if name not in baseline_results:
+            continue
+        baseline_time = baseline_results[name]["per_operation"]
+        current_time = result["per_operation"]
+        ratio = current_time / baseline_time if baseline_time else 1.0
+        comparison.append((
+            name, baseline_time, current_time, ratio,
+            ratio > 1.0 + threshold))
+    return comparison
+
+
+def over_startup_budget(results, budget=STARTUP_BUDGET):
+    """
+    Return the names and times of the CLI start up benchmarks slower than
+    budget seconds.
+    """
+    return [
+        (name, result["per_operation"])
+        for name, result in sorted(results["results"].items())
+        if name.startswith("cli_startup[") and
+        result["per_operation"] > budget
+    ]
+
+
+def format_results(results):
+    lines = []
+    for name, result in sorted(results["results"].items()):
+        lines.append("{:<60} {:>12.2f} us/op".format(
+            name, result["per_operation"] * 1e6))
+    return "\n".join(lines)
+
+
+def format_comparison(comparison):
+    lines = []
+    for name, baseline_time, current_time, ratio, regression in comparison:
+        lines.append("{:<60} {:>10.2f} -> {:>10.2f} us/op ({:.2f}x){}".format(
+            name, baseline_time * 1e6, current_time * 1e6, ratio,
+            "  REGRESSION" if regression else ""))
+    return "\n".join(lines)
+
+
+def save_results(results, path):
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path, "r") as results_file:
+        return json.load(results_file)
@@ -2,115 +2,187 @@
 import datetime
 import math
 import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from vpaad.constants import (
+    CANDLE_RES_TO_TIMEDELTA, CANDLE_TYPE_CODES, CANDLE_TYPES,
+    LONG_WICK_PERCENTAGE, NUMBER_OF_STDS_AWAY_FROM_MEAN, SHAPE_TYPE_CODES,
+    SHAPE_TYPES, SHORT_WICK_PERCENTAGE, SPREAD_TYPE_CODES, SPREAD_TYPES,
+    STRONG_WICK_PERCENTAGE, VOLUME_TYPE_CODES, VOLUME_TYPES)
+from vpaad.times import local_datetime
 
 LOGGER = logging.getLogger(__name__)
 
+MIN_CANDLE_HEIGHT = 0.0000001
+
+FIVE_MINUTES_MS = 5 * 60 * 1000
+
+
+_NO_PRICE_CHANGE = CANDLE_TYPE_CODES["NO_PRICE_CHANGE"]
+_BULLISH = CANDLE_TYPE_CODES["BULLISH"]
+_BEARISH = CANDLE_TYPE_CODES["BEARISH"]
+_AVERAGE_VOLUME = VOLUME_TYPE_CODES["AVERAGE_VOLUME"]
+_HIGH_VOLUME = VOLUME_TYPE_CODES["HIGH_VOLUME"]
+_LOW_VOLUME = VOLUME_TYPE_CODES["LOW_VOLUME"]
+_AVERAGE_SPREAD = SPREAD_TYPE_CODES["AVERAGE_SPREAD"]
+_WIDE_SPREAD = SPREAD_TYPE_CODES["WIDE_SPREAD"]
+_NARROW_SPREAD = SPREAD_TYPE_CODES["NARROW_SPREAD"]
+
+
+def _wick_percentages(open_, high, low, close):
+    """
+    The upper and lower wicks of a candle, as fractions of its height.
+    """
+    if close > open_:
+        upper_wick_length = high - close
+        lower_wick_length = open_ - low
+    else:
+        upper_wick_length = high - open_
+        lower_wick_length = close - low
+
+    candle_height = max(high - low, MIN_CANDLE_HEIGHT)
+    return (
+        upper_wick_length / candle_height, lower_wick_length / candle_height)
+
 
 class Candle(object):
+    """
+    A candle's bid prices, volume and start time in epoch milliseconds,
+    with its type and shape as codes of constants.CANDLE_TYPES and
+    constants.SHAPE_TYPES. The spread, wicks, data and shape are worked out
+    from them when asked for, so a candle holds nothing else.
+    """
+    __slots__ = (
+        "_bid_high", "_bid_low", "_bid_open", "_bid_close", "_volume",
+        "_utm", "_type", "_shape", "_complete")
+
     def __init__(self, candle_data):
         self._bid_high = float(candle_data["BID_HIGH"])
         self._bid_low = float(candle_data["BID_LOW"])
         self._bid_open = float(candle_data["BID_OPEN"])
         self._bid_close = float(candle_data["BID_CLOSE"])
         self._volume = float(candle_data["CONS_TICK_COUNT"])
-        self._time = datetime.datetime.fromtimestamp(
-            int(candle_data["UTM"]) / 1000)
-
-        self._spread = None
-        self._spread_size = None
-        self._type = None
-        self._shape = None
+        self._utm = int(float(candle_data["UTM"]))
 
         self._calculate_spread()
         self._calculate_shape()
         self._complete = True
 
     def _calculate_spread(self):
-        self._spread = self._bid_close - self._bid_open
-        self._spread_size = math.fabs(self._spread)
-
-        if self._spread > 0:
-            self._type = "BULLISH"
-        elif self._spread < 0:
-            self._type = "BEARISH"
+        if self._bid_close > self._bid_open:
+            self._type = _BULLISH
+        elif self._bid_close < self._bid_open:
+            self._type = _BEARISH
         else:
-            self._type = "NO_PRICE_CHANGE"
+            self._type = _NO_PRICE_CHANGE
 
     def _calculate_shape(self):
         """
         Calculate the shape of the candle. We want to know if it's a hammer
         or a shooting star - these are the most important shapes.
         """
-        if self._type == "BULLISH":
-            upper_wick_length = self._bid_high - self._bid_close
-            lower_wick_length = self._bid_open - self._bid_low
-        else:
-            upper_wick_length = self._bid_high - self._bid_open
-            lower_wick_length = self._bid_close - self._bid_low
-
-        candle_height = max(self._bid_high - self._bid_low, 0.0000001)
-        upper_wick_percentage = upper_wick_length / candle_height
-        lower_wick_percentage = lower_wick_length / candle_height
+        upper_wick_percentage, lower_wick_percentage = _wick_percentages(
+            self._bid_open, self._bid_high, self._bid_low, self._bid_close)
 
-        if upper_wick_percentage > 0.75:
+        if upper_wick_percentage > STRONG_WICK_PERCENTAGE:
             shape_name = "STRONG_SHOOTING_STAR"
-        elif upper_wick_percentage > 0.4 and lower_wick_percentage < 0.3:
+        elif (upper_wick_percentage > LONG_WICK_PERCENTAGE
+                and lower_wick_percentage < SHORT_WICK_PERCENTAGE):
             shape_name = "WEAK_SHOOTING_STAR"
-        elif lower_wick_percentage > 0.75:
+        elif lower_wick_percentage > STRONG_WICK_PERCENTAGE:
             shape_name = "STRONG_HAMMER"
-        elif lower_wick_percentage > 0.4 and upper_wick_percentage < 0.3:
+        elif (lower_wick_percentage > LONG_WICK_PERCENTAGE
+                and upper_wick_percentage < SHORT_WICK_PERCENTAGE):
             shape_name = "WEAK_HAMMER"
-        elif lower_wick_percentage > 0.4 and upper_wick_percentage > 0.4:
+        elif (lower_wick_percentage > LONG_WICK_PERCENTAGE
+                and upper_wick_percentage > LONG_WICK_PERCENTAGE):
             shape_name = "LONG_LEGGED_DOJI"
         else:
             shape_name = "AVERAGE_SHAPE"
 
-        self._shape = {
-            "shape_type": shape_name,
-            "upper_wick_percentage": upper_wick_percentage,
-            "lower_wick_percentage": lower_wick_percentage
-        }
+        self._shape = SHAPE_TYPE_CODES[shape_name]
 
-    def get_spread_volume_weight(self, volume_stats, spread_stats):
+    def spread_volume_codes(self, volume_stats, spread_stats):
+        """
+        The volume type code and spread type code of the candle, weighed
+        against the given stats.
+        """
         volume_mean, volume_std = volume_stats
         spread_mean, spread_std = spread_stats
 
-        NUMBER_OF_STDS_AWAY_FROM_MEAN = 1.0
-        volume = "AVERAGE_VOLUME"
+        volume = _AVERAGE_VOLUME
         volume_epsilon = NUMBER_OF_STDS_AWAY_FROM_MEAN * volume_std
         if self._volume > volume_mean + volume_epsilon:
-            volume = "HIGH_VOLUME"
+            volume = _HIGH_VOLUME
         elif self._volume <= volume_mean - volume_epsilon:
-            volume = "LOW_VOLUME"
+            volume = _LOW_VOLUME
 
-        spread = "AVERAGE_SPREAD"
-        if self._spread_size > spread_mean + spread_std:
-            spread = "WIDE_SPREAD"
-        elif self._spread_size <= spread_mean - 0.5 * spread_std:
-            spread = "NARROW_SPREAD"
+        spread = _AVERAGE_SPREAD
+        spread_size = self.spread_size
+        if spread_size > spread_mean + spread_std:
+            spread = _WIDE_SPREAD
+        elif spread_size <= spread_mean - 0.5 * spread_std:
+            spread = _NARROW_SPREAD
 
-        return (volume, spread, self._type)
+        return (volume, spread)
+
+    def get_spread_volume_weight(self, volume_stats, spread_stats):
+        volume, spread = self.spread_volume_codes(volume_stats, spread_stats)
+        return (VOLUME_TYPES[volume], SPREAD_TYPES[spread], self.type)
 
     @property
     def data(self):
+        spread = self.spread
         return {
             "high": self._bid_high,
             "low": self._bid_low,
             "open": self._bid_open,
             "close": self._bid_close,
             "volume": self._volume,
-            "spread": self._spread,
-            "spread_size": self._spread_size,
-            "spread_type": self._type,
+            "spread": spread,
+            "spread_size": math.fabs(spread),
+            "spread_type": self.type,
         }
 
     @property
     def shape(self):
-        return self._shape
+        if self._shape is None:
+            return None
+        upper_wick_percentage, lower_wick_percentage = self.wick_percentages
+        return {
+            "shape_type": SHAPE_TYPES[self._shape],
+            "upper_wick_percentage": upper_wick_percentage,
+            "lower_wick_percentage": lower_wick_percentage
+        }
+
+    @property
+    def wick_percentages(self):
+        """The upper and lower wicks, as fractions of the height."""
+        return _wick_percentages(
+            self._bid_open, self._bid_high, self._bid_low, self._bid_close)
+
+    @property
+    def open(self):
+        return self._bid_open
+
+    @property
+    def high(self):
+        return self._bid_high
+
+    @property
+    def low(self):
+        return self._bid_low
+
+    @property
+    def close(self):
+        return self._bid_close
 
     @property
     def spread_size(self):
-        return self._spread_size
+        return math.fabs(self._bid_close - self._bid_open)
 
     @property
     def volume(self):
@@ -118,7 +190,28 @@ class Candle(object):
 
     @property
     def time(self):
-        return self._time
+        """The local time the candle started at, for display."""
+        return local_datetime(self._utm)
+
+    @property
+    def utm(self):
+        return self._utm
+
+    @property
+    def spread(self):
+        return self._bid_close - self._bid_open
+
+    @property
+    def type(self):
+        return None if self._type is None else CANDLE_TYPES[self._type]
+
+    @property
+    def type_code(self):
+        return self._type
+
+    @property
+    def shape_code(self):
+        return self._shape
 
     @property
     def complete(self):
@@ -129,8 +222,13 @@ class CompositeCandle(Candle):
     """
     A candle made up of smaller 5 minute candles. For example, this could
     be a 15 minute candle containing 3 x 5 minute candles.
+
+    It starts at utm when given, such as the start of its time bucket, or
+    otherwise at its first sub candle.
     """
-    def __init__(self, timedelta):
+    __slots__ = ("_ratio", "_sub_candle_num")
+
+    def __init__(self, timedelta, utm=None):
         self._ratio = int(
             timedelta.total_seconds() /
             datetime.timedelta(minutes=5).total_seconds()
@@ -142,36 +240,364 @@ class CompositeCandle(Candle):
         self._bid_open = None
         self._bid_close = None
         self._volume = None
-        self._spread = None
-        self._spread_size = None
-        self._time = None
+        self._utm = utm
         self._type = None
         self._shape = None
         self._complete = False
 
+    @classmethod
+    def from_snapshot(cls, timedelta, snapshot):
+        """A candle carrying on from one that returned snapshot."""
+        utm, open_, high, low, close, volume, sub_candles = snapshot
+        candle = cls(timedelta, None if utm is None else int(utm))
+        if sub_candles:
+            candle._add(
+                float(open_), float(high), float(low), float(close),
+                float(volume), int(utm), int(sub_candles))
+        return candle
+
+    @property
+    def sub_candle_count(self):
+        return self._sub_candle_num
+
+    def snapshot(self):
+        """
+        The start time, prices, volume and number of sub candles added so
+        far, as a tuple from_snapshot takes.
+        """
+        return (self._utm, self._bid_open, self._bid_high, self._bid_low,
+                self._bid_close, self._volume, self._sub_candle_num)
+
     def add_5min_candle(self, candle_data):
+        self._add(
+            float(candle_data["BID_OPEN"]),
+            float(candle_data["BID_HIGH"]),
+            float(candle_data["BID_LOW"]),
+            float(candle_data["BID_CLOSE"]),
+            float(candle_data["CONS_TICK_COUNT"]),
+            int(float(candle_data["UTM"])))
+
+    def add_candle(self, sub_candle):
+        self._add(
+            sub_candle._bid_open, sub_candle._bid_high, sub_candle._bid_low,
+            sub_candle._bid_close, sub_candle._volume, sub_candle._utm)
+
+    def _add(self, open_, high, low, close, volume, utm, sub_candles=1):
         if self._complete:
             raise ValueError("Cannot add candle data to a complete candle.")
 
-        sub_candle = Candle(candle_data)
-
         if self._sub_candle_num == 0:
-            self._bid_high = sub_candle._bid_high
-            self._bid_low = sub_candle._bid_low
-            self._bid_open = sub_candle._bid_open
-            self._bid_close = sub_candle._bid_close
-            self._volume = sub_candle._volume
-            self._time = sub_candle._time
+            self._bid_high = high
+            self._bid_low = low
+            self._bid_open = open_
+            self._bid_close = close
+            self._volume = volume
+            if self._utm is None:
+                self._utm = utm
         else:
-            self._bid_high = max(self._bid_high, sub_candle._bid_high)
-            self._bid_low = min(self._bid_low, sub_candle._bid_low)
-            self._bid_close = sub_candle._bid_close
-            self._volume += sub_candle._volume
+            if high > self._bid_high:
+                self._bid_high = high
+            if low < self._bid_low:
+                self._bid_low = low
+            self._bid_close = close
+            self._volume += volume
 
-        self._sub_candle_num += 1
+        self._sub_candle_num += sub_candles
 
         if self._sub_candle_num == self._ratio:
-            # Complete the candle
-            self._calculate_spread()
-            self._calculate_shape()
-            self._complete = True
+            self.finish()
+
+    def finish(self):
+        """
+        Complete the candle with the sub candles added so far, for when the
+        rest of them are missing.
+        """
+        if self._complete:
+            return self
+        if not self._sub_candle_num:
+            raise ValueError("Cannot complete a candle without candle data.")
+        self._calculate_spread()
+        self._calculate_shape()
+        self._complete = True
+        return self
+
+
+class CandleAggregator(object):
+    """
+    Combines the 5 minute candles of an epic into candles of each of its
+    resolutions in a single pass, in buckets aligned to the clock by the
+    candles' UTM times rather than by counting them.
+
+    A bucket is closed as soon as a candle for the end of it arrives. When
+    that one is missed, it is closed by the first candle of a later bucket,
+    with the candles it has, as resample_historic_data does for the history
+    volume trackers are initiated with. A bucket already under way when the
+    first candle arrives is skipped. Candles no later than the last one
+    added, repeated or late, are ignored.
+
+    lock is held while the candles it completes are added to volume
+    trackers, so that a checkpoint sees all of them or none.
+    """
+    def __init__(self, epic=None, resolutions=()):
+        self._epic = epic
+        self._periods = {}
+        self._buckets = {}
+        self._first_utm = None
+        self._last_utm = None
+        self.lock = threading.Lock()
+        for resolution in resolutions:
+            self.add_resolution(resolution)
+
+    @property
+    def resolutions(self):
+        return tuple(self._periods)
+
+    @property
+    def last_utm(self):
+        return self._last_utm
+
+    def state(self):
+        """
+        The buckets in progress and the times of the first and last candles
+        added, as arrays.
+        """
+        resolutions = sorted(self._buckets)
+        buckets = [self._buckets[resolution] for resolution in resolutions]
+        return {
+            "utms": np.array(
+                [-1 if utm is None else utm
+                 for utm in (self._first_utm, self._last_utm)],
+                dtype=np.int64),
+            "bucket_resolutions": np.array(resolutions, dtype=np.str_),
+            "bucket_prices": np.array(
+                [bucket.snapshot() for bucket in buckets],
+                dtype=np.float64).reshape(len(buckets), 7),
+        }
+
+    def restore(self, state):
+        """Carry on from a state returned by state()."""
+        self._first_utm, self._last_utm = (
+            None if utm < 0 else int(utm) for utm in state["utms"])
+        self._buckets = {}
+        for resolution, prices in zip(
+                state["bucket_resolutions"], state["bucket_prices"]):
+            resolution = str(resolution)
+            self.add_resolution(resolution)
+            self._buckets[resolution] = CompositeCandle.from_snapshot(
+                CANDLE_RES_TO_TIMEDELTA[resolution], prices)
+
+    def add_resolution(self, resolution):
+        if resolution not in self._periods:
+            self._periods[resolution] = int(
+                CANDLE_RES_TO_TIMEDELTA[resolution].total_seconds() * 1000)
+
+    def add(self, candle_data):
+        """
+        Add the values of a completed 5 minute candle. Returns the candles
+        it completes, as a list per resolution.
+        """
+        candle = Candle(candle_data)
+        utm = candle.utm
+        if self._last_utm is not None and utm <= self._last_utm:
+            LOGGER.warning(
+                "Ignoring %s candle at %s, not after the last one at %s",
+                self._epic, utm, self._last_utm)
+            return {}
+        if self._first_utm is None:
+            self._first_utm = utm
+        self._last_utm = utm
+
+        completed = {}
+        for resolution, period in self._periods.items():
+            if period <= FIVE_MINUTES_MS:
+                completed[resolution] = [candle]
+                continue
+
+            start = utm - utm % period
+            bucket = self._buckets.get(resolution)
+            if bucket is not None and bucket.utm != start:
+                LOGGER.debug(
+                    "Closing %s %s candle at %s with %d/%d candles",
+                    self._epic, resolution, bucket.utm,
+                    bucket.sub_candle_count, period // FIVE_MINUTES_MS)
+                completed[resolution] = [bucket.finish()]
+                bucket = None
+            if bucket is None:
+                if start < self._first_utm:
+                    continue
+                bucket = CompositeCandle(
+                    CANDLE_RES_TO_TIMEDELTA[resolution], start)
+                self._buckets[resolution] = bucket
+
+            bucket.add_candle(candle)
+            if bucket.complete or utm + FIVE_MINUTES_MS >= start + period:
+                completed.setdefault(resolution, []).append(bucket.finish())
+                del self._buckets[resolution]
+        return completed
+
+
+def calculate_wicks(opens, highs, lows, closes):
+    """
+    Vectorised equivalent of Candle._calculate_spread and
+    Candle.wick_percentages. Returns arrays of spreads, spread type codes
+    and upper and lower wick percentages.
+    """
+    opens = np.asarray(opens, dtype=np.float64)
+    highs = np.asarray(highs, dtype=np.float64)
+    lows = np.asarray(lows, dtype=np.float64)
+    closes = np.asarray(closes, dtype=np.float64)
+
+    spreads = closes - opens
+    spread_types = np.full(
+        len(spreads), CANDLE_TYPE_CODES["NO_PRICE_CHANGE"], dtype=np.int8)
+    spread_types[spreads > 0] = CANDLE_TYPE_CODES["BULLISH"]
+    spread_types[spreads < 0] = CANDLE_TYPE_CODES["BEARISH"]
+
+    bullish = spread_types == CANDLE_TYPE_CODES["BULLISH"]
+    upper_wick_lengths = np.where(bullish, highs - closes, highs - opens)
+    lower_wick_lengths = np.where(bullish, opens - lows, closes - lows)
+
+    candle_heights = np.maximum(highs - lows, MIN_CANDLE_HEIGHT)
+    return (
+        spreads,
+        spread_types,
+        upper_wick_lengths / candle_heights,
+        lower_wick_lengths / candle_heights,
+    )
+
+
+def classify_shapes(
+        upper_wick_percentages, lower_wick_percentages,
+        strong_wick_percentage=STRONG_WICK_PERCENTAGE,
+        long_wick_percentage=LONG_WICK_PERCENTAGE,
+        short_wick_percentage=SHORT_WICK_PERCENTAGE):
+    """
+    Vectorised equivalent of the shape part of Candle._calculate_shape.
+    Returns an array of shape type codes.
+    """
+    upper = upper_wick_percentages
+    lower = lower_wick_percentages
+    return np.select(
+        (
+            upper > strong_wick_percentage,
+            (upper > long_wick_percentage) & (lower < short_wick_percentage),
+            lower > strong_wick_percentage,
+            (lower > long_wick_percentage) & (upper < short_wick_percentage),
+            (lower > long_wick_percentage) & (upper > long_wick_percentage),
+        ),
+        (
+            SHAPE_TYPE_CODES["STRONG_SHOOTING_STAR"],
+            SHAPE_TYPE_CODES["WEAK_SHOOTING_STAR"],
+            SHAPE_TYPE_CODES["STRONG_HAMMER"],
+            SHAPE_TYPE_CODES["WEAK_HAMMER"],
+            SHAPE_TYPE_CODES["LONG_LEGGED_DOJI"],
+        ),
+        default=SHAPE_TYPE_CODES["AVERAGE_SHAPE"],
+    ).astype(np.int8)
+
+
+def classify_spread_volume(
+        volumes, spread_sizes, volume_stats, spread_stats,
+        number_of_stds=NUMBER_OF_STDS_AWAY_FROM_MEAN):
+    """
+    Vectorised equivalent of Candle.get_spread_volume_weight. The stats may
+    be scalars or arrays with one mean and standard deviation per candle.
+    Returns arrays of volume type codes and spread type codes.
+    """
+    volumes = np.asarray(volumes, dtype=np.float64)
+    spread_sizes = np.asarray(spread_sizes, dtype=np.float64)
+    volume_mean, volume_std = volume_stats
+    spread_mean, spread_std = spread_stats
+
+    volume_epsilon = number_of_stds * np.asarray(volume_std)
+    volume_types = np.select(
+        (
+            volumes > volume_mean + volume_epsilon,
+            volumes <= volume_mean - volume_epsilon,
+        ),
+        (VOLUME_TYPE_CODES["HIGH_VOLUME"], VOLUME_TYPE_CODES["LOW_VOLUME"]),
+        default=VOLUME_TYPE_CODES["AVERAGE_VOLUME"],
+    ).astype(np.int8)
+
+    spread_types = np.select(
+        (
+            spread_sizes > spread_mean + np.asarray(spread_std),
+            spread_sizes <= spread_mean - 0.5 * np.asarray(spread_std),
+        ),
+        (SPREAD_TYPE_CODES["WIDE_SPREAD"], SPREAD_TYPE_CODES["NARROW_SPREAD"]),
+        default=SPREAD_TYPE_CODES["AVERAGE_SPREAD"],
+    ).astype(np.int8)
+    return volume_types, spread_types
+
+
+def classify_candles(df, volume_stats=None, spread_stats=None):
+    """
+    Classify every candle of a historical data DataFrame (with Open, High,
+    Low, Close and Volume columns) at once.
+
+    Gives the same results as building a Candle per row: spread, spread
+    size and type, wick percentages and shape type. When volume and spread
+    stats are given, the volume and spread weights of
+    Candle.get_spread_volume_weight are added too.
+    """
+    spreads, spread_types, upper, lower = calculate_wicks(
+        df["Open"].values, df["High"].values, df["Low"].values,
+        df["Close"].values)
+    shape_types = classify_shapes(upper, lower)
+
+    classified = pd.DataFrame({
+        "Spread": spreads,
+        "AbsSpread": np.abs(spreads),
+        "SpreadType": np.asarray(CANDLE_TYPES)[spread_types],
+        "UpperWickPercentage": upper,
+        "LowerWickPercentage": lower,
+        "ShapeType": np.asarray(SHAPE_TYPES)[shape_types],
+    }, index=df.index)
+
+    if volume_stats is not None and spread_stats is not None:
+        volume_weights, spread_weights = classify_spread_volume(
+            df["Volume"].values, np.abs(spreads), volume_stats, spread_stats)
+        classified["VolumeWeight"] = np.asarray(VOLUME_TYPES)[volume_weights]
+        classified["SpreadWeight"] = np.asarray(SPREAD_TYPES)[spread_weights]
+
+    return classified
+
+
+def aggregate_candles(
+        times, opens, highs, lows, closes, volumes, timedelta,
+        sub_timedelta):
+    """
+    Vectorised equivalent of CandleAggregator: combine candles of
+    sub_timedelta, sorted by their times in epoch milliseconds, into
+    candles of timedelta aligned to the clock. A candle missing some of its
+    sub candles is kept, with the ones it has, except for a bucket already
+    under way at the first candle, and the last bucket while the candle
+    for its end hasn't arrived. Returns arrays of times, opens, highs,
+    lows, closes and volumes.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if not len(times):
+        empty = np.empty(0)
+        return times, empty, empty, empty, empty, empty
+
+    period = int(timedelta.total_seconds() * 1000)
+    sub_period = int(sub_timedelta.total_seconds() * 1000)
+    buckets = times // period
+    starts = np.flatnonzero(
+        np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    ends = np.append(starts[1:], len(times)) - 1
+    kept = np.ones(len(starts), dtype=bool)
+    kept[0] = times[0] % period == 0
+    kept[-1] &= times[-1] + sub_period >= (buckets[-1] + 1) * period
+
+    return (
+        (buckets[starts] * period)[kept],
+        np.asarray(opens, dtype=np.float64)[starts][kept],
+        np.maximum.reduceat(
+            np.asarray(highs, dtype=np.float64), starts)[kept],
+        np.minimum.reduceat(
+            np.asarray(lows, dtype=np.float64), starts)[kept],
+        np.asarray(closes, dtype=np.float64)[ends][kept],
+        np.add.reduceat(
+            np.asarray(volumes, dtype=np.float64), starts)[kept],
+    )
@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+
+from vpaad.constants import (
+    CANDLE_TYPES, CANDLE_TYPE_CODES, SHAPE_TYPES, SHAPE_TYPE_CODES)
+from vpaad.times import local_datetime
+
+COLUMNS = (
+    ("time", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+    ("spread", np.float64),
+    ("upper_wick_percentage", np.float64),
+    ("lower_wick_percentage", np.float64),
+    ("spread_type", np.int8),
+    ("shape_type", np.int8),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+# Positions of the columns in a row
+(_TIME, _OPEN, _HIGH, _LOW, _CLOSE, _VOLUME, _SPREAD, _UPPER_WICK, _LOWER_WICK,
+ _SPREAD_TYPE, _SHAPE_TYPE) = range(len(COLUMNS))
+
+
+class StoredCandle(object):
+    """
+    A read-only, lightweight copy of one row of a CandleStore, as a tuple of
+    its values in the order of COLUMNS. Offers the same accessors as Candle.
+    """
+    __slots__ = ("_row",)
+
+    def __init__(self, row):
+        self._row = row
+
+    @property
+    def utm(self):
+        return int(self._row[_TIME])
+
+    @property
+    def time(self):
+        return local_datetime(self.utm)
+
+    @property
+    def volume(self):
+        return float(self._row[_VOLUME])
+
+    @property
+    def spread(self):
+        return float(self._row[_SPREAD])
+
+    @property
+    def spread_size(self):
+        return abs(self.spread)
+
+    @property
+    def type(self):
+        return CANDLE_TYPES[self._row[_SPREAD_TYPE]]
+
+    @property
+    def type_code(self):
+        return int(self._row[_SPREAD_TYPE])
+
+    @property
+    def shape_code(self):
+        return int(self._row[_SHAPE_TYPE])
+
+    @property
+    def wick_percentages(self):
+        row = self._row
+        return float(row[_UPPER_WICK]), float(row[_LOWER_WICK])
+
+    @property
+    def open(self):
+        return float(self._row[_OPEN])
+
+    @property
+    def high(self):
+        return float(self._row[_HIGH])
+
+    @property
+    def low(self):
+        return float(self._row[_LOW])
+
+    @property
+    def close(self):
+        return float(self._row[_CLOSE])
+
+    @property
+    def data(self):
+        row = self._row
+        return {
+            "high": float(row[_HIGH]),
+            "low": float(row[_LOW]),
+            "open": float(row[_OPEN]),
+            "close": float(row[_CLOSE]),
+            "volume": self.volume,
+            "spread": self.spread,
+            "spread_size": self.spread_size,
+            "spread_type": self.type,
+        }
+
+    @property
+    def shape(self):
+        row = self._row
+        return {
+            "shape_type": SHAPE_TYPES[row[_SHAPE_TYPE]],
+            "upper_wick_percentage": float(row[_UPPER_WICK]),
+            "lower_wick_percentage": float(row[_LOWER_WICK]),
+        }
+
+
+class CandleStore(object):
+    """
+    Columnar history of the most recent candles of a VolumeTracker.
+
+    Every column is a preallocated NumPy array holding two copies of a ring
+    buffer: each value is written at its slot and again one capacity
+    further along. That way the candles in the window are always a single
+    contiguous slice, so a column can be returned as a zero-copy, read-only
+    view in chronological order.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least one candle.")
+        self._capacity = int(capacity)
+        self._columns = {
+            name: np.zeros(2 * self._capacity, dtype=dtype)
+            for name, dtype in COLUMNS
+        }
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+    def append(self, time, open_, high, low, close, volume, spread,
+               upper_wick_percentage, lower_wick_percentage, spread_type,
+               shape_type):
+        """
+        Append a candle. spread_type and shape_type may be names or codes.
+        """
+        if not isinstance(spread_type, (int, np.integer)):
+            spread_type = CANDLE_TYPE_CODES[spread_type]
+        if not isinstance(shape_type, (int, np.integer)):
+            shape_type = SHAPE_TYPE_CODES[shape_type]
+
+        values = (
+            time, open_, high, low, close, volume, spread,
+            upper_wick_percentage, lower_wick_percentage, spread_type,
+            shape_type)
+        position = self._next
+        mirror = position + self._capacity
+        for name, value in zip(COLUMN_NAMES, values):
+            column = self._columns[name]
+            column[position] = value
+            column[mirror] = value
+
+        self._next = position + 1
+        if self._next == self._capacity:
+            self._next = 0
+        if self._count < self._capacity:
+            self._count += 1
+
+    def append_candle(self, candle):
+        upper_wick_percentage, lower_wick_percentage = (
+            candle.wick_percentages)
+        self.append(
+            candle.utm,
+            candle.open,
+            candle.high,
+            candle.low,
+            candle.close,
+            candle.volume,
+            candle.spread,
+            upper_wick_percentage,
+            lower_wick_percentage,
+            candle.type_code,
+            candle.shape_code)
+
+    def extend(self, columns):
+        """
+        Append many candles at once from a mapping of column name to array.
+        Codes must already be numeric.
+        """
+        length = len(columns["time"])
+        if length >= self._capacity:
+            # Only the newest candles fit in the window
+            offset = length - self._capacity
+            for name in COLUMN_NAMES:
+                values = np.asarray(columns[name])[offset:]
+                column = self._columns[name]
+                column[:self._capacity] = values
+                column[self._capacity:] = values
+            self._next = 0
+            self._count = self._capacity
+            return
+
+        positions = (self._next + np.arange(length)) % self._capacity
+        for name in COLUMN_NAMES:
+            values = np.asarray(columns[name])
+            column = self._columns[name]
+            column[positions] = values
+            column[positions + self._capacity] = values
+        self._next = (self._next + length) % self._capacity
+        self._count = min(self._count + length, self._capacity)
+
+    def column(self, name):
+        """
+        Return a read-only view of a column, oldest candle first.
+        """
+        start = (self._next - self._count) % self._capacity
+        view = self._columns[name][start:start + self._count]
+        view.flags.writeable = False
+        return view
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("Candle index out of range.")
+        position = (self._next - self._count + index) % self._capacity
+        return StoredCandle(tuple(
+            self._columns[name][position] for name in COLUMN_NAMES))
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+"""
+Checkpoints of the state of volume trackers, so that a restarted monitor
+carries on from where it stopped instead of initiating them from history
+again, and the candles missed in between are all that's fetched.
+
+A checkpoint is a NumPy .npz archive. Each candle column holds the candles
+of every tracker one after the other, with the epic, resolution and number
+of candles of each tracker alongside. The composite candles each epic's
+aggregator was part way through are kept the same way. It is written to a
+temporary file first and then moved into place, so a crash can't leave
+half of one behind.
+"""
+import logging
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from vpaad import metrics
+from vpaad.candle import FIVE_MINUTES_MS
+from vpaad.candle_store import COLUMN_NAMES
+from vpaad.constants import CANDLE_RES_TO_HISTORICAL_RES
+from vpaad.historical_data_fetcher import HISTORY_FETCH_SECONDS
+from vpaad.times import from_epoch_ms, to_epoch_ms, utc_now
+from vpaad.volume_tracker import add_candle_data
+
+LOGGER = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+# Seconds between checkpoints of a running monitor
+CHECKPOINT_INTERVAL = 300.0
+AGGREGATOR_KEY = "aggregator"
+
+CHECKPOINT_SECONDS = metrics.histogram(
+    "vpaad_checkpoint_seconds", "Time taken to save a checkpoint.")
+
+
+def _split(values, counts):
+    return np.split(values, np.cumsum(counts)[:-1]) if len(counts) else []
+
+
+def save_checkpoint(path, volume_trackers):
+    """
+    Save the state of volume trackers, by epic. An epic's trackers are
+    saved together, between candles, so they must share an aggregator as
+    create_volume_trackers makes them.
+    """
+    with CHECKPOINT_SECONDS.time():
+        trackers = []
+        aggregators = []
+        for epic, vts in sorted(volume_trackers.items()):
+            if not vts:
+                continue
+            aggregator = vts[0].aggregator
+            if any(vt.aggregator is not aggregator for vt in vts):
+                LOGGER.warning(
+                    "Not checkpointing %s, as its volume trackers don't "
+                    "share an aggregator.", epic)
+                continue
+            with aggregator.lock:
+                aggregators.append((epic, aggregator.state()))
+                trackers.extend(
+                    (epic, vt.resolution, vt.state()) for vt in vts)
+
+        arrays = {
+            "version": np.array(CHECKPOINT_VERSION),
+            "epics": np.array(
+                [epic for epic, _, _ in trackers], dtype=np.str_),
+            "resolutions": np.array(
+                [resolution for _, resolution, _ in trackers],
+                dtype=np.str_),
+            "counts": np.array(
+                [len(state["time"]) for _, _, state in trackers],
+                dtype=np.int64),
+            "aggregator_epics": np.array(
+                [epic for epic, _ in aggregators], dtype=np.str_),
+            "aggregator_utms": np.array(
+                [state["utms"] for _, state in aggregators],
+                dtype=np.int64).reshape(len(aggregators), 2),
+            "bucket_counts": np.array(
+                [len(state["bucket_resolutions"])
+                 for _, state in aggregators], dtype=np.int64),
+            "bucket_resolutions": np.array(
+                [resolution for _, state in aggregators
+                 for resolution in state["bucket_resolutions"]],
+                dtype=np.str_),
+            "bucket_prices": np.concatenate(
+                [state["bucket_prices"] for _, state in aggregators] +
+                [np.empty((0, 7))]),
+        }
+        for name in COLUMN_NAMES:
+            arrays["candle_" + name] = np.concatenate(
+                [state[name] for _, _, state in trackers] or [[]])
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.savez(tmp_file, **arrays)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    LOGGER.info(
+        "Saved checkpoint of %d volume trackers to %s", len(trackers), path)
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint saved by save_checkpoint. Returns None when there
+    isn't one, or it can't be read.
+    """
+    if not os.path.exists(path):
+        return None
+    states = {}
+    try:
+        with np.load(path) as saved:
+            version = int(saved["version"])
+            if version != CHECKPOINT_VERSION:
+                raise ValueError(
+                    "Unknown checkpoint version: {}".format(version))
+
+            columns = {
+                name: _split(saved["candle_" + name], saved["counts"])
+                for name in COLUMN_NAMES}
+            for i, (epic, resolution) in enumerate(
+                    zip(saved["epics"], saved["resolutions"])):
+                states.setdefault(str(epic), {})[str(resolution)] = {
+                    name: columns[name][i] for name in COLUMN_NAMES}
+
+            bucket_counts = saved["bucket_counts"]
+            for epic, utms, resolutions, prices in zip(
+                    saved["aggregator_epics"], saved["aggregator_utms"],
+                    _split(saved["bucket_resolutions"], bucket_counts),
+                    _split(saved["bucket_prices"], bucket_counts)):
+                states.setdefault(str(epic), {})[AGGREGATOR_KEY] = {
+                    "utms": utms,
+                    "bucket_resolutions": resolutions,
+                    "bucket_prices": prices,
+                }
+    except (IOError, OSError, KeyError, ValueError,
+            zipfile.BadZipfile) as exc:
+        LOGGER.warning("Ignoring unreadable checkpoint %s: %r", path, exc)
+        return None
+    LOGGER.info("Loaded checkpoint of %d epics from %s", len(states), path)
+    return Checkpoint(states)
+
+
+def _candles_since(historical_data_fetcher, epic, last_utm, now):
+    """
+    Fetch the 5 minute candles of an epic completed after last_utm, as the
+    values of stream events.
+    """
+    now_utm = to_epoch_ms(now)
+    if last_utm + 2 * FIVE_MINUTES_MS > now_utm:
+        return []
+    start = from_epoch_ms([last_utm + FIVE_MINUTES_MS])[0]
+    with HISTORY_FETCH_SECONDS.time():
+        df = historical_data_fetcher.fetch(
+            epic, CANDLE_RES_TO_HISTORICAL_RES["5MINUTE"], start, now)
+
+    utms = to_epoch_ms(df.index)
+    # Without the candle still in progress, which the stream will send
+    rows = np.flatnonzero(
+        (utms > last_utm) & (utms + FIVE_MINUTES_MS <= now_utm))
+    return [
+        {
+            "BID_OPEN": df["Open"].values[i],
+            "BID_HIGH": df["High"].values[i],
+            "BID_LOW": df["Low"].values[i],
+            "BID_CLOSE": df["Close"].values[i],
+            "CONS_TICK_COUNT": df["Volume"].values[i],
+            "UTM": utms[i],
+        }
+        for i in rows]
+
+
+class Checkpoint(object):
+    """
+    The saved state of volume trackers, by epic.
+    """
+    def __init__(self, states):
+        self._states = states
+
+    @property
+    def epics(self):
+        return sorted(self._states)
+
+    def restore(self, epic, volume_trackers, historical_data_fetcher=None,
+                now=None):
+        """
+        Restore an epic's volume trackers, then add the candles completed
+        since the checkpoint, fetched with historical_data_fetcher or else
+        the trackers' own. Returns whether they were restored. They aren't
+        when they weren't all saved, or too long ago for their window.
+        """
+        states = self._states.get(epic, {})
+        if not volume_trackers or AGGREGATOR_KEY not in states:
+            return False
+        aggregator = volume_trackers[0].aggregator
+        if any(vt.resolution not in states or vt.aggregator is not aggregator
+               for vt in volume_trackers):
+            LOGGER.info(
+                "Not all volume trackers of %s are in the checkpoint.", epic)
+            return False
+
+        now = utc_now() if now is None else now
+        last_utm = int(states[AGGREGATOR_KEY]["utms"][1])
+        span = min(vt.history_span for vt in volume_trackers)
+        if (last_utm < 0 or
+                to_epoch_ms(now) - last_utm > span.total_seconds() * 1000):
+            LOGGER.info("Checkpoint of %s is too old to restore.", epic)
+            return False
+
+        if historical_data_fetcher is None:
+            historical_data_fetcher = (
+                volume_trackers[0].historical_data_fetcher)
+        candles = []
+        if historical_data_fetcher is not None:
+            candles = _candles_since(
+                historical_data_fetcher, epic, last_utm, now)
+
+        aggregator.restore(states[AGGREGATOR_KEY])
+        for vt in volume_trackers:
+            vt.restore(states[vt.resolution])
+        for values in candles:
+            add_candle_data(volume_trackers, values, notify_on_anomaly=False)
+        LOGGER.info(
+            "Restored %s from the checkpoint, and added %d candles since.",
+            epic, len(candles))
+        return True
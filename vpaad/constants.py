@@ -29,5 +29,57 @@ HISTORICAL_RES_TO_TIMEDELTA = {
     for key, value in HISTORICAL_RES_TO_CANDLE_RES.items()
 }
 DATETIME_STR_FORMAT = "%Y-%m-%d %H:%M:%S"
-DF_DATETIME_FORMAT = "%Y:%m:%d-%H:%M:%S"
 LOG_FILE_DATETIME_FORMAT = "%Y_%m_%d_%H:%M:%S"
+# Enum codes used when candles are stored in numeric arrays
+CANDLE_TYPES = ("NO_PRICE_CHANGE", "BULLISH", "BEARISH")
+CANDLE_TYPE_CODES = {name: code for code, name in enumerate(CANDLE_TYPES)}
+SHAPE_TYPES = (
+    "AVERAGE_SHAPE", "STRONG_SHOOTING_STAR", "WEAK_SHOOTING_STAR",
+    "STRONG_HAMMER", "WEAK_HAMMER", "LONG_LEGGED_DOJI",
+)
+SHAPE_TYPE_CODES = {name: code for code, name in enumerate(SHAPE_TYPES)}
+VOLUME_TYPES = ("AVERAGE_VOLUME", "HIGH_VOLUME", "LOW_VOLUME")
+VOLUME_TYPE_CODES = {name: code for code, name in enumerate(VOLUME_TYPES)}
+SPREAD_TYPES = ("AVERAGE_SPREAD", "WIDE_SPREAD", "NARROW_SPREAD")
+SPREAD_TYPE_CODES = {name: code for code, name in enumerate(SPREAD_TYPES)}
+# Patterns over several candles, as bits of a mask since a candle can
+# complete more than one
+PATTERNS = (
+    "SELLING_CLIMAX", "BUYING_CLIMAX", "NO_DEMAND", "NO_SUPPLY",
+    "BULLISH_DIVERGENCE", "BEARISH_DIVERGENCE",
+)
+PATTERN_CODES = {name: code for code, name in enumerate(PATTERNS)}
+# Concurrent initiation of volume trackers at start up
+INITIATION_WORKERS = 8
+INITIATION_TIMEOUT = 120
+# On-disk cache of historical candles
+HISTORY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HISTORY_CACHE_MAX_CANDLES = 20000
+# IG's allowances for fetching historical prices: requests per minute per
+# account, and data points (candles) per week
+HISTORY_REQUESTS_PER_MINUTE = 30
+HISTORY_REQUEST_BURST = 5
+HISTORY_DATA_POINTS_PER_WEEK = 10000
+HISTORY_FETCH_WORKERS = 2
+HISTORY_FETCH_RETRIES = 4
+# Seconds before the first retry of a failed fetch, doubling for each one
+HISTORY_FETCH_BACKOFF = 2.0
+HISTORY_FETCH_MAX_BACKOFF = 60.0
+# Shape thresholds, as a fraction of the candle's height
+STRONG_WICK_PERCENTAGE = 0.75
+LONG_WICK_PERCENTAGE = 0.4
+SHORT_WICK_PERCENTAGE = 0.3
+NUMBER_OF_STDS_AWAY_FROM_MEAN = 1.0
+# What a candle dispatcher may do with a candle when a queue is full
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+# Default grids of vpaad sweep, around the thresholds used when monitoring
+SWEEP_WINDOWS = (36, START_TIME_MULIPLIER, 144)
+SWEEP_NUMBERS_OF_STDS = (0.5, NUMBER_OF_STDS_AWAY_FROM_MEAN, 1.5, 2.0)
+SWEEP_STRONG_WICK_PERCENTAGES = (0.7, STRONG_WICK_PERCENTAGE, 0.8)
+SWEEP_LONG_WICK_PERCENTAGES = (LONG_WICK_PERCENTAGE,)
+SWEEP_SHORT_WICK_PERCENTAGES = (SHORT_WICK_PERCENTAGE,)
+SWEEP_SORT_COLUMNS = ("Hits", "HitsPer1000", "ReversalRate")
+# Slow down, relative to the baseline, from which a benchmark is flagged
+REGRESSION_THRESHOLD = 0.2
+# Seconds any command may take to start, up to printing its help
+STARTUP_BUDGET = 0.5
@@ -1,76 +1,242 @@
 # -*- coding:utf-8 -*-
 import logging
+import random
 import smtplib
+import socket
 import threading
 import time
-from Queue import Queue, Empty
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from vpaad import metrics
 
 LOGGER = logging.getLogger(__name__)
 
+# Seconds to wait for more anomalies before sending, so that a burst of them
+# goes out as a single digest e-mail
+DIGEST_WINDOW = 10.0
+# Delivery attempts after the first one fails, and the delay before the
+# first of them, doubled after each failure
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2.0
+# Reconnect rather than reuse an SMTP connection left idle for this long, as
+# servers drop idle connections
+IDLE_TIMEOUT = 240.0
+# Seconds to wait on the SMTP server before giving up on a delivery attempt,
+# so that an unresponsive server can't stall the thread forever
+SMTP_TIMEOUT = 30.0
+
+_STOP = object()
+
+EMAIL_SECONDS = metrics.histogram(
+    "vpaad_email_seconds",
+    "Time taken to send an e-mail, including retries.")
+EMAILS = metrics.counter(
+    "vpaad_emails_total", "E-mails sent, or given up on.", ("result",))
+EMAIL_QUEUE_DEPTH = metrics.gauge(
+    "vpaad_email_queue_depth", "Reports waiting to be e-mailed.")
+
 
 class Emailer(object):
     """
     An instance that sits in its own thread and sends emails when they
     are available in the queue.
+
+    The thread blocks on the queue until a report arrives, then waits up to
+    digest_window seconds for others so that a burst of anomalies is sent
+    as one digest. The SMTP session is kept open between e-mails and
+    reopened when it's been idle too long or fails. Failed deliveries are
+    retried with exponential backoff.
     """
-    def __init__(self, notification_config, password):
+    def __init__(self, notification_config, password, smtp_class=None):
         self._from = notification_config["email_address"]
         self._recipients = notification_config["recipients"]
         self._username = notification_config["username"]
         self._password = password
+        self._report_format = notification_config.get("format", "text")
+
+        self._smtp_server = notification_config.get(
+            "smtp_server", "smtp.gmail.com")
+        self._smtp_port = notification_config.get("smtp_port", 587)
+        self._use_tls = notification_config.get("use_tls", True)
+        self._digest_window = notification_config.get(
+            "digest_window", DIGEST_WINDOW)
+        self._max_retries = notification_config.get(
+            "max_retries", MAX_RETRIES)
+        self._retry_backoff = notification_config.get(
+            "retry_backoff", RETRY_BACKOFF)
+        self._smtp_class = smtp_class or smtplib.SMTP
+
+        self._server = None
+        self._last_used = None
 
         self._emailer_thread = None
-        self._running = False
+        self._stopping = threading.Event()
         self._queue = Queue()
-        self._queue_lock = threading.Lock()
 
         LOGGER.info(
             "Created e-mailer with address: %s and username: %s",
             self._from, self._username)
 
-    def _send_email(self, summary, content):
-        from_address = self._from
-        to_address = self._recipients
-        subject = "VPA Anomaly Detected: {}".format(summary)
-        body = content
-
-        # Prepare actual message
-        message = """From: %s\nTo: %s\nSubject: %s\n\n%s
-        """ % (from_address, ", ".join(to_address), subject, body)
+    def _connect(self):
+        LOGGER.info(
+            "Connecting to SMTP server %s:%s",
+            self._smtp_server, self._smtp_port)
+        server = self._smtp_class(
+            self._smtp_server, self._smtp_port, timeout=SMTP_TIMEOUT)
         try:
-            server = smtplib.SMTP("smtp.gmail.com", 587)
             server.ehlo()
-            server.starttls()
-            server.login(self._username, self._password)
-            server.sendmail(from_address, to_address, message)
+            if self._use_tls:
+                server.starttls()
+                server.ehlo()
+            if self._password:
+                server.login(self._username, self._password)
+        except Exception:
             server.close()
-            LOGGER.info('Successfully sent the mail to: %s', to_address)
-        except Exception as exc:
-            LOGGER.error("Failed to send mail. Exception: %r", exc)
+            raise
+        return server
+
+    def _connection(self):
+        if (self._server is not None
+                and time.time() - self._last_used > IDLE_TIMEOUT):
+            self._disconnect()
+        if self._server is None:
+            self._server = self._connect()
+        self._last_used = time.time()
+        return self._server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+            self._server = None
+        except (smtplib.SMTPException, socket.error):
+            self._drop_connection()
+
+    def _drop_connection(self):
+        if self._server is not None:
+            try:
+                self._server.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._server = None
+
+    def _message(self, reports):
+        if len(reports) == 1:
+            report = reports[0]
+            subject = "VPA Anomaly Detected: {}".format(report.summary)
+            body = self._render(report)
+        else:
+            subject = "VPA Anomalies Detected: {} anomalies".format(
+                len(reports))
+            body = "\n\n".join(
+                ["\n".join(report.summary for report in reports)] +
+                [self._render(report) for report in reports])
+
+        return "From: %s\nTo: %s\nSubject: %s\n\n%s\n" % (
+            self._from, ", ".join(self._recipients), subject, body)
+
+    def _render(self, report):
+        if self._report_format == "text":
+            return report.content
+        return report.render(self._report_format)
+
+    def _send_email(self, reports):
+        with EMAIL_SECONDS.time():
+            sent = self._deliver(reports)
+        EMAILS.labels("sent" if sent else "failed").inc()
+        return sent
+
+    def _deliver(self, reports):
+        message = self._message(reports)
+        for attempt in range(self._max_retries + 1):
+            try:
+                self._connection().sendmail(
+                    self._from, self._recipients, message)
+                LOGGER.info(
+                    "Successfully sent the mail about %d anomalies to: %s",
+                    len(reports), self._recipients)
+                return True
+            except (smtplib.SMTPException, socket.error) as exc:
+                LOGGER.error("Failed to send mail. Exception: %r", exc)
+                # Start again with a fresh connection
+                self._drop_connection()
+
+            if attempt < self._max_retries:
+                delay = self._retry_backoff * (2 ** attempt)
+                delay *= random.uniform(0.5, 1.5)
+                LOGGER.info("Retrying sending mail in %.1fs", delay)
+                if self._stopping.wait(delay):
+                    break
+
+        LOGGER.error(
+            "Giving up sending the mail about: %s",
+            ", ".join(report.summary for report in reports))
+        return False
 
     def start(self):
         LOGGER.info("Starting Emailer thread.")
-        self._running = True
+        EMAIL_QUEUE_DEPTH.set_function(self._queue.qsize)
+        self._stopping.clear()
         self._emailer_thread = threading.Thread(target=self._run)
         self._emailer_thread.start()
 
     def stop(self):
+        """
+        Stop the thread, once the reports already queued have been sent.
+        Failed deliveries aren't retried any more.
+        """
         LOGGER.info("Stopping Emailer thread.")
         if self._emailer_thread is not None:
-            self._running = False
+            self._stopping.set()
+            self._queue.put(_STOP)
             self._emailer_thread.join()
+            self._emailer_thread = None
 
-    def _run(self):
-        while self._running:
+    def _next_batch(self):
+        """
+        Block until a report arrives, then collect the ones arriving within
+        the digest window. Returns the reports and whether to stop.
+        """
+        report = self._queue.get()
+        if report is _STOP:
+            return [], True
+
+        reports = [report]
+        deadline = time.time() + self._digest_window
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
             try:
-                with self._queue_lock:
-                    summary, content = self._queue.get_nowait()
-                self._send_email(summary, content)
+                report = self._queue.get(timeout=remaining)
             except Empty:
-                pass
-            time.sleep(1)
+                break
+            if report is _STOP:
+                return reports, True
+            reports.append(report)
+        return reports, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            reports, stop = self._next_batch()
+            if not reports:
+                continue
+            # Whatever goes wrong with one batch, carry on with the next
+            try:
+                self._send_email(reports)
+            except Exception:
+                LOGGER.exception(
+                    "Could not send the mail about %d anomalies.",
+                    len(reports))
+                EMAILS.labels("failed").inc()
+                self._drop_connection()
+        self._disconnect()
 
-    def add_email_to_queue(self, summary, content):
-        LOGGER.info("Added email to queue: %s", summary)
-        with self._queue_lock:
-            self._queue.put((summary, content))
+    def add_email_to_queue(self, report):
+        LOGGER.info("Added email to queue: %s", report.summary)
+        self._queue.put(report)
@@ -0,0 +1,334 @@
+# -*- coding:utf-8 -*-
+"""
+Fetching historical prices from IG within its allowances: how many requests
+an account may make a minute, and how many data points (candles) it may
+fetch a week. IG refuses requests beyond either, so without this a monitor
+starting up with many markets fails to initiate them.
+
+FetchScheduler queues fetches, shortest resolution first, and makes them
+from a few worker threads no faster than a token bucket allows. Fetches
+that fail are retried after a jittered, exponentially growing delay, and a
+fetch identical to one already queued waits for that one's result instead
+of being requested again. Once the week's data points are used up, fetches
+fail straight away rather than being sent.
+"""
+import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+try:
+    from queue import PriorityQueue
+except ImportError:
+    from Queue import PriorityQueue
+
+from vpaad import metrics
+from vpaad.constants import (
+    HISTORICAL_RES_TO_TIMEDELTA, HISTORY_DATA_POINTS_PER_WEEK,
+    HISTORY_FETCH_BACKOFF, HISTORY_FETCH_MAX_BACKOFF, HISTORY_FETCH_RETRIES,
+    HISTORY_FETCH_WORKERS, HISTORY_REQUEST_BURST,
+    HISTORY_REQUESTS_PER_MINUTE)
+from vpaad.historical_data_fetcher import IHistoricalDataFetcher
+
+LOGGER = logging.getLogger(__name__)
+
+WEEK_SECONDS = 7 * 24 * 3600
+# Parts of the errors IG responds with when an allowance is used up
+RATE_LIMIT_ERRORS = (
+    "ApiExceededException", "exceeded-api-key-allowance",
+    "exceeded-account-allowance")
+DATA_POINT_ALLOWANCE_ERRORS = ("exceeded-account-historical-data-allowance",)
+
+_STOP = object()
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+HISTORY_REQUESTS = metrics.counter(
+    "vpaad_history_requests_total",
+    "Requests for historical prices, by result.", ("result",))
+HISTORY_FETCHES_DEDUPLICATED = metrics.counter(
+    "vpaad_history_fetches_deduplicated_total",
+    "Fetches of historical prices answered by an identical queued fetch.")
+HISTORY_THROTTLE_SECONDS = metrics.histogram(
+    "vpaad_history_throttle_seconds",
+    "Time requests for historical prices waited for the rate limit.")
+HISTORY_FETCH_QUEUE_DEPTH = metrics.gauge(
+    "vpaad_history_fetch_queue_depth",
+    "Fetches of historical prices waiting to be requested.")
+HISTORY_DATA_POINTS = metrics.counter(
+    "vpaad_history_data_points_total", "Historical data points fetched.")
+HISTORY_DATA_POINTS_REMAINING = metrics.gauge(
+    "vpaad_history_data_points_remaining",
+    "Historical data points left in this week's allowance.")
+
+
+class HistoryAllowanceExceeded(Exception):
+    """
+    Raised when a fetch would go beyond the week's data point allowance.
+    """
+
+
+class FetchSchedulerStopped(Exception):
+    """
+    Raised for fetches still queued when the scheduler is stopped.
+    """
+
+
+def _error_text(exc):
+    return "{}: {}".format(type(exc).__name__, exc)
+
+
+def _floor(time, td):
+    """The start of the td long period of naive UTC time it falls in."""
+    return time - (time - _EPOCH) % td
+
+
+class TokenBucket(object):
+    """
+    Allows rate tokens a second on average, and up to capacity at once.
+    """
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(
+                "Rate must be positive and capacity at least one.")
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self):
+        """
+        Take a token. Returns how many seconds to wait before using it.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(-self._tokens / self._rate, 0.0)
+
+    def pause(self, seconds):
+        """
+        Hold back every token for at least seconds, as when IG says the
+        rate limit has been reached anyway.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0) - seconds * self._rate
+
+
+class DataPointAllowance(object):
+    """
+    Counts the data points fetched against a weekly allowance. Whenever IG
+    says how much of the allowance is left, that replaces the count.
+    """
+    def __init__(self, total=HISTORY_DATA_POINTS_PER_WEEK,
+                 period=WEEK_SECONDS, clock=time.monotonic):
+        self._total = total
+        self._period = period
+        self._clock = clock
+        self._remaining = total
+        self._resets_at = clock() + period
+        self._lock = threading.Lock()
+
+    def _reset_if_expired(self):
+        now = self._clock()
+        if now >= self._resets_at:
+            self._remaining = self._total
+            self._resets_at = now + self._period
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self._reset_if_expired()
+            return self._remaining
+
+    def consume(self, data_points):
+        HISTORY_DATA_POINTS.inc(data_points)
+        with self._lock:
+            self._reset_if_expired()
+            self._remaining = max(self._remaining - data_points, 0)
+
+    def update(self, remaining, expiry_seconds, total=None):
+        """
+        Set what's left of the allowance, and the seconds until it resets,
+        as IG reports them.
+        """
+        with self._lock:
+            if total is not None:
+                self._total = total
+            HISTORY_DATA_POINTS.inc(max(self._remaining - remaining, 0))
+            self._remaining = remaining
+            self._resets_at = self._clock() + expiry_seconds
+
+    def exhaust(self):
+        with self._lock:
+            self._reset_if_expired()
+            self._remaining = 0
+
+
+class FetchScheduler(IHistoricalDataFetcher):
+    """
+    Makes the fetches of another IHistoricalDataFetcher from worker
+    threads, at most requests_per_minute in any minute, and retries those
+    that fail.
+
+    Up to burst requests are made at once, then the rest at an even pace
+    that keeps any minute within the limit. When an allowance is given, it
+    should be the one the fetcher counts its data points against.
+    """
+    def __init__(
+            self, historical_data_fetcher,
+            requests_per_minute=HISTORY_REQUESTS_PER_MINUTE,
+            burst=HISTORY_REQUEST_BURST, allowance=None,
+            workers=HISTORY_FETCH_WORKERS, retries=HISTORY_FETCH_RETRIES,
+            backoff=HISTORY_FETCH_BACKOFF,
+            max_backoff=HISTORY_FETCH_MAX_BACKOFF, seed=None):
+        if requests_per_minute <= burst:
+            raise ValueError(
+                "More requests a minute than the burst are needed.")
+        if workers < 1:
+            raise ValueError("At least one worker is needed.")
+
+        self._historical_data_fetcher = historical_data_fetcher
+        self._bucket = TokenBucket(
+            (requests_per_minute - burst) / 60.0, burst)
+        self._allowance = allowance
+        self._workers = workers
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._rng = random.Random(seed)
+
+        self._queue = PriorityQueue()
+        self._sequence = itertools.count()
+        self._fetches = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def start(self):
+        LOGGER.info("Starting %d history fetch workers.", self._workers)
+        self._stopped.clear()
+        HISTORY_FETCH_QUEUE_DEPTH.set_function(lambda: self.queued)
+        if self._allowance is not None:
+            HISTORY_DATA_POINTS_REMAINING.set_function(
+                lambda: self._allowance.remaining)
+        for i in range(self._workers):
+            thread = threading.Thread(
+                target=self._work, name="FetchScheduler-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the workers, failing the fetches still queued.
+        """
+        LOGGER.info("Stopping history fetch workers.")
+        self._stopped.set()
+        for _ in self._threads:
+            self._queue.put((float("-inf"), next(self._sequence), _STOP, None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        while not self._queue.empty():
+            _, _, key, future = self._queue.get_nowait()
+            if key is not _STOP:
+                self._finish(key, future, exception=FetchSchedulerStopped())
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        """
+        Queue a fetch, and wait for its result. The times are floored to
+        the resolution, which covers the same candles, so that fetches
+        asked for moments apart are made once.
+        """
+        td = HISTORICAL_RES_TO_TIMEDELTA[resolution]
+        key = (epic, resolution, _floor(start_time, td), _floor(end_time, td))
+        with self._lock:
+            future = self._fetches.get(key)
+            if future is None:
+                future = Future()
+                self._fetches[key] = future
+                priority = td.total_seconds()
+                self._queue.put(
+                    (priority, next(self._sequence), key, future))
+            else:
+                HISTORY_FETCHES_DEDUPLICATED.inc()
+        return future.result().copy()
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            self._fetches.pop(key, None)
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+    def _work(self):
+        while True:
+            _, _, key, future = self._queue.get()
+            if key is _STOP:
+                return
+            try:
+                df = self._fetch_with_retries(*key)
+            except Exception as exc:
+                self._finish(key, future, exception=exc)
+            else:
+                self._finish(key, future, result=df)
+
+    def _wait(self, seconds):
+        if self._stopped.wait(seconds):
+            raise FetchSchedulerStopped()
+
+    def _fetch_with_retries(self, epic, resolution, start_time, end_time):
+        for attempt in itertools.count():
+            if self._allowance is not None and self._allowance.remaining <= 0:
+                HISTORY_REQUESTS.labels("allowance_exceeded").inc()
+                raise HistoryAllowanceExceeded(
+                    "No historical data points left to fetch {} ({}) "
+                    "with.".format(epic, resolution))
+
+            delay = self._bucket.reserve()
+            if delay:
+                HISTORY_THROTTLE_SECONDS.observe(delay)
+                self._wait(delay)
+            try:
+                df = self._historical_data_fetcher.fetch(
+                    epic, resolution, start_time, end_time)
+            except Exception as exc:
+                error = _error_text(exc)
+                if any(code in error for code in DATA_POINT_ALLOWANCE_ERRORS):
+                    HISTORY_REQUESTS.labels("allowance_exceeded").inc()
+                    if self._allowance is not None:
+                        self._allowance.exhaust()
+                    raise HistoryAllowanceExceeded(error)
+                if attempt >= self._retries:
+                    HISTORY_REQUESTS.labels("failed").inc()
+                    raise
+
+                HISTORY_REQUESTS.labels("retried").inc()
+                limit = min(self._backoff * 2 ** attempt, self._max_backoff)
+                delay = limit / 2 + self._rng.uniform(0, limit / 2)
+                if any(code in error for code in RATE_LIMIT_ERRORS):
+                    # Every worker would be refused for now
+                    self._bucket.pause(delay)
+                LOGGER.warning(
+                    "Fetching %s (%s) history failed, retrying in %.1fs: %s",
+                    epic, resolution, delay, error)
+                self._wait(delay)
+            else:
+                HISTORY_REQUESTS.labels("ok").inc()
+                return df
@@ -1,21 +1,25 @@
 # -*- coding:utf-8 -*-
-import datetime
-
 import logging
 import numpy as np
 import pandas as pd
 
+from vpaad import metrics
 from vpaad.constants import (
-    START_TIME_MULIPLIER, DATETIME_STR_FORMAT, DF_DATETIME_FORMAT,
-    HISTORICAL_RES_TO_TIMEDELTA)
+    DATETIME_STR_FORMAT, CANDLE_RES_TO_HISTORICAL_RES,
+    CANDLE_RES_TO_TIMEDELTA, HISTORICAL_RES_TO_TIMEDELTA)
+from vpaad.synthetic import generate_candles
+from vpaad.times import local_to_utc, utc_to_local
 
 LOGGER = logging.getLogger(__name__)
 
+HISTORY_FETCH_SECONDS = metrics.histogram(
+    "vpaad_history_fetch_seconds", "Time taken to fetch historical prices.")
+
 
 def create_historical_data_fetcher(
-        interpolated_hd_params, ig_service, real_history):
+        interpolated_hd_params, ig_service, real_history, allowance=None):
     if real_history:
-        return RealHistoricalDataFetcher(ig_service)
+        return RealHistoricalDataFetcher(ig_service, allowance)
     else:
         return InterpolatedHistoricalDataFetcher(interpolated_hd_params)
 
@@ -31,66 +35,134 @@ def condense_historic_data(df):
     return candle_df
 
 
+def resample_historic_data(df, resolution, end_time=None):
+    """
+    Aggregate historical data into candles of a coarser resolution, combining
+    prices and volumes the same way CompositeCandle does. Candles are aligned
+    to the clock, and one still in progress at end_time is left out.
+    """
+    td = HISTORICAL_RES_TO_TIMEDELTA[resolution]
+    candle_df = df[["Open", "High", "Low", "Close", "Volume"]]
+
+    resampled = candle_df.resample(
+        pd.Timedelta(td), label="left", closed="left").agg({
+            "Open": "first",
+            "High": "max",
+            "Low": "min",
+            "Close": "last",
+            "Volume": "sum",
+        })
+    # Periods without any candles, e.g. when the market is closed
+    resampled = resampled.dropna(subset=["Open"])
+    if end_time is not None:
+        resampled = resampled[resampled.index + td <= end_time]
+
+    resampled["AbsSpread"] = (
+        pd.Series.abs(resampled["Open"] - resampled["Close"]))
+    resampled.index.name = df.index.name
+    return resampled
+
+
+def load_epic_history(historical_data_fetcher, epic, spans, end_time):
+    """
+    Fetch the history of an epic for several candle resolutions with a single
+    request. spans maps each resolution to how far back its history must go.
+
+    The finest resolution is fetched far enough back to cover every span,
+    and the coarser resolutions are resampled from it.
+    """
+    finest_res = min(spans, key=lambda res: CANDLE_RES_TO_TIMEDELTA[res])
+    start_time = end_time - max(spans.values())
+
+    LOGGER.info(
+        "Fetching %s history for %s from %s to %s, for resolutions: %s",
+        finest_res, epic, start_time, end_time, ", ".join(spans))
+    with HISTORY_FETCH_SECONDS.time():
+        df = historical_data_fetcher.fetch(
+            epic, CANDLE_RES_TO_HISTORICAL_RES[finest_res], start_time,
+            end_time)
+
+    histories = {}
+    for res, span in spans.items():
+        if res == finest_res:
+            res_df = df
+        else:
+            res_df = resample_historic_data(
+                df, CANDLE_RES_TO_HISTORICAL_RES[res], end_time)
+        candle_count = int(span / CANDLE_RES_TO_TIMEDELTA[res])
+        histories[res] = res_df.iloc[-candle_count:]
+    return histories
+
+
 class IHistoricalDataFetcher(object):
     def fetch(self, epic, resolution, start_time, end_time):
+        """
+        Return the candles between two naive UTC datetimes, as a DataFrame
+        with a DatetimeIndex of naive UTC times.
+        """
         raise NotImplementedError()
 
 
 class RealHistoricalDataFetcher(IHistoricalDataFetcher):
-    def __init__(self, ig_service):
+    def __init__(self, ig_service, allowance=None):
         self._ig_service = ig_service
+        self._allowance = allowance
 
     def fetch(self, epic, resolution, start_time, end_time):
         """
-        Fetch actual historical data from IG
+        Fetch actual historical data from IG, which works in local time.
+        When there is an allowance, the data points fetched are counted
+        against it.
         """
         historical_info = (
             self._ig_service.fetch_historical_prices_by_epic_and_date_range(
-                epic, resolution, start_time, end_time)
+                epic, resolution,
+                utc_to_local(start_time).strftime(DATETIME_STR_FORMAT),
+                utc_to_local(end_time).strftime(DATETIME_STR_FORMAT))
         )
-        return condense_historic_data(historical_info["prices"])
+        df = condense_historic_data(historical_info["prices"])
+        df.index = local_to_utc(df.index)
+
+        if self._allowance is not None:
+            # Older versions of the API don't nest it in the metadata
+            allowance = historical_info.get("allowance") or (
+                historical_info.get("metadata") or {}).get("allowance")
+            if allowance:
+                self._allowance.update(
+                    allowance["remainingAllowance"],
+                    allowance["allowanceExpiry"],
+                    allowance.get("totalAllowance"))
+            else:
+                self._allowance.consume(len(df))
+        return df
 
 
 class InterpolatedHistoricalDataFetcher(IHistoricalDataFetcher):
-    def __init__(self, interpolated_hd_params):
+    def __init__(self, interpolated_hd_params, seed=None):
         self._interpolated_hd_params = interpolated_hd_params
+        self._rng = np.random.default_rng(seed)
 
     def fetch(self, epic, resolution, start_time, end_time):
         """
-        Return mocked up data based on given mean and standard deviation
+        Return synthetic candles, between the given times, with volumes and
+        spread sizes of about the given mean and standard deviation
         """
         epic_params = self._interpolated_hd_params[epic][resolution]
         volume_params = epic_params["volume"]
         spread_params = epic_params["spread"]
 
-        volume_a = np.random.normal(
-            volume_params["mean"], volume_params["std"], START_TIME_MULIPLIER)
-        spread_a = np.random.normal(
-            spread_params["mean"], spread_params["std"], START_TIME_MULIPLIER)
-        volume_a = np.absolute(volume_a)
-        spread_a = np.absolute(spread_a)
-
-        df = pd.DataFrame()
-
         td = HISTORICAL_RES_TO_TIMEDELTA[resolution]
-        mock_times = [
-            datetime.datetime.strptime(start_time, DATETIME_STR_FORMAT) +
-            td * i for i in range(START_TIME_MULIPLIER)
-        ]
-
-        mock_times = [
-            dt.strftime(DF_DATETIME_FORMAT) for dt in mock_times
-        ]
-
-        df["Time"] = mock_times
-        df.set_index("Time", inplace=True)
-
-        df["AbsSpread"] = spread_a.tolist()
-        df["Volume"] = volume_a.tolist()
-
-        # These are irrelevant
-        df["Open"] = [0 for _ in range(START_TIME_MULIPLIER)]
-        df["Close"] = [0 for _ in range(START_TIME_MULIPLIER)]
-        df["High"] = [0 for _ in range(START_TIME_MULIPLIER)]
-        df["Low"] = [0 for _ in range(START_TIME_MULIPLIER)]
+        # Candles are aligned to the clock, covering the times from
+        # start_time, and all finished by end_time
+        end = pd.Timestamp(end_time).floor(td)
+        count = max(int(np.ceil((end - start_time) / td)), 0)
+
+        df = generate_candles(
+            count, end - count * td, td,
+            volume_mean=volume_params["mean"],
+            volume_std=volume_params["std"],
+            spread_mean=spread_params["mean"],
+            spread_std=spread_params["std"],
+            seed=self._rng.integers(2 ** 32))
+        df["AbsSpread"] = (df["Open"] - df["Close"]).abs()
         return df
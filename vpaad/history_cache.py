@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from vpaad.constants import (
+    HISTORICAL_RES_TO_TIMEDELTA, HISTORY_CACHE_MAX_BYTES,
+    HISTORY_CACHE_MAX_CANDLES)
+from vpaad.historical_data_fetcher import IHistoricalDataFetcher
+from vpaad.times import from_epoch_ms, to_epoch_ms
+
+LOGGER = logging.getLogger(__name__)
+
+PRICE_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+CACHE_FILE_EXTENSION = ".npz"
+
+
+def read_cache_file(path):
+    """
+    Read a cache file. Returns its candles, with a DatetimeIndex, and the
+    time range they were fetched for.
+    """
+    with np.load(path) as cached:
+        df = pd.DataFrame(
+            {column: cached[column] for column in PRICE_COLUMNS},
+            index=from_epoch_ms(cached["Time"]))
+        fetched_from, fetched_until = from_epoch_ms(cached["FetchedRange"])
+    return df, fetched_from, fetched_until
+
+
+class CachingHistoricalDataFetcher(IHistoricalDataFetcher):
+    """
+    Keeps the candles fetched by another IHistoricalDataFetcher on disk, one
+    file per epic and resolution, so that only the candles completed since
+    the last fetch need to be requested again.
+
+    Files are NumPy .npz archives holding one array per column. They are
+    written to a temporary file first and then moved into place, so a crash
+    can't leave a half written cache file behind; a file that can't be read
+    anyway is discarded and fetched again. Each file keeps at most
+    max_candles candles, and the least recently used files are deleted when
+    the cache grows beyond max_bytes.
+    """
+    def __init__(
+            self, historical_data_fetcher, cache_dir,
+            max_bytes=HISTORY_CACHE_MAX_BYTES,
+            max_candles=HISTORY_CACHE_MAX_CANDLES):
+        self._historical_data_fetcher = historical_data_fetcher
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_candles = max_candles
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._eviction_lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, epic, resolution):
+        filename = "{}_{}{}".format(epic, resolution, CACHE_FILE_EXTENSION)
+        return os.path.join(
+            self._cache_dir, filename.replace(os.sep, "_"))
+
+    def _lock(self, path):
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _load(self, path):
+        """
+        Return the cached candles and the time range they were fetched for,
+        or (None, None, None) when nothing usable is cached.
+        """
+        if not os.path.exists(path):
+            return None, None, None
+        try:
+            df, fetched_from, fetched_until = read_cache_file(path)
+        except (IOError, OSError, KeyError, ValueError,
+                zipfile.BadZipfile) as exc:
+            LOGGER.warning("Discarding unreadable cache file %s: %r",
+                           path, exc)
+            os.remove(path)
+            return None, None, None
+
+        # Mark as recently used
+        os.utime(path, None)
+        return df, fetched_from, fetched_until
+
+    def _save(self, path, df, fetched_from, fetched_until):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.savez(
+                    tmp_file,
+                    Time=to_epoch_ms(df.index),
+                    FetchedRange=to_epoch_ms(pd.DatetimeIndex(
+                        [fetched_from, fetched_until])),
+                    **{column: df[column].values.astype(np.float64)
+                       for column in PRICE_COLUMNS})
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _evict(self):
+        with self._eviction_lock:
+            files = []
+            for filename in os.listdir(self._cache_dir):
+                if not filename.endswith(CACHE_FILE_EXTENSION):
+                    continue
+                path = os.path.join(self._cache_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Discarded as unreadable by another fetch meanwhile
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total_size <= self._max_bytes:
+                    break
+                LOGGER.info("Evicting cache file %s", path)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    def _fetch(self, epic, resolution, start_time, end_time):
+        df = self._historical_data_fetcher.fetch(
+            epic, resolution, start_time, end_time)
+        return df[list(PRICE_COLUMNS)]
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        """
+        Fetch historical data, only requesting what isn't cached yet. Only
+        the candles finished by end_time are returned, whether they were
+        cached or not.
+        """
+        td = HISTORICAL_RES_TO_TIMEDELTA[resolution]
+        start = pd.Timestamp(start_time)
+        end = pd.Timestamp(end_time)
+        path = self._path(epic, resolution)
+
+        with self._lock(path):
+            cached, fetched_from, fetched_until = self._load(path)
+
+            if cached is None or fetched_from > start:
+                LOGGER.info(
+                    "History cache miss for %s (%s)", epic, resolution)
+                df = self._fetch(epic, resolution, start, end)
+                fetched_from = start
+                fetched_until = end
+            else:
+                # Everything up to the first unfinished candle is cached
+                gap_start = fetched_until - td
+                if len(cached):
+                    gap_start = max(gap_start, cached.index[-1] + td)
+                if gap_start + td <= end:
+                    LOGGER.info(
+                        "Topping up history cache for %s (%s) from %s",
+                        epic, resolution, gap_start)
+                    gap_df = self._fetch(epic, resolution, gap_start, end)
+                    df = pd.concat((cached, gap_df))
+                    df = df[~df.index.duplicated(keep="last")].sort_index()
+                    fetched_until = end
+                else:
+                    LOGGER.info(
+                        "History cache hit for %s (%s)", epic, resolution)
+                    df = cached
+
+            if fetched_until == end:
+                # Only keep candles that had finished when they were fetched
+                complete = df[df.index + td <= fetched_until]
+                if len(complete) > self._max_candles:
+                    complete = complete.iloc[-self._max_candles:]
+                    fetched_from = complete.index[0]
+                self._save(path, complete, fetched_from, fetched_until)
+
+        self._evict()
+
+        df = df.iloc[
+            df.index.searchsorted(start):
+            df.index.searchsorted(end - td, side="right")].copy()
+        df["AbsSpread"] = pd.Series.abs(df["Open"] - df["Close"])
+        return df
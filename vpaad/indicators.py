@@ -0,0 +1,228 @@
+# -*- coding:utf-8 -*-
+"""
+Indicators updated with one value at a time, in O(1) (amortised for
+RollingMinMax) whatever their window, so that tracking the context of each
+new candle never means rescanning the candles before it.
+"""
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class EMA(object):
+    """
+    Exponential moving average, seeded with the first value.
+    """
+    def __init__(self, span):
+        if span < 1:
+            raise ValueError("Span must be at least one value.")
+        self._alpha = 2.0 / (span + 1.0)
+        self._value = float("nan")
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def value(self):
+        return self._value
+
+    def add(self, value):
+        if self._count:
+            self._value += self._alpha * (value - self._value)
+        else:
+            self._value = float(value)
+        self._count += 1
+        return self._value
+
+    def extend(self, values):
+        if not len(values):
+            return
+        seed = [] if not self._count else [self._value]
+        series = pd.Series(np.concatenate(
+            (seed, np.asarray(values, dtype=np.float64))))
+        self._value = float(series.ewm(
+            alpha=self._alpha, adjust=False).mean().iloc[-1])
+        self._count += len(values)
+
+
+def ema(values, span):
+    """
+    Vectorised equivalent of adding each of values to a new EMA, returning
+    its value after each add.
+    """
+    return pd.Series(np.asarray(values, dtype=np.float64)).ewm(
+        alpha=2.0 / (span + 1.0), adjust=False).mean().values
+
+
+class RollingSlope(object):
+    """
+    Least squares slope, per value, of the most recent values in a window.
+
+    The sums needed are updated as values enter and leave the window: when
+    the oldest value leaves, the others move one place down, which takes
+    the sum of the values off the sum of the values times their place.
+    """
+    # As for RollingStats, rounding errors are cleared every so often
+    RESYNC_INTERVAL = 100000
+
+    def __init__(self, window):
+        if window < 2:
+            raise ValueError("Window must contain at least two values.")
+        self._window = int(window)
+        self._buffer = np.zeros(self._window, dtype=np.float64)
+        self._next = 0
+        self._count = 0
+        self._sum = 0.0
+        self._weighted_sum = 0.0
+        self._updates_since_resync = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def slope(self):
+        n = self._count
+        if n < 2:
+            return float("nan")
+        sum_x = n * (n - 1) / 2.0
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6.0
+        return (
+            (n * self._weighted_sum - sum_x * self._sum) /
+            (n * sum_xx - sum_x * sum_x))
+
+    def add(self, value):
+        value = float(value)
+        if self._count < self._window:
+            self._weighted_sum += self._count * value
+            self._sum += value
+            self._count += 1
+        else:
+            old_value = float(self._buffer[self._next])
+            self._weighted_sum += (
+                old_value - self._sum + (self._window - 1) * value)
+            self._sum += value - old_value
+
+        self._buffer[self._next] = value
+        self._next += 1
+        if self._next == self._window:
+            self._next = 0
+
+        self._updates_since_resync += 1
+        if self._updates_since_resync >= self.RESYNC_INTERVAL:
+            self._resync()
+
+    def extend(self, values):
+        for value in np.asarray(values, dtype=np.float64)[-self._window:]:
+            self.add(value)
+
+    def values(self):
+        """Return a copy of the values in the window, oldest first."""
+        if self._count < self._window:
+            return self._buffer[:self._count].copy()
+        return np.concatenate(
+            (self._buffer[self._next:], self._buffer[:self._next]))
+
+    def _resync(self):
+        values = self.values()
+        self._sum = float(np.sum(values))
+        self._weighted_sum = float(np.dot(np.arange(len(values)), values))
+        self._updates_since_resync = 0
+
+
+def rolling_slope(values, window):
+    """
+    Vectorised equivalent of adding each of values to a new RollingSlope,
+    returning its slope after each add.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values):
+        # Slopes don't change when the values are shifted, and this keeps
+        # the cumulative sums small
+        values = values - values.mean()
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - window, 0)
+    n = (ends - starts).astype(np.float64)
+
+    positions = np.arange(len(values), dtype=np.float64)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    weighted = np.concatenate(([0.0], np.cumsum(positions * values)))
+    window_sums = sums[ends] - sums[starts]
+    # Places within the window count from its start
+    window_weighted = weighted[ends] - weighted[starts] - starts * window_sums
+
+    sum_x = n * (n - 1) / 2.0
+    sum_xx = (n - 1) * n * (2 * n - 1) / 6.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slopes = (n * window_weighted - sum_x * window_sums) / (
+            n * sum_xx - sum_x * sum_x)
+    slopes[n < 2] = np.nan
+    return slopes
+
+
+class RollingMinMax(object):
+    """
+    Minimum and maximum of the most recent values in a window, kept with
+    monotonic deques: each value is pushed and popped at most once.
+    """
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError("Window must contain at least one value.")
+        self._window = int(window)
+        self._index = 0
+        # (index, value) pairs, with increasing (decreasing) values
+        self._mins = deque()
+        self._maxes = deque()
+
+    def __len__(self):
+        return min(self._index, self._window)
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def min(self):
+        return self._mins[0][1] if self._mins else float("nan")
+
+    @property
+    def max(self):
+        return self._maxes[0][1] if self._maxes else float("nan")
+
+    def add(self, value):
+        value = float(value)
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((self._index, value))
+        while self._maxes and self._maxes[-1][1] <= value:
+            self._maxes.pop()
+        self._maxes.append((self._index, value))
+
+        oldest = self._index - self._window
+        while self._mins[0][0] <= oldest:
+            self._mins.popleft()
+        while self._maxes[0][0] <= oldest:
+            self._maxes.popleft()
+        self._index += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        # Only the values still in the window matter
+        self._index += max(len(values) - self._window, 0)
+        for value in values[-self._window:]:
+            self.add(value)
+
+
+def rolling_min_max(values, window):
+    """
+    Vectorised equivalent of adding each of values to a new RollingMinMax,
+    returning its minimum and maximum after each add.
+    """
+    series = pd.Series(np.asarray(values, dtype=np.float64))
+    rolling = series.rolling(window, min_periods=1)
+    return rolling.min().values, rolling.max().values
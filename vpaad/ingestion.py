@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+import logging
+import threading
+import time
+import zlib
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from vpaad import metrics
+from vpaad.constants import OVERFLOW_POLICIES
+from vpaad.volume_tracker import add_candle_to_volume_trackers
+
+LOGGER = logging.getLogger(__name__)
+
+_STOP = object()
+
+QUEUE_DEPTH = metrics.gauge(
+    "vpaad_dispatcher_queue_depth",
+    "Candles waiting for a candle dispatcher worker.")
+DROPPED = metrics.counter(
+    "vpaad_dispatcher_dropped_total",
+    "Candles dropped because a candle dispatcher queue was full.")
+
+
+def epic_of(event):
+    sub_type, epic, resolution = event["name"].split(":")
+    return epic
+
+
+def partition(epic, count):
+    """
+    The partition, out of count, that an epic's candles always go to.
+    """
+    return zlib.crc32(epic.encode("utf-8")) % count
+
+
+class CandleDispatcher(object):
+    """
+    Takes completed candle events off the stream listener's thread and adds
+    them to the volume trackers on worker threads, so that slow volume
+    trackers don't hold up reading the stream.
+
+    Each worker has its own bounded queue, and every event for an epic goes
+    to the same worker so that an epic's candles are handled in order. When
+    a queue is full, the overflow policy decides whether to wait for space
+    ("block"), discard the oldest queued event ("drop_oldest") or discard
+    the new one ("drop_newest").
+    """
+    def __init__(
+            self, workers=1, max_queue_size=10000, overflow_policy="block",
+            handler=add_candle_to_volume_trackers):
+        if workers < 1:
+            raise ValueError("At least one worker is needed.")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy: {}".format(overflow_policy))
+
+        self._queues = [Queue(max_queue_size) for _ in range(workers)]
+        self._overflow_policy = overflow_policy
+        self._handler = handler
+        self._volume_trackers = None
+        self._threads = []
+
+        self._metrics_lock = threading.Lock()
+        self._submitted = 0
+        self._processed = 0
+        self._dropped = 0
+        self._failed = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+
+    def start(self, volume_trackers):
+        """
+        Start the workers, which call the handler with the volume trackers
+        and every submitted event.
+        """
+        LOGGER.info(
+            "Starting %d candle dispatcher workers.", len(self._queues))
+        self._volume_trackers = volume_trackers
+        QUEUE_DEPTH.set_function(
+            lambda: sum(queue.qsize() for queue in self._queues))
+        for i, queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(queue,),
+                name="CandleDispatcher-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the workers once they've handled the events already queued.
+        """
+        LOGGER.info("Stopping candle dispatcher workers.")
+        for queue in self._queues:
+            queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, event):
+        """
+        Queue an event if it holds a completed candle. Returns whether it
+        was queued.
+        """
+        if event["values"]["CONS_END"] != u"1":
+            return False
+
+        queue = self._queues[partition(epic_of(event), len(self._queues))]
+        item = (time.time(), event)
+        with self._metrics_lock:
+            self._submitted += 1
+
+        if self._overflow_policy == "block":
+            queue.put(item)
+            return True
+
+        while True:
+            try:
+                queue.put_nowait(item)
+                return True
+            except Full:
+                pass
+
+            if self._overflow_policy == "drop_newest":
+                self._drop(event)
+                return False
+
+            try:
+                _, dropped_event = queue.get_nowait()
+                self._drop(dropped_event)
+            except Empty:
+                pass
+
+    def _drop(self, event):
+        with self._metrics_lock:
+            self._dropped += 1
+        DROPPED.inc()
+        LOGGER.warning(
+            "Candle queue full, dropped candle for %s at %s",
+            event["name"], event["values"].get("UTM"))
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            enqueued_at, event = item
+            lag = time.time() - enqueued_at
+            try:
+                self._handler(self._volume_trackers, event)
+            except Exception:
+                LOGGER.exception(
+                    "Failed to handle candle for %s", event["name"])
+                with self._metrics_lock:
+                    self._failed += 1
+
+            with self._metrics_lock:
+                self._processed += 1
+                self._last_lag = lag
+                self._max_lag = max(self._max_lag, lag)
+
+    def metrics(self, reset_max_lag=False):
+        """
+        Return queue depths, counts of events and how long events waited
+        in the queues (lag, in seconds).
+        """
+        with self._metrics_lock:
+            metrics = {
+                "queue_depths": [queue.qsize() for queue in self._queues],
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "dropped": self._dropped,
+                "failed": self._failed,
+                "last_lag": self._last_lag,
+                "max_lag": self._max_lag,
+            }
+            if reset_max_lag:
+                self._max_lag = 0.0
+        metrics["queue_depth"] = sum(metrics["queue_depths"])
+        return metrics
+
+    def log_metrics(self):
+        metrics = self.metrics(reset_max_lag=True)
+        LOGGER.info(
+            "Candle queue depth: %d %s, processed: %d, dropped: %d, "
+            "failed: %d, lag: %.3fs (max %.3fs)",
+            metrics["queue_depth"], metrics["queue_depths"],
+            metrics["processed"], metrics["dropped"], metrics["failed"],
+            metrics["last_lag"], metrics["max_lag"])
@@ -0,0 +1,392 @@
+# -*- coding:utf-8 -*-
+"""
+Counters, gauges and histograms of what the monitor is doing, cheap enough
+to update for every candle. They are served over HTTP in the Prometheus
+text format, and summarised in the log.
+
+Metrics are created when the module they measure is imported, and kept in
+REGISTRY. Those with labels are updated through labels(...), whose result
+can be kept to skip looking it up again.
+
+Values are updated without locking, which would cost more than the rest of
+an update. An update racing another thread's can be lost, leaving a count
+slightly low, but the GIL makes that rare.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds, from adding a candle to fetching history
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SUMMARY_INTERVAL = 60.0
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{}}}".format(",".join(
+        "{}=\"{}\"".format(name, _escape(value))
+        for name, value in zip(names, values)))
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+
+class _GaugeValue(object):
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Read the value from function whenever it's needed."""
+        self._function = function
+
+
+class _Timer(object):
+    def __init__(self, histogram_value):
+        self._histogram_value = histogram_value
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram_value.observe(time.perf_counter() - self._start)
+
+
+class _HistogramValue(object):
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def observe(self, value):
+        # Buckets hold the values up to and including their bound
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def time(self):
+        """A context manager observing how long its block takes."""
+        return _Timer(self)
+
+    def buckets(self):
+        """The cumulative count of each bucket, by its upper bound."""
+        counts = list(self._counts)
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self._bounds + (float("inf"),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets
+
+    def quantile(self, q):
+        """
+        The upper bound of the bucket holding the q quantile, or None when
+        nothing has been observed.
+        """
+        buckets = self.buckets()
+        total = buckets[-1][1]
+        if not total:
+            return None
+        for bound, cumulative in buckets:
+            if cumulative >= q * total:
+                return bound
+
+
+class _Metric(object):
+    """
+    A metric, with a value for each combination of its labels' values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self._name = name
+        self._documentation = documentation
+        self._label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self._label_names:
+            self._default = self.labels()
+
+    @property
+    def name(self):
+        return self._name
+
+    def _new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        if len(values) != len(self._label_names):
+            raise ValueError("{} has labels: {}".format(
+                self._name, ", ".join(self._label_names)))
+        value = self._values.get(values)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(values, self._new_value())
+        return value
+
+    def remove(self, *values):
+        with self._lock:
+            self._values.pop(values, None)
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _samples(self, label_values, value):
+        """Yield the name suffix, labels and value of each sample."""
+        yield "", (), value.value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self._name, self._documentation),
+            "# TYPE {} {}".format(self._name, self.kind),
+        ]
+        for label_values, value in self._items():
+            for suffix, extra_labels, sample in self._samples(
+                    label_values, value):
+                if sample is None:
+                    continue
+                names = self._label_names + tuple(
+                    name for name, _ in extra_labels)
+                values = label_values + tuple(
+                    value for _, value in extra_labels)
+                lines.append("{}{}{} {}".format(
+                    self._name, suffix, _format_labels(names, values),
+                    _format_value(sample)))
+        return "\n".join(lines)
+
+    def summary(self):
+        """A short description of the values, or None without any."""
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def summary(self):
+        total = sum(value.value for _, value in self._items())
+        return "{}={}".format(self._name, total) if total else None
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def summary(self):
+        values = [value.value for _, value in self._items()]
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        if len(values) == 1:
+            return "{}={:g}".format(self._name, values[0])
+        return "{} max={:g}".format(self._name, max(values))
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self._bounds = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labels)
+
+    def _new_value(self):
+        return _HistogramValue(self._bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _samples(self, label_values, value):
+        for bound, cumulative in value.buckets():
+            yield "_bucket", (("le", _format_value(bound)),), cumulative
+        yield "_sum", (), value.sum
+        yield "_count", (), value.count
+
+    def summary(self):
+        values = [value for _, value in self._items() if value.count]
+        if not values:
+            return None
+        count = sum(value.count for value in values)
+        total = sum(value.sum for value in values)
+        slowest = max(value.quantile(0.99) for value in values)
+        return "{} count={} mean={:.6f} p99<={:g}".format(
+            self._name, count, total / count, slowest)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(
+                    "Metric already registered: {}".format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def render(self):
+        """All of the metrics, in the Prometheus text format."""
+        return "".join(
+            metric.render() + "\n" for metric in self.metrics())
+
+    def summary(self):
+        return [
+            summary for summary in (
+                metric.summary() for metric in self.metrics())
+            if summary is not None]
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=(), registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS,
+              registry=REGISTRY):
+    return registry.register(
+        Histogram(name, documentation, labels, buckets))
+
+
+def log_summary(registry=REGISTRY):
+    summary = registry.summary()
+    if summary:
+        LOGGER.info("Metrics: %s", ", ".join(summary))
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics of a registry on /metrics from a background thread,
+    by default to this machine only.
+    """
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        LOGGER.info("Serving metrics on port %d.", self.port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="MetricsServer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
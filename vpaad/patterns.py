@@ -0,0 +1,175 @@
+# -*- coding:utf-8 -*-
+"""
+Volume Price Analysis patterns, which need the trend and the candles
+before a candle as well as the candle itself:
+
+- SELLING_CLIMAX: a hammer on high volume making a new low in a bearish
+  trend.
+- BUYING_CLIMAX: a shooting star on high volume making a new high in a
+  bullish trend.
+- NO_DEMAND: a narrow spread bullish candle in a bullish trend, on less
+  volume than either of the two candles before it.
+- NO_SUPPLY: a narrow spread bearish candle in a bearish trend, on less
+  volume than either of the two candles before it.
+- BEARISH_DIVERGENCE / BULLISH_DIVERGENCE: a new high (low) made on falling
+  volume, below its average.
+
+Candles are weighed against the window of candles before them. The trend
+is the slope of their closes, against the average candle spread size.
+"""
+from collections import deque
+
+import numpy as np
+
+from vpaad.constants import (
+    CANDLE_TYPE_CODES, PATTERN_CODES, PATTERNS, SHAPE_TYPE_CODES,
+    SPREAD_TYPE_CODES, VOLUME_TYPE_CODES)
+from vpaad.indicators import (
+    EMA, RollingMinMax, RollingSlope, ema, rolling_min_max, rolling_slope)
+
+PATTERN_WINDOW = 20
+# Slope of the closes per candle, as a fraction of the mean spread size,
+# from which there's a trend
+TREND_THRESHOLD = 0.1
+
+_HAMMERS = (SHAPE_TYPE_CODES["STRONG_HAMMER"], SHAPE_TYPE_CODES["WEAK_HAMMER"])
+_SHOOTING_STARS = (
+    SHAPE_TYPE_CODES["STRONG_SHOOTING_STAR"],
+    SHAPE_TYPE_CODES["WEAK_SHOOTING_STAR"])
+
+
+def _pattern_mask(
+        high, low, volume, shape_type, volume_type, spread_weight,
+        spread_type, spread_mean, price_slope, volume_slope, volume_average,
+        lowest, highest, previous_volume, second_previous_volume):
+    """
+    The bit mask of the patterns a candle completes, given the context of
+    the candles before it. Works on scalars and on arrays alike.
+    """
+    bearish = price_slope < -TREND_THRESHOLD * spread_mean
+    bullish = price_slope > TREND_THRESHOLD * spread_mean
+    new_low = low < lowest
+    new_high = high > highest
+    high_volume = volume_type == VOLUME_TYPE_CODES["HIGH_VOLUME"]
+    quiet = (
+        (spread_weight == SPREAD_TYPE_CODES["NARROW_SPREAD"])
+        & (volume < previous_volume) & (volume < second_previous_volume))
+    fading_volume = (volume_slope < 0) & (volume < volume_average)
+
+    hammer = (shape_type == _HAMMERS[0]) | (shape_type == _HAMMERS[1])
+    shooting_star = (
+        (shape_type == _SHOOTING_STARS[0]) |
+        (shape_type == _SHOOTING_STARS[1]))
+
+    patterns = (
+        ("SELLING_CLIMAX", bearish & new_low & high_volume & hammer),
+        ("BUYING_CLIMAX", bullish & new_high & high_volume & shooting_star),
+        ("NO_DEMAND", bullish & quiet & (
+            spread_type == CANDLE_TYPE_CODES["BULLISH"])),
+        ("NO_SUPPLY", bearish & quiet & (
+            spread_type == CANDLE_TYPE_CODES["BEARISH"])),
+        ("BULLISH_DIVERGENCE", new_low & fading_volume),
+        ("BEARISH_DIVERGENCE", new_high & fading_volume),
+    )
+    mask = 0
+    for name, matched in patterns:
+        mask = mask + matched * (1 << PATTERN_CODES[name])
+    return mask
+
+
+def pattern_names(mask):
+    return tuple(
+        name for name in PATTERNS if int(mask) & (1 << PATTERN_CODES[name]))
+
+
+class PatternDetector(object):
+    """
+    Keeps the context of the most recent candles in incremental indicators,
+    and finds the patterns each new candle completes.
+    """
+    def __init__(self, window=PATTERN_WINDOW):
+        self._window = window
+        self._price_slope = RollingSlope(window)
+        self._volume_slope = RollingSlope(window)
+        self._volume_average = EMA(window)
+        self._lows = RollingMinMax(window)
+        self._highs = RollingMinMax(window)
+        self._previous_volumes = deque([float("nan")] * 2, maxlen=2)
+
+    @property
+    def window(self):
+        return self._window
+
+    def update(
+            self, high, low, close, volume, shape_type, volume_type,
+            spread_weight, spread_type, spread_mean):
+        """
+        Return the bit mask of the patterns a candle completes, then add it
+        to the context.
+        """
+        # Numpy scalars would make every comparison several times slower
+        mask = _pattern_mask(
+            float(high), float(low), float(volume), shape_type, volume_type,
+            spread_weight, spread_type, float(spread_mean),
+            self._price_slope.slope,
+            self._volume_slope.slope, self._volume_average.value,
+            self._lows.min, self._highs.max, self._previous_volumes[1],
+            self._previous_volumes[0])
+        self._add(high, low, close, volume)
+        return int(mask)
+
+    def _add(self, high, low, close, volume):
+        self._price_slope.add(close)
+        self._volume_slope.add(volume)
+        self._volume_average.add(volume)
+        self._lows.add(low)
+        self._highs.add(high)
+        self._previous_volumes.append(volume)
+
+    def extend(self, highs, lows, closes, volumes):
+        """
+        Add candles to the context, without looking for patterns.
+        """
+        self._price_slope.extend(closes)
+        self._volume_slope.extend(volumes)
+        self._volume_average.extend(volumes)
+        self._lows.extend(lows)
+        self._highs.extend(highs)
+        for volume in np.asarray(volumes, dtype=np.float64)[-2:]:
+            self._previous_volumes.append(volume)
+
+
+def _previous(values, periods=1):
+    """
+    Shift values later by periods, so that each lines up with the candle
+    after it.
+    """
+    shifted = np.full(len(values), np.nan)
+    if len(values) > periods:
+        shifted[periods:] = values[:-periods]
+    return shifted
+
+
+def detect_patterns(
+        highs, lows, closes, volumes, shape_types, volume_types,
+        spread_weights, spread_types, spread_means,
+        window=PATTERN_WINDOW):
+    """
+    Vectorised equivalent of updating a new PatternDetector with every
+    candle. Returns an array of pattern bit masks.
+    """
+    highs = np.asarray(highs, dtype=np.float64)
+    lows = np.asarray(lows, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    lowest, _ = rolling_min_max(lows, window)
+    _, highest = rolling_min_max(highs, window)
+
+    mask = _pattern_mask(
+        highs, lows, volumes, shape_types, volume_types, spread_weights,
+        spread_types, np.asarray(spread_means, dtype=np.float64),
+        _previous(rolling_slope(closes, window)),
+        _previous(rolling_slope(volumes, window)),
+        _previous(ema(volumes, window)),
+        _previous(lowest), _previous(highest),
+        _previous(volumes), _previous(volumes, 2))
+    return np.broadcast_to(mask, len(volumes)).astype(np.int64)
@@ -0,0 +1,186 @@
+# -*- coding:utf-8 -*-
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from vpaad.synthetic import generate_candles
+from vpaad.times import from_epoch_ms
+from vpaad.volume_tracker import add_candle_to_volume_trackers
+
+LOGGER = logging.getLogger(__name__)
+
+FIVE_MINUTES_MS = 5 * 60 * 1000
+
+
+class CandleRecorder(object):
+    """
+    Appends every stream event it's given to a log file, one JSON object per
+    line, so that the stream can be replayed later.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+        self._count = 0
+
+        LOGGER.info("Recording stream events to: %s", path)
+
+    def record(self, event):
+        line = json.dumps({"name": event["name"], "values": event["values"]})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._count += 1
+
+    @property
+    def count(self):
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        LOGGER.info(
+            "Recorded %d stream events to: %s", self._count, self._path)
+
+
+def read_events(path):
+    """
+    Read the events of a log written by a CandleRecorder.
+    """
+    with open(path, "r") as log_file:
+        for line in log_file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_events(path, events):
+    with open(path, "w") as log_file:
+        for event in events:
+            log_file.write(json.dumps(event) + "\n")
+
+
+def generate_synthetic_events(epics, count, start_utm=None, seed=None):
+    """
+    Generate count completed 5 minute CHART events for each epic, in the
+    same form as the Lightstreamer events, with the candles of
+    synthetic.generate_candles.
+    """
+    if start_utm is None:
+        start_utm = int(time.time() * 1000) - count * FIVE_MINUTES_MS
+    start_utm -= start_utm % FIVE_MINUTES_MS
+    start = from_epoch_ms([start_utm])[0]
+
+    epic_prices = {}
+    for epic, epic_seed in zip(
+            epics, np.random.SeedSequence(seed).spawn(len(epics))):
+        df = generate_candles(count, start, seed=epic_seed)
+        epic_prices[epic] = (
+            df["Open"].values, df["Close"].values, df["High"].values,
+            df["Low"].values, df["Volume"].values)
+
+    for i in range(count):
+        utm = str(start_utm + i * FIVE_MINUTES_MS)
+        for epic in epics:
+            opens, closes, highs, lows, volumes = epic_prices[epic]
+            yield {
+                "name": ":".join(("CHART", epic, "5MINUTE")),
+                "values": {
+                    "BID_OPEN": repr(float(opens[i])),
+                    "BID_CLOSE": repr(float(closes[i])),
+                    "BID_HIGH": repr(float(highs[i])),
+                    "BID_LOW": repr(float(lows[i])),
+                    "CONS_TICK_COUNT": str(int(volumes[i])),
+                    "CONS_END": u"1",
+                    "UTM": utm,
+                },
+            }
+
+
+class ReplayResult(object):
+    """
+    Throughput and latency measured while replaying events.
+    """
+    def __init__(self, event_count, elapsed, latencies, anomalies):
+        self.event_count = event_count
+        self.elapsed = elapsed
+        self.latencies = np.asarray(latencies, dtype=np.float64)
+        self.anomalies = anomalies
+
+    @property
+    def events_per_second(self):
+        return self.event_count / self.elapsed if self.elapsed else 0.0
+
+    def latency_percentile(self, percentile):
+        if not len(self.latencies):
+            return float("nan")
+        return float(np.percentile(self.latencies, percentile))
+
+    def summary(self):
+        lines = [
+            "Events replayed: {}".format(self.event_count),
+            "Elapsed: {:.3f}s".format(self.elapsed),
+            "Events/sec: {:.1f}".format(self.events_per_second),
+        ]
+        if len(self.latencies):
+            lines[1:1] = ["Candles added: {}".format(len(self.latencies))]
+            lines.append(
+                "Latency per candle (us): p50={:.1f} p90={:.1f} p99={:.1f} "
+                "max={:.1f}".format(
+                    self.latency_percentile(50) * 1e6,
+                    self.latency_percentile(90) * 1e6,
+                    self.latency_percentile(99) * 1e6,
+                    self.latency_percentile(100) * 1e6))
+        lines.append("Anomalies: {}".format(len(self.anomalies)))
+        return "\n".join(lines)
+
+
+def replay_events(
+        volume_trackers, events, speed=None, anomalies=None,
+        dispatcher=None):
+    """
+    Feed events through add_candle_to_volume_trackers, the same path as the
+    live stream, or submit them to a dispatcher when one is given. Latencies
+    are only measured without a dispatcher, and the elapsed time includes
+    waiting for the dispatcher to finish.
+
+    Without a speed the events are replayed as fast as possible. Otherwise
+    they are paced by their UTM times, sped up by the given multiplier.
+    anomalies should be the list the trackers' notification callback
+    appends to, so it can be included in the result.
+    """
+    latencies = []
+    event_count = 0
+    first_utm = None
+    start = time.perf_counter()
+    if dispatcher is not None:
+        dispatcher.start(volume_trackers)
+
+    for event in events:
+        if speed:
+            utm = int(float(event["values"]["UTM"]))
+            if first_utm is None:
+                first_utm = utm
+            elapsed = time.perf_counter() - start
+            delay = (utm - first_utm) / 1000.0 / speed - elapsed
+            if delay > 0:
+                time.sleep(delay)
+
+        event_count += 1
+        if dispatcher is not None:
+            dispatcher.submit(event)
+            continue
+        candle_start = time.perf_counter()
+        added = add_candle_to_volume_trackers(volume_trackers, event)
+        if added:
+            latencies.append(time.perf_counter() - candle_start)
+
+    if dispatcher is not None:
+        dispatcher.stop()
+
+    return ReplayResult(
+        event_count, time.perf_counter() - start, latencies,
+        anomalies if anomalies is not None else [])
@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+import json
+import pprint
+
+from vpaad.constants import DATETIME_STR_FORMAT
+
+REPORT_FORMATS = ("text", "json", "compact")
+
+
+class CandleReport(object):
+    """
+    Everything known about a candle once a volume tracker has weighed it.
+
+    Nothing is formatted when a report is created: each consumer renders
+    the representation it needs, when it needs it. Formatting a report with
+    "%s" gives the text representation, so it can be passed to logging
+    calls as an argument and only be formatted if the record is emitted.
+    """
+    __slots__ = (
+        "name", "epic", "resolution", "candle", "relative_data",
+        "volume_stats", "spread_stats", "rules", "patterns",
+    )
+
+    def __init__(
+            self, name, epic, resolution, candle, relative_data,
+            volume_stats, spread_stats, rules=(), patterns=()):
+        self.name = name
+        self.epic = epic
+        self.resolution = resolution
+        self.candle = candle
+        self.relative_data = tuple(relative_data)
+        self.volume_stats = volume_stats
+        self.spread_stats = spread_stats
+        # Names of the anomaly rules the candle matched
+        self.rules = tuple(rules)
+        # Names of the patterns the candle completed
+        self.patterns = tuple(patterns)
+
+    @property
+    def time(self):
+        return self.candle.time.strftime(DATETIME_STR_FORMAT)
+
+    @property
+    def shape_type(self):
+        return self.candle.shape["shape_type"]
+
+    @property
+    def summary(self):
+        return ", ".join((
+            self.name,
+            self.resolution,
+            self.time,
+            self.shape_type,
+            str(self.relative_data)
+        ))
+
+    @property
+    def details(self):
+        return {
+            "time": self.time,
+            "name": self.name,
+            "epic": self.epic,
+            "resolution": self.resolution,
+            "relative_data": self.relative_data,
+            "data": self.candle.data,
+            "overall_volume_stats": self.volume_stats,
+            "overall_spread_stats": self.spread_stats,
+            "shape": self.candle.shape,
+            "rules": list(self.rules),
+            "patterns": list(self.patterns),
+        }
+
+    @property
+    def content(self):
+        """
+        The body of a notification about this anomaly.
+        """
+        return (
+            "VPAAD has detected an anomaly candle in: {}.\n\n"
+            "{}"
+        ).format(self.name, self.to_text())
+
+    def to_text(self):
+        return pprint.pformat(self.details)
+
+    def to_json(self):
+        details = self.details
+        details["overall_volume_stats"] = [
+            float(value) for value in self.volume_stats]
+        details["overall_spread_stats"] = [
+            float(value) for value in self.spread_stats]
+        return json.dumps(details, sort_keys=True)
+
+    def to_compact(self):
+        volume, spread, sentiment = self.relative_data
+        return "{} {} {} {} {} {} {}".format(
+            self.epic, self.resolution, self.time, self.shape_type, volume,
+            spread, sentiment)
+
+    def render(self, report_format="text"):
+        if report_format == "json":
+            return self.to_json()
+        elif report_format == "compact":
+            return self.to_compact()
+        elif report_format == "text":
+            return self.to_text()
+        raise ValueError("Unknown report format: {}".format(report_format))
+
+    def __str__(self):
+        return self.to_text()
@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+import math
+
+import numpy as np
+
+
+class RollingStats(object):
+    """
+    Mean and (population) standard deviation over a fixed-size window of
+    the most recent values.
+
+    Values are kept in a preallocated ring buffer and the statistics are
+    updated incrementally (Welford's algorithm, extended to remove the value
+    that drops out of the window), so each update is O(1) regardless of the
+    window size and allocates nothing.
+    """
+    # Rounding errors slowly accumulate in the running sums, so they are
+    # recalculated from the buffer every so often.
+    RESYNC_INTERVAL = 100000
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError("Window must contain at least one value.")
+        self._window = int(window)
+        self._buffer = np.zeros(self._window, dtype=np.float64)
+        self._next = 0
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._updates_since_resync = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def mean(self):
+        return self._mean if self._count else float("nan")
+
+    @property
+    def variance(self):
+        if not self._count:
+            return float("nan")
+        return max(self._m2, 0.0) / self._count
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def stats(self):
+        return (self.mean, self.std)
+
+    def add(self, value):
+        """Add a value, evicting the oldest one if the window is full."""
+        value = float(value)
+        if self._count < self._window:
+            self._count += 1
+            delta = value - self._mean
+            self._mean += delta / self._count
+            self._m2 += delta * (value - self._mean)
+        else:
+            old_value = self._buffer[self._next]
+            old_mean = self._mean
+            self._mean += (value - old_value) / self._count
+            self._m2 += (value - old_value) * (
+                value - self._mean + old_value - old_mean)
+
+        self._buffer[self._next] = value
+        self._next += 1
+        if self._next == self._window:
+            self._next = 0
+
+        self._updates_since_resync += 1
+        if self._updates_since_resync >= self.RESYNC_INTERVAL:
+            self._resync()
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) < self._window:
+            for value in values:
+                self.add(value)
+            return
+
+        # Everything currently in the window gets replaced
+        self._buffer[:] = values[-self._window:]
+        self._next = 0
+        self._count = self._window
+        self._resync()
+
+    def values(self):
+        """Return a copy of the values in the window, oldest first."""
+        if self._count < self._window:
+            return self._buffer[:self._count].copy()
+        return np.concatenate(
+            (self._buffer[self._next:], self._buffer[:self._next]))
+
+    def _resync(self):
+        values = self._buffer[:self._count]
+        self._mean = float(np.mean(values))
+        self._m2 = float(np.sum((values - self._mean) ** 2))
+        self._updates_since_resync = 0
+
+
+def rolling_mean_std(values, window, history=()):
+    """
+    Vectorised equivalent of adding each of values to a RollingStats that
+    already holds history (oldest first), returning the mean and standard
+    deviation arrays seen after each add.
+    """
+    history = np.asarray(history, dtype=np.float64)[-window:]
+    combined = np.concatenate(
+        (history, np.asarray(values, dtype=np.float64)))
+    if not len(combined):
+        return np.empty(0), np.empty(0)
+
+    # Shift the data to keep the cumulative sums small
+    shifted = combined - combined.mean()
+    sums = np.concatenate(([0.0], np.cumsum(shifted)))
+    squares = np.concatenate(([0.0], np.cumsum(shifted * shifted)))
+
+    ends = np.arange(len(history) + 1, len(combined) + 1)
+    starts = np.maximum(ends - window, 0)
+    counts = ends - starts
+    window_sums = sums[ends] - sums[starts]
+    window_squares = squares[ends] - squares[starts]
+
+    shifted_mean = window_sums / counts
+    variance = np.maximum(
+        window_squares / counts - shifted_mean * shifted_mean, 0.0)
+    return shifted_mean + combined.mean(), np.sqrt(variance)
@@ -0,0 +1,284 @@
+# -*- coding:utf-8 -*-
+"""
+Anomaly rules, written in the config as expressions such as:
+
+    shape in {STRONG_HAMMER, STRONG_SHOOTING_STAR} AND volume_z > 1.5
+    AND NOT spread == NARROW
+
+Categorical features (shape, volume, spread and type) are compared with ==,
+!=, in and not in against the names of their categories, or the names
+without their _VOLUME or _SPREAD suffix. Numeric features (volume_z,
+spread_z, upper_wick and lower_wick) are compared with numbers. The
+patterns a candle completes, of vpaad.patterns, are checked with in and not
+in. Comparisons are combined with AND, OR, NOT and brackets.
+
+Rules are compiled once into a Python function of a candle's features, with
+categories replaced by their integer codes, so no strings are compared when
+evaluating them. The same function works on arrays of features, to
+evaluate rules over many candles at once.
+"""
+import re
+
+import numpy as np
+
+from vpaad.constants import (
+    CANDLE_TYPES, PATTERNS, SHAPE_TYPES, SPREAD_TYPES, VOLUME_TYPES)
+
+# Categorical features and their categories, numeric features, then
+# features holding a bit mask of categories, in the order they are given to
+# compiled rules
+CATEGORICAL_FEATURES = (
+    ("shape", SHAPE_TYPES),
+    ("volume", VOLUME_TYPES),
+    ("spread", SPREAD_TYPES),
+    ("type", CANDLE_TYPES),
+)
+NUMERIC_FEATURES = ("volume_z", "spread_z", "upper_wick", "lower_wick")
+SET_FEATURES = (
+    ("patterns", PATTERNS),
+)
+FEATURES = (
+    tuple(name for name, _ in CATEGORICAL_FEATURES) + NUMERIC_FEATURES +
+    tuple(name for name, _ in SET_FEATURES))
+FEATURE_INDICES = {name: index for index, name in enumerate(FEATURES)}
+CATEGORIES = dict(CATEGORICAL_FEATURES + SET_FEATURES)
+SETS = dict(SET_FEATURES)
+
+DEFAULT_RULES = {
+    "notable_shape_high_volume": (
+        "shape in {STRONG_HAMMER, STRONG_SHOOTING_STAR} "
+        "AND volume == HIGH_VOLUME"),
+}
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<number>-?(?:\d+\.?\d*|\.\d+))
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<symbol>==|!=|>=|<=|>|<|\{|\}|\(|\)|,)
+    )""", re.VERBOSE)
+_KEYWORDS = ("AND", "OR", "NOT", "IN")
+_NUMERIC_OPERATORS = ("==", "!=", ">", ">=", "<", "<=")
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_RE.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError("Unexpected character in rule at {}: {}".format(
+                position, expression))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.upper() in _KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def _category_code(feature, name):
+    categories = CATEGORIES[feature]
+    matches = [
+        code for code, category in enumerate(categories)
+        if category == name or category.startswith(name + "_")]
+    if len(matches) != 1:
+        raise ValueError("Unknown {} category: {}. Expected one of: {}".format(
+            feature, name, ", ".join(categories)))
+    return matches[0]
+
+
+class _Parser(object):
+    """
+    Recursive descent parser turning a rule into the source of a Python
+    expression of the feature sequence f.
+    """
+    def __init__(self, expression):
+        self._expression = expression
+        self._tokens = _tokenize(expression)
+        self._position = 0
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def _expect(self, kind, value=None):
+        token_kind, token_value = self._next()
+        if token_kind != kind or (value is not None and token_value != value):
+            raise ValueError("Expected {} in rule, got {}: {}".format(
+                value or kind, token_value, self._expression))
+        return token_value
+
+    def parse(self):
+        source = self._or()
+        if self._peek() != (None, None):
+            raise ValueError("Unexpected {} in rule: {}".format(
+                self._peek()[1], self._expression))
+        return source
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == ("keyword", "OR"):
+            self._next()
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else "({})".format(
+            " | ".join(terms))
+
+    def _and(self):
+        factors = [self._not()]
+        while self._peek() == ("keyword", "AND"):
+            self._next()
+            factors.append(self._not())
+        return factors[0] if len(factors) == 1 else "({})".format(
+            " & ".join(factors))
+
+    def _not(self):
+        if self._peek() == ("keyword", "NOT"):
+            self._next()
+            # Unlike not, this also negates arrays
+            return "({} ^ True)".format(self._not())
+        if self._peek() == ("symbol", "("):
+            self._next()
+            source = self._or()
+            self._expect("symbol", ")")
+            return source
+        return self._comparison()
+
+    def _comparison(self):
+        feature = self._expect("name")
+        if feature not in FEATURE_INDICES:
+            raise ValueError("Unknown feature {} in rule: {}".format(
+                feature, self._expression))
+        index = FEATURE_INDICES[feature]
+
+        kind, operator = self._next()
+        negated = False
+        if (kind, operator) == ("keyword", "NOT"):
+            self._expect("keyword", "IN")
+            kind, operator, negated = "keyword", "IN", True
+
+        if feature in CATEGORIES:
+            if (kind, operator) == ("keyword", "IN"):
+                mask = 0
+                self._expect("symbol", "{")
+                while True:
+                    mask |= 1 << _category_code(
+                        feature, self._expect("name"))
+                    if self._next() == ("symbol", "}"):
+                        break
+                    self._position -= 1
+                    self._expect("symbol", ",")
+                # Set features already hold a mask
+                value = "f[{}]".format(index)
+                if feature not in SETS:
+                    value = "(1 << {})".format(value)
+                return "(({} & {}) {} 0)".format(
+                    value, mask, "==" if negated else "!=")
+            if (feature not in SETS and
+                    (kind, operator) in (("symbol", "=="), ("symbol", "!="))):
+                code = _category_code(feature, self._expect("name"))
+                return "(f[{}] {} {})".format(index, operator, code)
+        elif kind == "symbol" and operator in _NUMERIC_OPERATORS:
+            value = float(self._expect("number"))
+            return "(f[{}] {} {!r})".format(index, operator, value)
+
+        raise ValueError("Cannot compare {} with {} in rule: {}".format(
+            feature, operator, self._expression))
+
+
+class RuleSet(object):
+    """
+    Named rules, compiled into one function returning whether each of them
+    matches.
+    """
+    def __init__(self, rules):
+        self._names = tuple(sorted(rules))
+        self._expressions = dict(rules)
+        if not self._names:
+            self._evaluate = lambda f: ()
+            return
+
+        sources = [_Parser(rules[name]).parse() for name in self._names]
+        self._evaluate = eval(compile(
+            "lambda f: ({},)".format(", ".join(sources)),
+            "<rules>", "eval"), {"__builtins__": {}})
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def expressions(self):
+        return dict(self._expressions)
+
+    def matches(self, features):
+        """
+        Return the names of the rules matched by a candle's features, given
+        in the order of FEATURES.
+        """
+        return tuple(
+            name for name, matched in zip(
+                self._names, self._evaluate(features))
+            if matched)
+
+    def match_arrays(self, features):
+        """
+        Evaluate the rules over arrays of features, one array per feature in
+        the order of FEATURES. Returns a boolean array per rule.
+        """
+        results = self._evaluate(features)
+        length = len(features[0])
+        return [
+            np.broadcast_to(np.asarray(result, dtype=bool), (length,))
+            for result in results]
+
+    def any_arrays(self, features):
+        """
+        Return which candles, of arrays of features, match any rule.
+        """
+        results = self.match_arrays(features)
+        if not results:
+            return np.zeros(len(features[0]), dtype=bool)
+        return np.logical_or.reduce(results)
+
+
+def z_score(value, mean, std):
+    """
+    How many standard deviations a value is from the mean. A value above
+    (below) a mean with no deviation is infinitely far above (below) it.
+    """
+    if std:
+        return (value - mean) / std
+    if value == mean:
+        return 0.0
+    return float("inf") if value > mean else float("-inf")
+
+
+def z_scores(values, means, stds):
+    """
+    Vectorised equivalent of z_score.
+    """
+    differences = np.asarray(values, dtype=np.float64) - means
+    stds = np.broadcast_to(stds, differences.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = differences / stds
+    # 0 / 0
+    z[np.isnan(z)] = 0.0
+    return z
+
+
+def market_rules(config_rules, market):
+    """
+    The rules for a market: those of the config, overridden by name by the
+    market's own. A rule overridden with null is dropped.
+    """
+    rules = dict(DEFAULT_RULES if config_rules is None else config_rules)
+    rules.update(market.get("rules", {}))
+    return {name: rule for name, rule in rules.items() if rule is not None}
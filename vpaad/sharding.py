@@ -0,0 +1,248 @@
+# -*- coding:utf-8 -*-
+import logging
+import multiprocessing
+import signal
+import threading
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+
+from vpaad.candle import CandleAggregator
+from vpaad.ingestion import epic_of, partition
+from vpaad.rules import RuleSet
+from vpaad.volume_tracker import VolumeTracker, add_candle_to_volume_trackers
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait for room in a shard's queue before checking that the
+# shard is still alive
+SUBMIT_TIMEOUT = 1.0
+
+
+def partition_volume_trackers(volume_trackers, shards):
+    """
+    Split volume trackers, by epic, into one dict per shard.
+    """
+    partitions = [{} for _ in range(shards)]
+    for epic, vts in volume_trackers.items():
+        partitions[partition(epic, shards)][epic] = vts
+    return partitions
+
+
+def describe_volume_trackers(volume_trackers):
+    """
+    Describe volume trackers, by epic, in a form that can be pickled: the
+    details of each and the state it has reached. Each epic's trackers
+    must share an aggregator, as create_volume_trackers makes them.
+    """
+    descriptions = {}
+    for epic, vts in volume_trackers.items():
+        if not vts:
+            continue
+        aggregator = vts[0].aggregator
+        with aggregator.lock:
+            descriptions[epic] = {
+                "aggregator": aggregator.state(),
+                "trackers": [
+                    {
+                        "name": vt.name,
+                        "resolution": vt.resolution,
+                        "pre_calculate": vt.pre_calculate,
+                        "window": vt.window,
+                        "rules": vt.rules.expressions,
+                        "state": vt.state(),
+                    }
+                    for vt in vts
+                ],
+            }
+    return descriptions
+
+
+def build_volume_trackers(descriptions, notification_callbacks=()):
+    """
+    Build volume trackers that carry on from those described by
+    describe_volume_trackers.
+    """
+    volume_trackers = {}
+    for epic, description in descriptions.items():
+        aggregator = CandleAggregator(epic)
+        vts = []
+        for tracker in description["trackers"]:
+            vt = VolumeTracker(
+                tracker["name"], epic, tracker["resolution"], None, None,
+                notification_callbacks=notification_callbacks,
+                pre_calculate=tracker["pre_calculate"],
+                window=tracker["window"], rules=RuleSet(tracker["rules"]),
+                aggregator=aggregator)
+            if len(tracker["state"]["time"]):
+                vt.restore(tracker["state"])
+            vts.append(vt)
+        aggregator.restore(description["aggregator"])
+        volume_trackers[epic] = vts
+    return volume_trackers
+
+
+def _run_shard(descriptions, events, reports):
+    """
+    The body of a shard's process: build its volume trackers, add the
+    candles it's sent to them, and send back the reports of anomalies.
+    """
+    # The parent process decides when to stop, once the queue is drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    volume_trackers = build_volume_trackers(descriptions, (reports.put,))
+
+    while True:
+        item = events.get()
+        if item is None:
+            break
+        name, values = item
+        add_candle_to_volume_trackers(
+            volume_trackers, {"name": name, "values": values})
+
+
+class ShardedDispatcher(object):
+    """
+    Adds candles to volume trackers in several processes, to get past the
+    GIL when tracking many markets.
+
+    The volume trackers are initiated in the parent process, then each
+    shard's process is started with a description of its own share of
+    them, by epic, to rebuild them from. Shards are spawned rather than
+    forked, as the parent has threads by then whose locks a fork could copy
+    while held. Every completed candle is sent to the shard that owns its
+    epic over a queue, so an epic's candles are handled in order. Reports
+    of anomalies are sent back over a single queue and passed to the
+    notification callbacks of the parent's volume trackers.
+
+    When a shard's queue is full, submit blocks until there's room. The
+    candles of a shard that has died are logged and dropped instead.
+    """
+    def __init__(self, shards, max_queue_size=10000):
+        if shards < 1:
+            raise ValueError("At least one shard is needed.")
+        self._context = multiprocessing.get_context("spawn")
+        self._shards = shards
+        self._max_queue_size = max_queue_size
+
+        self._volume_trackers = None
+        self._queues = []
+        self._processes = []
+        self._reports = None
+        self._notifier_thread = None
+
+        self._submitted = [0] * shards
+        self._dropped = [0] * shards
+        self._anomalies = 0
+
+    def start(self, volume_trackers):
+        LOGGER.info("Starting %d volume tracker shards.", self._shards)
+        self._volume_trackers = volume_trackers
+        self._reports = self._context.Queue()
+        partitions = partition_volume_trackers(volume_trackers, self._shards)
+        for i, shard_volume_trackers in enumerate(partitions):
+            events = self._context.Queue(self._max_queue_size)
+            process = self._context.Process(
+                target=_run_shard,
+                args=(
+                    describe_volume_trackers(shard_volume_trackers), events,
+                    self._reports),
+                name="VolumeTrackerShard-{}".format(i))
+            process.daemon = True
+            process.start()
+            self._queues.append(events)
+            self._processes.append(process)
+            LOGGER.info(
+                "Shard %d (pid %d) tracks: %s",
+                i, process.pid, sorted(shard_volume_trackers))
+
+        self._notifier_thread = threading.Thread(
+            target=self._notify, name="ShardNotifier")
+        self._notifier_thread.daemon = True
+        self._notifier_thread.start()
+
+    def stop(self):
+        """
+        Stop the shards once they've handled the candles already sent, and
+        the notifier once it's passed on their reports.
+        """
+        LOGGER.info("Stopping volume tracker shards.")
+        for events, process in zip(self._queues, self._processes):
+            if process.is_alive():
+                events.put(None)
+        for process in self._processes:
+            process.join()
+        if self._notifier_thread is not None:
+            self._reports.put(None)
+            self._notifier_thread.join()
+            self._notifier_thread = None
+        self._queues = []
+        self._processes = []
+
+    def submit(self, event):
+        """
+        Send an event to its shard if it holds a completed candle. Returns
+        whether it was sent.
+        """
+        values = event["values"]
+        if values["CONS_END"] != u"1":
+            return False
+
+        shard = partition(epic_of(event), self._shards)
+        process = self._processes[shard]
+        while process.is_alive():
+            try:
+                self._queues[shard].put(
+                    (event["name"], values), timeout=SUBMIT_TIMEOUT)
+            except Full:
+                continue
+            self._submitted[shard] += 1
+            return True
+
+        if not self._dropped[shard]:
+            LOGGER.error(
+                "Shard %d (pid %s) has died with exit code %s, dropping "
+                "the candles of its epics.",
+                shard, process.pid, process.exitcode)
+        self._dropped[shard] += 1
+        return False
+
+    def _notify(self):
+        while True:
+            report = self._reports.get()
+            if report is None:
+                return
+            self._anomalies += 1
+            for vt in self._volume_trackers[report.epic]:
+                if vt.resolution != report.resolution:
+                    continue
+                for cb in vt.notification_callbacks:
+                    try:
+                        cb(report)
+                    except Exception:
+                        LOGGER.exception(
+                            "Failed to notify about: %s", report.summary)
+
+    def _queue_depths(self):
+        try:
+            return [events.qsize() for events in self._queues]
+        except NotImplementedError:
+            # Not available on macOS
+            return []
+
+    def metrics(self):
+        return {
+            "queue_depths": self._queue_depths(),
+            "submitted": list(self._submitted),
+            "dropped": list(self._dropped),
+            "anomalies": self._anomalies,
+            "alive": [process.is_alive() for process in self._processes],
+        }
+
+    def log_metrics(self):
+        metrics = self.metrics()
+        LOGGER.info(
+            "Candles sent to shards: %s, dropped: %s, shard queue depths: "
+            "%s, anomalies: %d, shards alive: %s",
+            metrics["submitted"], metrics["dropped"], metrics["queue_depths"],
+            metrics["anomalies"], metrics["alive"])
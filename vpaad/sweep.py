@@ -0,0 +1,189 @@
+# -*- coding:utf-8 -*-
+import itertools
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from vpaad.backtest import candles_at_resolutions
+from vpaad.candle import calculate_wicks, classify_shapes
+from vpaad.constants import (
+    SHAPE_TYPE_CODES, SWEEP_LONG_WICK_PERCENTAGES, SWEEP_NUMBERS_OF_STDS,
+    SWEEP_SHORT_WICK_PERCENTAGES, SWEEP_SORT_COLUMNS,
+    SWEEP_STRONG_WICK_PERCENTAGES, SWEEP_WINDOWS)
+from vpaad.rolling_stats import rolling_mean_std
+
+LOGGER = logging.getLogger(__name__)
+
+# Candles after an anomaly at which to check whether the price reversed
+HORIZON = 3
+
+PARAMETERS = (
+    "Window", "NumberOfStds", "StrongWick", "LongWick", "ShortWick")
+
+# Precomputed data, set in each worker process of the pool
+_SWEEP_DATA = None
+
+
+class SweepData(object):
+    """
+    The parts of the anomaly rule that don't depend on every parameter,
+    computed once per series of candles (an epic at a resolution) and
+    shared by all parameter combinations: the shapes for each combination
+    of wick thresholds, the volume stats for each window and how the price
+    moved after each candle.
+    """
+    def __init__(
+            self, series, windows, wick_grid, horizon=HORIZON, warm_up=None):
+        self.keys = []
+        self.volumes = []
+        self.moves = []
+        self.shapes = {wicks: [] for wicks in wick_grid}
+        self.volume_stats = {window: [] for window in windows}
+        # Candles are only counted once every window is full, so that all
+        # parameter combinations see the same candles
+        self.warm_up = max(windows) if warm_up is None else warm_up
+
+        for key, candles in series:
+            times, opens, highs, lows, closes, volumes = candles
+            self.keys.append(key)
+            self.volumes.append(volumes)
+
+            _, _, upper, lower = calculate_wicks(opens, highs, lows, closes)
+            for wicks in wick_grid:
+                strong, long_, short = wicks
+                self.shapes[wicks].append(classify_shapes(
+                    upper, lower, strong_wick_percentage=strong,
+                    long_wick_percentage=long_, short_wick_percentage=short))
+
+            for window in windows:
+                self.volume_stats[window].append(
+                    rolling_mean_std(volumes, window))
+
+            moves = np.full(len(closes), np.nan)
+            if len(closes) > horizon:
+                moves[:-horizon] = closes[horizon:] - closes[:-horizon]
+            self.moves.append(moves)
+
+    def counts(self, window, number_of_stds, wicks):
+        """
+        Return (candles, hits, reversals) for each series. Hammers are
+        expected to be followed by a rise, shooting stars by a fall.
+        """
+        counts = []
+        for i in range(len(self.keys)):
+            means, stds = self.volume_stats[window][i]
+            high_volume = self.volumes[i] > means + number_of_stds * stds
+            high_volume[:self.warm_up] = False
+
+            shapes = self.shapes[wicks][i]
+            hammers = high_volume & (
+                shapes == SHAPE_TYPE_CODES["STRONG_HAMMER"])
+            stars = high_volume & (
+                shapes == SHAPE_TYPE_CODES["STRONG_SHOOTING_STAR"])
+            moves = self.moves[i]
+            counts.append((
+                max(len(shapes) - self.warm_up, 0),
+                int(np.count_nonzero(hammers | stars)),
+                int(np.count_nonzero(moves[hammers] > 0) +
+                    np.count_nonzero(moves[stars] < 0)),
+            ))
+        return counts
+
+
+def _set_sweep_data(sweep_data):
+    global _SWEEP_DATA
+    _SWEEP_DATA = sweep_data
+
+
+def _evaluate(window, number_of_stds, wick_grid):
+    """
+    Count the hits of every combination of wick thresholds for a window and
+    number of standard deviations, as rows of the sweep table.
+    """
+    rows = []
+    for wicks in wick_grid:
+        series_counts = _SWEEP_DATA.counts(window, number_of_stds, wicks)
+        for key, (candles, hits, reversals) in zip(
+                _SWEEP_DATA.keys, series_counts):
+            epic, resolution = key
+            rows.append(
+                (epic, resolution, window, number_of_stds) + tuple(wicks) +
+                (candles, hits, reversals))
+    return rows
+
+
+def run_sweep(
+        histories, resolutions, base_resolution="5MINUTE",
+        windows=SWEEP_WINDOWS, numbers_of_stds=SWEEP_NUMBERS_OF_STDS,
+        strong_wick_percentages=SWEEP_STRONG_WICK_PERCENTAGES,
+        long_wick_percentages=SWEEP_LONG_WICK_PERCENTAGES,
+        short_wick_percentages=SWEEP_SHORT_WICK_PERCENTAGES,
+        horizon=HORIZON, workers=1, per_epic=False, sort_by="Hits"):
+    """
+    Count the anomalies found in the histories, a dict of DataFrames by
+    epic, with every combination of the parameters. Combinations are
+    shared out over a pool of worker processes.
+
+    Returns a DataFrame with a row per combination (and epic, when
+    per_epic is set) ranked by sort_by, along with the number of candles
+    looked at, hits per thousand candles and the rate of hits followed by a
+    reversal of the price within horizon candles.
+    """
+    if sort_by not in SWEEP_SORT_COLUMNS:
+        raise ValueError("Cannot sort by: {}".format(sort_by))
+    start = time.perf_counter()
+
+    series = [
+        ((epic, resolution), candles)
+        for epic, df in sorted(histories.items())
+        for resolution, candles in candles_at_resolutions(
+            df, resolutions, base_resolution)
+    ]
+    wick_grid = list(itertools.product(
+        strong_wick_percentages, long_wick_percentages,
+        short_wick_percentages))
+    sweep_data = SweepData(series, windows, wick_grid, horizon)
+    LOGGER.info(
+        "Precomputed %d series in %.3fs", len(series),
+        time.perf_counter() - start)
+
+    tasks = list(itertools.product(windows, numbers_of_stds))
+    rows = []
+    if workers > 1 and len(tasks) > 1:
+        # Workers are spawned, as forking a process with threads isn't
+        # safe, and are each sent the precomputed data once
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_set_sweep_data,
+                initargs=(sweep_data,)) as executor:
+            futures = [
+                executor.submit(_evaluate, window, stds, wick_grid)
+                for window, stds in tasks]
+            for future in futures:
+                rows.extend(future.result())
+    else:
+        _set_sweep_data(sweep_data)
+        for window, stds in tasks:
+            rows.extend(_evaluate(window, stds, wick_grid))
+    LOGGER.info(
+        "Swept %d combinations in %.3fs", len(tasks) * len(wick_grid),
+        time.perf_counter() - start)
+
+    table = pd.DataFrame(rows, columns=(
+        ("Epic", "Resolution") + PARAMETERS +
+        ("Candles", "Hits", "Reversals")))
+    group_by = (["Epic"] if per_epic else []) + list(PARAMETERS)
+    table = table.groupby(group_by, as_index=False)[
+        ["Candles", "Hits", "Reversals"]].sum()
+    table["HitsPer1000"] = 1000.0 * table["Hits"] / table["Candles"].clip(
+        lower=1)
+    table["ReversalRate"] = table["Reversals"] / table["Hits"].clip(lower=1)
+    return table.sort_values(
+        (["Epic"] if per_epic else []) + [sort_by],
+        ascending=[True] * per_epic + [False],
+        kind="stable").reset_index(drop=True)
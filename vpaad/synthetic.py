@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+"""
+Synthetic candles, for when there is no real history: backfilling volume
+trackers without a connection to ig.com, and load tests.
+
+Prices follow a random walk, with each candle opening where the last one
+closed. Candle spread sizes and volumes are lognormal, so heavy tailed, and
+both follow an intraday cycle peaking in the afternoon. Wicks are
+exponential, so hammers and shooting stars turn up now and then.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+PRICE = 1000.0
+VOLUME_MEAN = 100.0
+VOLUME_STD = 50.0
+SPREAD_MEAN = 1.0
+SPREAD_STD = 0.8
+# Mean wick length, relative to the mean spread size
+WICK_RATIO = 0.5
+# How much busier the busiest time of day is than average
+SEASONALITY = 0.3
+SEASONALITY_PEAK = datetime.timedelta(hours=14, minutes=30)
+# Smallest mean volume and spread size generated, as lognormal values need a
+# positive mean
+MIN_MEAN = 0.01
+
+_DAY_NS = 24 * 3600 * 10 ** 9
+
+
+def intraday_seasonality(index, amplitude=SEASONALITY,
+                         peak=SEASONALITY_PEAK):
+    """
+    Activity through the day, at each time of a DatetimeIndex, averaging one
+    over a whole day.
+    """
+    nanoseconds = index.values.astype("datetime64[ns]").astype(
+        np.int64) % _DAY_NS
+    phase = 2 * np.pi * (nanoseconds - peak.total_seconds() * 1e9) / _DAY_NS
+    return 1.0 + amplitude * np.cos(phase)
+
+
+def _heavy_tailed(rng, mean, std, seasonality):
+    """
+    Lognormal values scaled by the seasonality, with the given mean and
+    standard deviation overall.
+    """
+    if mean <= 0 or std < 0:
+        raise ValueError(
+            "Mean must be positive and standard deviation not negative.")
+    seasonality = seasonality / seasonality.mean()
+    # The seasonality spreads the values out too, so the noise spreads
+    # them less
+    noise_variance = max(
+        (std ** 2 + mean ** 2) / np.mean(seasonality ** 2) - mean ** 2, 0.0)
+    sigma_squared = np.log1p(noise_variance / mean ** 2)
+    return seasonality * rng.lognormal(
+        np.log(mean) - sigma_squared / 2, np.sqrt(sigma_squared),
+        len(seasonality))
+
+
+def generate_candles(
+        count, start, timedelta=datetime.timedelta(minutes=5), price=PRICE,
+        volume_mean=VOLUME_MEAN, volume_std=VOLUME_STD,
+        spread_mean=SPREAD_MEAN, spread_std=SPREAD_STD,
+        wick_ratio=WICK_RATIO, seasonality=SEASONALITY, seed=None):
+    """
+    Generate count candles, every timedelta from start. Volumes and candle
+    spread sizes have about the given means and standard deviations, with
+    means of no less than MIN_MEAN. Prices start at price, and are lifted if
+    the walk would take them to zero.
+
+    Returns a DataFrame with Open, High, Low, Close and Volume columns and a
+    DatetimeIndex.
+    """
+    volume_mean = max(volume_mean, MIN_MEAN)
+    spread_mean = max(spread_mean, MIN_MEAN)
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(
+        start, periods=count, freq=pd.Timedelta(timedelta), name="Time")
+
+    activity = intraday_seasonality(index)
+    # Too strong a cycle would spread the values out more than asked for
+    cycle_variance = np.var(activity / activity.mean())
+    smallest_variance = min(
+        (volume_std / volume_mean) ** 2, (spread_std / spread_mean) ** 2)
+    if cycle_variance > smallest_variance / 2:
+        activity = intraday_seasonality(
+            index, seasonality * np.sqrt(
+                smallest_variance / 2 / cycle_variance))
+
+    volumes = np.round(_heavy_tailed(rng, volume_mean, volume_std, activity))
+    spread_sizes = _heavy_tailed(rng, spread_mean, spread_std, activity)
+    spreads = np.where(rng.random(count) < 0.5, -spread_sizes, spread_sizes)
+
+    closes = price + np.cumsum(spreads)
+    opens = np.concatenate(([price], closes[:-1]))
+    wick_scale = wick_ratio * spread_mean * activity
+    highs = np.maximum(opens, closes) + rng.exponential(wick_scale)
+    lows = np.minimum(opens, closes) - rng.exponential(wick_scale)
+
+    if count and lows.min() <= 0:
+        lift = spread_mean - lows.min()
+        opens += lift
+        highs += lift
+        lows += lift
+        closes += lift
+
+    return pd.DataFrame({
+        "Open": opens,
+        "High": highs,
+        "Low": lows,
+        "Close": closes,
+        "Volume": volumes,
+    }, index=index)
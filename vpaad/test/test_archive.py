@@ -0,0 +1,76 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from vpaad.archive import (
+    ArchiveHistoricalDataFetcher, ArchiveWriter, CandleArchive,
+    RECORD_DTYPE)
+from vpaad.backtest import read_histories
+from vpaad.replay import generate_synthetic_events
+from vpaad.synthetic import generate_candles
+from vpaad.times import to_epoch_ms
+
+START = datetime.datetime(2020, 1, 6)
+
+
+def test_archive_maps_time_ranges(tmpdir):
+    df = generate_candles(1000, START, seed=0)
+    archive = CandleArchive(str(tmpdir))
+    assert archive.append_frame("EPIC", "5MINUTE", df.iloc[:600]) == 600
+    # Candles already archived are skipped
+    assert archive.append_frame("EPIC", "5MINUTE", df.iloc[500:]) == 400
+
+    start = START + datetime.timedelta(hours=10, minutes=2)
+    end = START + datetime.timedelta(hours=20)
+    records = archive.range("EPIC", "5MINUTE", start, end)
+    assert isinstance(records.base, np.memmap)
+    expected = df[(df.index >= start) & (df.index < end)]
+    assert len(records) == len(expected) == 119
+    np.testing.assert_array_equal(records["time"], to_epoch_ms(expected.index))
+    np.testing.assert_array_equal(records["close"], expected["Close"])
+
+    pd.testing.assert_frame_equal(
+        archive.frame("EPIC", "5MINUTE"), df, check_freq=False,
+        check_index_type=False, check_names=False)
+    assert archive.keys() == [("EPIC", "5MINUTE")]
+    assert len(CandleArchive(str(tmpdir)).series("EPIC", "5MINUTE")) == 1000
+
+
+def test_archive_appends_stream_events_and_recovers(tmpdir):
+    archive = CandleArchive(str(tmpdir))
+    events = list(generate_synthetic_events(
+        ["A", "B"], 10, start_utm=to_epoch_ms(START)))
+    events[2]["values"]["CONS_END"] = u"0"
+    writer = ArchiveWriter(archive)
+    writer.start()
+    for event in events:
+        writer.submit(event)
+    writer.stop()
+
+    assert len(archive.series("A", "5MINUTE")) == 9
+    assert archive.series("A", "5MINUTE").last_time == (
+        CandleArchive(str(tmpdir)).series("A", "5MINUTE").last_time)
+    fetcher = ArchiveHistoricalDataFetcher(archive)
+    df = fetcher.fetch(
+        "B", "5Min", START, START + datetime.timedelta(minutes=20))
+    assert len(df) == 5
+    assert (df["AbsSpread"] == (df["Open"] - df["Close"]).abs()).all()
+
+    # A crash mid-append leaves part of a record without its time
+    path = os.path.join(str(tmpdir), "A_5MINUTE.candles")
+    with open(path, "ab") as record_file:
+        record_file.write(b"\0" * (RECORD_DTYPE.itemsize // 2))
+    series = CandleArchive(str(tmpdir)).series("A", "5MINUTE")
+    assert len(series) == 9
+    assert os.path.getsize(path) == 9 * RECORD_DTYPE.itemsize
+
+
+def test_read_histories_reads_archive(tmpdir):
+    df = generate_candles(100, START, seed=1)
+    CandleArchive(str(tmpdir)).append_frame("EPIC", "5MINUTE", df)
+
+    histories = read_histories([str(tmpdir)])
+    assert list(histories) == ["EPIC"]
+    np.testing.assert_array_equal(histories["EPIC"]["Volume"], df["Volume"])
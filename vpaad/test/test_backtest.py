@@ -0,0 +1,141 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.archive import CandleArchive
+from vpaad.backtest import read_histories, run_backtest
+from vpaad.candle import aggregate_candles
+from vpaad.volume_tracker import VolumeTracker
+
+START_UTM = 1500000000000 // 3600000 * 3600000
+FIVE_MINUTES_MS = 5 * 60 * 1000
+
+
+def make_history(count, seed=0):
+    rng = np.random.RandomState(seed)
+    closes = 1000.0 + np.cumsum(rng.normal(0.0, 1.0, count))
+    opens = np.concatenate(([1000.0], closes[:-1]))
+    return pd.DataFrame({
+        "Open": opens,
+        "High": np.maximum(opens, closes) + rng.exponential(0.5, count),
+        "Low": np.minimum(opens, closes) - rng.exponential(0.5, count),
+        "Close": closes,
+        "Volume": np.ceil(rng.lognormal(4.0, 0.6, count)),
+    }, index=pd.to_datetime(
+        START_UTM + np.arange(count) * FIVE_MINUTES_MS, unit="ms"))
+
+
+def test_aggregate_candles_keeps_partial_candles():
+    times = START_UTM + np.array([1, 2, 3, 4, 6, 9, 10]) * FIVE_MINUTES_MS
+    prices = np.arange(7, dtype=np.float64)
+    aggregated = aggregate_candles(
+        times, prices, prices + 10, prices - 10, prices + 1, prices,
+        datetime.timedelta(minutes=15), datetime.timedelta(minutes=5))
+
+    times, opens, highs, lows, closes, volumes = aggregated
+    # The first 15 minutes was under way at the first candle, and the last
+    # is still missing the candle for its end. The others are missing some
+    # of their candles.
+    assert list(times) == [
+        START_UTM + 3 * FIVE_MINUTES_MS, START_UTM + 6 * FIVE_MINUTES_MS]
+    assert list(opens) == [2.0, 4.0]
+    assert list(highs) == [13.0, 14.0]
+    assert list(lows) == [-8.0, -6.0]
+    assert list(closes) == [4.0, 5.0]
+    assert list(volumes) == [5.0, 4.0]
+
+
+def volume_tracker_reports(df, resolutions):
+    """The anomalies VolumeTrackers report, given the candles of df."""
+    reports = []
+    volume_trackers = [
+        VolumeTracker(
+            "A", "EPIC.A", resolution, None, None,
+            notification_callbacks=(reports.append,), pre_calculate=False)
+        for resolution in resolutions
+    ]
+    for time, row in zip(df.index, df.itertuples()):
+        candle_data = {
+            "BID_OPEN": row.Open,
+            "BID_CLOSE": row.Close,
+            "BID_HIGH": row.High,
+            "BID_LOW": row.Low,
+            "CONS_TICK_COUNT": row.Volume,
+            "UTM": int(time.value // 10 ** 6),
+        }
+        for vt in volume_trackers:
+            vt.add_5min_candle(candle_data, notify_on_anomaly=True)
+    return sorted(
+        (report.resolution, report.candle.utm, report.shape_type)
+        for report in reports)
+
+
+def backtest_anomalies(result):
+    return sorted(
+        (resolution, int(time.value // 10 ** 6), shape)
+        for time, resolution, shape in zip(
+            result.anomalies.index, result.anomalies["Resolution"],
+            result.anomalies["ShapeType"]))
+
+
+def test_backtest_matches_volume_tracker():
+    df = make_history(2000)
+    resolutions = ["5MINUTE", "15MINUTE"]
+
+    expected = volume_tracker_reports(df, resolutions)
+    result = run_backtest({"EPIC.A": df}, resolutions, warm_up=0)
+
+    assert expected
+    assert backtest_anomalies(result) == expected
+    assert result.stats.loc[("EPIC.A", "15MINUTE"), "Candles"] == 666
+    assert "Anomalies: {}".format(len(expected)) in result.summary()
+
+
+def test_backtest_matches_volume_tracker_with_gaps():
+    df = make_history(2000)
+    # Start part way through an hour, and miss a tenth of the candles
+    rng = np.random.RandomState(1)
+    df = df.iloc[5:][rng.uniform(size=len(df) - 5) > 0.1]
+    resolutions = ["5MINUTE", "15MINUTE", "HOUR"]
+
+    expected = volume_tracker_reports(df, resolutions)
+    result = run_backtest({"EPIC.A": df}, resolutions, warm_up=0)
+
+    assert any(resolution == "HOUR" for resolution, _, _ in expected)
+    assert backtest_anomalies(result) == expected
+
+
+def test_read_histories(tmpdir):
+    df = make_history(100)
+    df.to_csv(os.path.join(str(tmpdir), "EPIC.A.csv"))
+    both = pd.concat((df.assign(Epic="EPIC.B"), df.assign(Epic="EPIC.C")))
+    both.to_csv(os.path.join(str(tmpdir), "more.csv"))
+
+    histories = read_histories([str(tmpdir)])
+
+    assert sorted(histories) == ["EPIC.A", "EPIC.B", "EPIC.C"]
+    for epic_df in histories.values():
+        assert list(epic_df.columns) == [
+            "Open", "High", "Low", "Close", "Volume"]
+        assert np.allclose(epic_df.values, df.values)
+        assert (epic_df.index == df.index).all()
+
+
+def test_read_histories_keeps_resolutions_apart(tmpdir):
+    five_minutes = make_history(24)
+    hourly = make_history(2) * 10
+    hourly.index = five_minutes.index[::12]
+    archive = CandleArchive(str(tmpdir))
+    archive.append_frame("EPIC", "5MINUTE", five_minutes)
+    archive.append_frame("EPIC", "HOUR", hourly)
+
+    with pytest.raises(ValueError):
+        read_histories([str(tmpdir)])
+    for resolution, df in (("5MINUTE", five_minutes), ("HOUR", hourly)):
+        histories = read_histories([str(tmpdir)], resolution)
+        assert list(histories) == ["EPIC"]
+        np.testing.assert_array_equal(
+            histories["EPIC"]["Volume"], df["Volume"])
@@ -0,0 +1,44 @@
+import copy
+import os
+
+from vpaad.benchmark import (
+    HEAVY_MODULES, compare_results, imported_modules, load_results,
+    over_startup_budget, run_benchmarks, save_results)
+
+
+def test_run_benchmarks_and_compare(tmpdir):
+    results = run_benchmarks(quick=True, repeat=1, only="trackers=1,")
+    assert results["results"]
+    for name, result in results["results"].items():
+        assert name.startswith("volume_tracker_add_candle")
+        assert result["per_operation"] > 0
+
+    path = os.path.join(str(tmpdir), "baseline.json")
+    save_results(results, path)
+    baseline = load_results(path)
+    assert baseline == results
+
+    comparison = compare_results(results, baseline)
+    assert comparison
+    assert not any(regression for _, _, _, _, regression in comparison)
+
+    slower = copy.deepcopy(results)
+    name = sorted(slower["results"])[0]
+    slower["results"][name]["per_operation"] *= 2
+    comparison = compare_results(slower, baseline)
+    assert [c[0] for c in comparison if c[4]] == [name]
+
+
+def test_cli_starts_without_heavy_modules():
+    for entry_point in (None, "search"):
+        modules = imported_modules(entry_point)
+        assert "click" in modules
+        assert not [
+            module for module in modules
+            if module.split(".")[0] in HEAVY_MODULES]
+
+    results = run_benchmarks(repeat=1, only="cli_startup[vpaad]")
+    assert list(results["results"]) == ["cli_startup[vpaad]"]
+    assert over_startup_budget(results, budget=0.0) == [
+        ("cli_startup[vpaad]",
+         results["results"]["cli_startup[vpaad]"]["per_operation"])]
@@ -1,9 +1,13 @@
 # -*- coding:utf-8 -*-
 import datetime
 import time
+import numpy as np
+import pandas as pd
 import pytest
 
-from vpaad.candle import CompositeCandle
+from vpaad.candle import (
+    Candle, CandleAggregator, CompositeCandle, classify_candles)
+from vpaad.constants import SPREAD_TYPE_CODES, VOLUME_TYPE_CODES
 
 
 def test_composite_candle_simple_sub_candles():
@@ -149,3 +153,158 @@ def test_composite_candle_completed_exception():
                 "UTM": candle_time,
             }
         )
+
+
+def test_candle_is_compact_and_composites_match_sub_candles():
+    candle_data = [
+        {
+            "BID_HIGH": 100 + i,
+            "BID_LOW": 50 - i,
+            "BID_CLOSE": 60 + 10 * i,
+            "BID_OPEN": 70,
+            "CONS_TICK_COUNT": 50,
+            "UTM": 1500000000000 + i * 300000,
+        }
+        for i in range(3)
+    ]
+    candle = Candle(candle_data[0])
+    assert not hasattr(candle, "__dict__")
+    assert candle.utm == 1500000000000
+    assert candle.type == "BEARISH"
+    assert candle.shape["shape_type"] == "WEAK_SHOOTING_STAR"
+    assert candle.wick_percentages == (
+        candle.shape["upper_wick_percentage"],
+        candle.shape["lower_wick_percentage"])
+
+    from_data = CompositeCandle(datetime.timedelta(minutes=15))
+    from_candles = CompositeCandle(datetime.timedelta(minutes=15))
+    for data in candle_data:
+        from_data.add_5min_candle(data)
+        from_candles.add_candle(Candle(data))
+    assert from_data.complete and from_candles.complete
+    assert from_data.data == from_candles.data
+    assert from_data.shape == from_candles.shape
+    assert from_data.utm == candle.utm
+    assert from_data.data["low"] == 48
+    assert from_data.data["close"] == 80
+
+    partial = CompositeCandle(datetime.timedelta(minutes=15))
+    for data in candle_data[:2]:
+        partial.add_5min_candle(data)
+    restored = CompositeCandle.from_snapshot(
+        datetime.timedelta(minutes=15), partial.snapshot())
+    assert restored.snapshot() == partial.snapshot()
+    restored.add_5min_candle(candle_data[2])
+    assert restored.complete
+    assert restored.data == from_data.data
+
+
+def aggregator_candle_data(minutes, volume=10):
+    # 2017-07-14 02:00 UTC, on the hour
+    return {
+        "BID_HIGH": 101 + minutes,
+        "BID_LOW": 99,
+        "BID_CLOSE": 100 + minutes,
+        "BID_OPEN": 100,
+        "CONS_TICK_COUNT": volume,
+        "UTM": 1500000000000 - 1500000000000 % 3600000 + minutes * 60000,
+    }
+
+
+def test_candle_aggregator_closes_buckets_on_time():
+    aggregator = CandleAggregator(
+        "EPIC", ("5MINUTE", "15MINUTE", "30MINUTE"))
+
+    # Joining mid bucket, the 15 and 30 minute candles start on the clock
+    assert list(aggregator.add(aggregator_candle_data(10))) == ["5MINUTE"]
+    completed = [
+        aggregator.add(aggregator_candle_data(minutes))
+        for minutes in (15, 20, 25, 35, 40)]
+
+    assert [len(candles) for candles in completed[2].values()] == [1, 1]
+    fifteen = completed[2]["15MINUTE"][0]
+    assert fifteen.utm == aggregator_candle_data(15)["UTM"]
+    assert fifteen.data["volume"] == 30
+    assert fifteen.data["close"] == 125
+    # 30 minutes started before the first candle
+    assert "30MINUTE" not in completed[2]
+
+    # 30 was missed, but the next bucket is still on the clock
+    fifteen = completed[4]["15MINUTE"][0]
+    assert fifteen.utm == aggregator_candle_data(30)["UTM"]
+    assert fifteen.complete
+    assert fifteen.sub_candle_count == 2
+    assert fifteen.data["open"] == 100
+    assert fifteen.data["close"] == 140
+
+
+def test_candle_aggregator_closes_buckets_after_gaps():
+    aggregator = CandleAggregator("EPIC", ("15MINUTE", "HOUR"))
+    for minutes in (0, 5):
+        assert aggregator.add(aggregator_candle_data(minutes)) == {}
+
+    # Nothing until the next hour
+    completed = aggregator.add(aggregator_candle_data(65, volume=1))
+
+    assert [candle.data["volume"] for candle in completed["15MINUTE"]] == [
+        20]
+    assert [candle.data["volume"] for candle in completed["HOUR"]] == [20]
+    assert completed["HOUR"][0].utm == aggregator_candle_data(0)["UTM"]
+
+
+def test_candle_aggregator_ignores_late_candles():
+    aggregator = CandleAggregator("EPIC", ("5MINUTE", "15MINUTE"))
+    aggregator.add(aggregator_candle_data(0))
+    aggregator.add(aggregator_candle_data(5))
+
+    assert aggregator.add(aggregator_candle_data(5, volume=1000)) == {}
+    assert aggregator.add(aggregator_candle_data(0)) == {}
+    completed = aggregator.add(aggregator_candle_data(10))
+
+    assert completed["15MINUTE"][0].data["volume"] == 30
+    assert completed["15MINUTE"][0].sub_candle_count == 3
+
+
+def test_classify_candles_matches_candle():
+    rng = np.random.RandomState(42)
+    size = 2000
+    opens = np.round(rng.uniform(90, 110, size), 1)
+    closes = np.round(rng.uniform(90, 110, size), 1)
+    closes[:50] = opens[:50]
+    highs = np.maximum(opens, closes) + np.round(rng.exponential(3, size), 1)
+    lows = np.minimum(opens, closes) - np.round(rng.exponential(3, size), 1)
+    highs[50:60] = lows[50:60] = opens[50:60] = closes[50:60]
+    volumes = rng.randint(1, 1000, size).astype(float)
+    df = pd.DataFrame({
+        "Open": opens, "High": highs, "Low": lows, "Close": closes,
+        "Volume": volumes,
+    })
+    volume_stats = (500.0, 200.0)
+    spread_stats = (5.0, 3.0)
+
+    classified = classify_candles(df, volume_stats, spread_stats)
+
+    for i in range(size):
+        candle = Candle({
+            "BID_HIGH": highs[i],
+            "BID_LOW": lows[i],
+            "BID_CLOSE": closes[i],
+            "BID_OPEN": opens[i],
+            "CONS_TICK_COUNT": volumes[i],
+            "UTM": 0,
+        })
+        row = classified.iloc[i]
+        assert row["Spread"] == candle.data["spread"]
+        assert row["AbsSpread"] == candle.spread_size
+        assert row["SpreadType"] == candle.data["spread_type"]
+        assert row["ShapeType"] == candle.shape["shape_type"]
+        assert (row["UpperWickPercentage"]
+                == candle.shape["upper_wick_percentage"])
+        assert (row["LowerWickPercentage"]
+                == candle.shape["lower_wick_percentage"])
+        volume, spread, _ = candle.get_spread_volume_weight(
+            volume_stats, spread_stats)
+        assert row["VolumeWeight"] == volume
+        assert row["SpreadWeight"] == spread
+        assert candle.spread_volume_codes(volume_stats, spread_stats) == (
+            VOLUME_TYPE_CODES[volume], SPREAD_TYPE_CODES[spread])
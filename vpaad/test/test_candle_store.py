@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from vpaad.candle import Candle
+from vpaad.candle_store import CandleStore, COLUMN_NAMES
+
+
+def make_candle(i):
+    return Candle({
+        "BID_OPEN": 100 + i,
+        "BID_CLOSE": 100 + i + (1 if i % 2 else -1),
+        "BID_HIGH": 103 + i,
+        "BID_LOW": 95 + i,
+        "CONS_TICK_COUNT": 10 * i,
+        "UTM": 1500000000000 + i * 300000,
+    })
+
+
+def test_candle_store_keeps_most_recent_candles_in_order():
+    store = CandleStore(5)
+    candles = [make_candle(i) for i in range(12)]
+    for candle in candles:
+        store.append_candle(candle)
+
+    assert len(store) == 5
+    np.testing.assert_array_equal(
+        store.column("time"), [c.utm for c in candles[-5:]])
+    np.testing.assert_array_equal(
+        store.column("volume"), [c.volume for c in candles[-5:]])
+
+    for stored, candle in zip(store, candles[-5:]):
+        assert stored.data == candle.data
+        assert stored.shape == candle.shape
+        assert stored.time == candle.time
+
+    assert store[-1].utm == candles[-1].utm
+    with pytest.raises(IndexError):
+        store[5]
+
+
+def test_candle_store_columns_are_read_only():
+    store = CandleStore(3)
+    store.append_candle(make_candle(1))
+    with pytest.raises(ValueError):
+        store.column("close")[0] = 1.0
+
+
+def test_candle_store_extend_matches_append():
+    appended = CandleStore(7)
+    extended = CandleStore(7)
+    candles = [make_candle(i) for i in range(10)]
+    for candle in candles[:3]:
+        appended.append_candle(candle)
+        extended.append_candle(candle)
+    for candle in candles[3:]:
+        appended.append_candle(candle)
+
+    staging = CandleStore(len(candles) - 3)
+    for candle in candles[3:]:
+        staging.append_candle(candle)
+    extended.extend({name: staging.column(name) for name in COLUMN_NAMES})
+
+    for name in COLUMN_NAMES:
+        np.testing.assert_array_equal(
+            appended.column(name), extended.column(name))
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from vpaad.candle_store import COLUMN_NAMES
+from vpaad.checkpoint import load_checkpoint, save_checkpoint
+from vpaad.historical_data_fetcher import IHistoricalDataFetcher
+from vpaad.synthetic import generate_candles
+from vpaad.times import from_epoch_ms, to_epoch_ms
+from vpaad.volume_tracker import (
+    add_candle_to_volume_trackers, create_volume_trackers)
+
+MARKETS = [{
+    "name": "Gold", "epic": "EPIC",
+    "resolutions": ["5MINUTE", "15MINUTE", "HOUR"]}]
+
+
+class FrameFetcher(IHistoricalDataFetcher):
+    def __init__(self, df):
+        self.df = df
+        self.fetches = []
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        self.fetches.append((epic, resolution, start_time, end_time))
+        return self.df[start_time:end_time]
+
+
+def create(fetcher):
+    return create_volume_trackers(
+        MARKETS, None, fetcher, (), pre_calculate=False)
+
+
+def add_candles(volume_trackers, df):
+    for time, row in zip(to_epoch_ms(df.index), df.itertuples()):
+        add_candle_to_volume_trackers(volume_trackers, {
+            "name": "CHART:EPIC:5MINUTE",
+            "values": {
+                "BID_OPEN": row.Open, "BID_HIGH": row.High,
+                "BID_LOW": row.Low, "BID_CLOSE": row.Close,
+                "CONS_TICK_COUNT": row.Volume, "UTM": time,
+                "CONS_END": u"1"}})
+
+
+def test_restore_carries_on_where_the_checkpoint_left_off(tmpdir):
+    df = generate_candles(600, "2021-03-01 00:00", seed=0)
+    fetcher = FrameFetcher(df)
+    path = os.path.join(str(tmpdir), "checkpoint.npz")
+
+    uninterrupted = create(fetcher)
+    add_candles(uninterrupted, df)
+
+    # Stopped half way through an hour, and restarted 20 candles later
+    stopped = create(fetcher)
+    add_candles(stopped, df.iloc[:400])
+    save_checkpoint(path, stopped)
+    restarted = create(fetcher)
+    now = from_epoch_ms([to_epoch_ms(df.index[420])])[0]
+    checkpoint = load_checkpoint(path)
+
+    assert checkpoint.epics == ["EPIC"]
+    assert checkpoint.restore("EPIC", restarted["EPIC"], now=now)
+    assert fetcher.fetches == [("EPIC", "5Min", df.index[400], now)]
+    add_candles(restarted, df.iloc[420:])
+
+    for expected, vt in zip(uninterrupted["EPIC"], restarted["EPIC"]):
+        for name in COLUMN_NAMES:
+            assert np.array_equal(
+                vt.candles.column(name), expected.candles.column(name))
+        assert np.allclose(vt._volume_stats, expected._volume_stats)
+        assert np.allclose(
+            vt._candle_spread_stats, expected._candle_spread_stats)
+
+
+def test_restore_falls_back_to_initiating(tmpdir):
+    df = generate_candles(200, "2021-03-01 00:00", seed=0)
+    path = os.path.join(str(tmpdir), "checkpoint.npz")
+    volume_trackers = create(FrameFetcher(df))
+    add_candles(volume_trackers, df.iloc[:100])
+    save_checkpoint(path, volume_trackers)
+
+    # Longer ago than the 72 5 minute candle window
+    checkpoint = load_checkpoint(path)
+    restarted = create(FrameFetcher(df))
+    assert not checkpoint.restore(
+        "EPIC", restarted["EPIC"], now=df.index[100] + 73 * df.index.freq)
+    assert not checkpoint.restore("OTHER", restarted["EPIC"])
+    assert len(restarted["EPIC"][0].candles) == 0
+
+    with open(path, "wb") as checkpoint_file:
+        checkpoint_file.write(b"not a checkpoint")
+    assert load_checkpoint(path) is None
+    assert load_checkpoint(os.path.join(str(tmpdir), "missing.npz")) is None
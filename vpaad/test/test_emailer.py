@@ -0,0 +1,233 @@
+import smtplib
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from vpaad.emailer import SMTP_TIMEOUT, Emailer
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA,
+    NOOP, RSET and QUIT.
+    """
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 localhost fake SMTP")
+        while True:
+            line = self.rfile.readline().decode("ascii").rstrip("\r\n")
+            if not line:
+                return
+            command = line.split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif command == "AUTH":
+                server.logins += 1
+                self.reply("235 Authenticated")
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 Go ahead")
+                lines = []
+                while True:
+                    data_line = self.rfile.readline().decode("ascii")
+                    if data_line in (".\r\n", ""):
+                        break
+                    lines.append(data_line)
+                server.messages.append("".join(lines))
+                if server.drop_after_message:
+                    server.drop_after_message = False
+                    return
+                self.reply("250 Queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", 0), FakeSMTPHandler)
+        self.connections = 0
+        self.logins = 0
+        self.messages = []
+        self.drop_after_message = False
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RecordingSMTP(smtplib.SMTP):
+    """An SMTP client that remembers the timeouts it was created with."""
+    timeouts = []
+
+    def __init__(self, host, port, timeout):
+        RecordingSMTP.timeouts.append(timeout)
+        smtplib.SMTP.__init__(self, host, port, timeout=timeout)
+
+
+class FakeReport(object):
+    def __init__(self, number):
+        self.summary = "Anomaly {}".format(number)
+        self.content = "Details of anomaly {}".format(number)
+
+
+class BrokenReport(object):
+    def __init__(self, number):
+        self.summary = "Anomaly {}".format(number)
+
+    @property
+    def content(self):
+        raise ValueError("Cannot render")
+
+
+def make_emailer(server, smtp_class=None, **config):
+    notification_config = {
+        "email_address": "vpaad@example.com",
+        "username": "vpaad@example.com",
+        "recipients": ["trader@example.com"],
+        "smtp_server": "127.0.0.1",
+        "smtp_port": server.port,
+        "use_tls": False,
+        "digest_window": 0,
+        "retry_backoff": 0.01,
+    }
+    notification_config.update(config)
+    return Emailer(notification_config, "password", smtp_class=smtp_class)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_emailer_reuses_connection():
+    server = FakeSMTPServer()
+    emailer = make_emailer(server)
+    emailer.start()
+    try:
+        emailer.add_email_to_queue(FakeReport(1))
+        assert wait_for(lambda: len(server.messages) == 1)
+        emailer.add_email_to_queue(FakeReport(2))
+        assert wait_for(lambda: len(server.messages) == 2)
+    finally:
+        emailer.stop()
+        server.close()
+
+    assert server.connections == 1
+    assert server.logins == 1
+    assert "Subject: VPA Anomaly Detected: Anomaly 1" in server.messages[0]
+    assert "Details of anomaly 2" in server.messages[1]
+
+
+def test_emailer_connects_with_timeout():
+    server = FakeSMTPServer()
+    RecordingSMTP.timeouts = []
+    emailer = make_emailer(server, smtp_class=RecordingSMTP)
+    try:
+        assert emailer._send_email([FakeReport(1)]) is True
+        emailer._disconnect()
+    finally:
+        server.close()
+
+    assert RecordingSMTP.timeouts == [SMTP_TIMEOUT]
+    assert len(server.messages) == 1
+
+
+def test_emailer_sends_bursts_as_digest():
+    server = FakeSMTPServer()
+    emailer = make_emailer(server, digest_window=0.5)
+    emailer.start()
+    try:
+        for number in range(5):
+            emailer.add_email_to_queue(FakeReport(number))
+        assert wait_for(lambda: len(server.messages) == 1)
+        time.sleep(0.6)
+    finally:
+        emailer.stop()
+        server.close()
+
+    assert len(server.messages) == 1
+    assert "Subject: VPA Anomalies Detected: 5 anomalies" in (
+        server.messages[0])
+    for number in range(5):
+        assert "Details of anomaly {}".format(number) in server.messages[0]
+
+
+def test_emailer_reconnects_and_retries():
+    server = FakeSMTPServer()
+    server.drop_after_message = True
+    emailer = make_emailer(server)
+    emailer.start()
+    try:
+        emailer.add_email_to_queue(FakeReport(1))
+        assert wait_for(lambda: len(server.messages) == 2)
+        emailer.add_email_to_queue(FakeReport(2))
+        assert wait_for(lambda: len(server.messages) == 3)
+    finally:
+        emailer.stop()
+        server.close()
+
+    # The first attempt was cut off before it was acknowledged
+    assert server.connections == 2
+    assert "Anomaly 1" in server.messages[1]
+    assert "Anomaly 2" in server.messages[2]
+
+
+def test_emailer_survives_unexpected_errors():
+    server = FakeSMTPServer()
+    emailer = make_emailer(server)
+    emailer.start()
+    try:
+        emailer.add_email_to_queue(BrokenReport(1))
+        emailer.add_email_to_queue(FakeReport(2))
+        assert wait_for(lambda: len(server.messages) == 1)
+    finally:
+        emailer.stop()
+        server.close()
+
+    assert "Anomaly 2" in server.messages[0]
+
+
+def test_emailer_gives_up_after_retries():
+    # Nothing listens on this port
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    emailer = Emailer({
+        "email_address": "vpaad@example.com",
+        "username": "vpaad@example.com",
+        "recipients": ["trader@example.com"],
+        "smtp_server": "127.0.0.1",
+        "smtp_port": port,
+        "max_retries": 2,
+        "retry_backoff": 0.01,
+    }, "password")
+    assert emailer._send_email([FakeReport(1)]) is False
@@ -0,0 +1,184 @@
+import datetime
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.constants import DATETIME_STR_FORMAT
+from vpaad.fetch_scheduler import (
+    HISTORY_FETCHES_DEDUPLICATED, DataPointAllowance, FetchScheduler,
+    HistoryAllowanceExceeded, TokenBucket)
+from vpaad.historical_data_fetcher import RealHistoricalDataFetcher
+
+
+class FakeIGService(object):
+    """
+    Serves historical prices like IG's REST API through trading_ig: prices
+    in a DataFrame with bid, ask and last columns, and what's left of the
+    data point allowance. Refuses requests beyond requests_per_window in
+    any window seconds, or beyond the allowance, with IG's errors.
+    """
+    def __init__(self, allowance=10000, requests_per_window=None,
+                 window=1.0, failures=0):
+        self.calls = []
+        self.allowance = allowance
+        self._requests_per_window = requests_per_window
+        self._window = window
+        self._failures = failures
+        self._request_times = []
+        self._lock = threading.Lock()
+        self.release = threading.Event()
+        self.release.set()
+
+    def fetch_historical_prices_by_epic_and_date_range(
+            self, epic, resolution, start_date, end_date):
+        with self._lock:
+            self.calls.append((epic, resolution))
+        self.release.wait()
+        with self._lock:
+            now = time.monotonic()
+            self._request_times = [
+                t for t in self._request_times if now - t < self._window]
+            self._request_times.append(now)
+            if self._failures:
+                self._failures -= 1
+                raise ConnectionError("Connection reset by peer")
+            if (self._requests_per_window is not None and
+                    len(self._request_times) > self._requests_per_window):
+                raise Exception("error.public-api.exceeded-account-allowance")
+
+            times = pd.date_range(
+                datetime.datetime.strptime(start_date, DATETIME_STR_FORMAT),
+                datetime.datetime.strptime(end_date, DATETIME_STR_FORMAT),
+                freq=resolution.replace("Min", "min").replace("H", "h"))
+            if len(times) > self.allowance:
+                raise Exception(
+                    "error.public-api.exceeded-account-historical-data-"
+                    "allowance")
+            self.allowance -= len(times)
+
+        values = np.arange(len(times), dtype=float)
+        columns = pd.MultiIndex.from_product(
+            (("bid", "ask", "last"), ("Open", "High", "Low", "Close")))
+        prices = pd.DataFrame(
+            np.repeat(values[:, np.newaxis], len(columns), axis=1),
+            index=times, columns=columns)
+        prices[("last", "Volume")] = values * 10
+        return {
+            "prices": prices,
+            "allowance": {
+                "remainingAllowance": self.allowance,
+                "totalAllowance": 10000,
+                "allowanceExpiry": 3600,
+            },
+        }
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_token_bucket_allows_bursts_then_paces():
+    now = [0.0]
+    bucket = TokenBucket(rate=2.0, capacity=3, clock=lambda: now[0])
+    assert [bucket.reserve() for _ in range(5)] == [0.0, 0.0, 0.0, 0.5, 1.0]
+
+    # Tokens reserved are used up first, and no more than capacity build up
+    now[0] = 10.0
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.0, 0.5]
+    bucket.pause(2.0)
+    assert bucket.reserve() == pytest.approx(3.0)
+
+
+def test_scheduler_orders_deduplicates_and_retries():
+    ig_service = FakeIGService(failures=1)
+    ig_service.release.clear()
+    allowance = DataPointAllowance()
+    scheduler = FetchScheduler(
+        RealHistoricalDataFetcher(ig_service, allowance),
+        requests_per_minute=6000, burst=5, allowance=allowance, workers=1,
+        backoff=0.01, seed=0)
+    start = datetime.datetime(2020, 1, 6, 9, 0)
+    end = datetime.datetime(2020, 1, 6, 15, 0)
+    fetches = [
+        ("FIRST", "1H"), ("SECOND", "5Min"), ("THIRD", "1Min"),
+        ("SECOND", "5Min"),
+    ]
+    results = {}
+
+    def fetch(i, epic, resolution):
+        # Times moments apart are the same fetch
+        offset = datetime.timedelta(microseconds=i)
+        results[i] = scheduler.fetch(
+            epic, resolution, start + offset, end + offset)
+
+    deduplicated = HISTORY_FETCHES_DEDUPLICATED.labels().value
+    threads = []
+    scheduler.start()
+    for i, (epic, resolution) in enumerate(fetches):
+        threads.append(threading.Thread(
+            target=fetch, args=(i, epic, resolution)))
+        threads[-1].start()
+        # The first fetch is held up at IG, so the rest are all queued
+        assert wait_for(
+            lambda: len(ig_service.calls) == 1 and (
+                scheduler.queued == i or
+                HISTORY_FETCHES_DEDUPLICATED.labels().value > deduplicated))
+    ig_service.release.set()
+    for thread in threads:
+        thread.join()
+    scheduler.stop()
+
+    # After the first, fetches are made shortest resolution first, and the
+    # failure is retried
+    assert ig_service.calls == [
+        ("FIRST", "1H"), ("FIRST", "1H"), ("THIRD", "1Min"),
+        ("SECOND", "5Min")]
+    assert HISTORY_FETCHES_DEDUPLICATED.labels().value == deduplicated + 1
+    assert len(results[0]) == 7
+    assert len(results[1]) == len(results[3]) == 73
+    assert results[1] is not results[3]
+    assert allowance.remaining == ig_service.allowance == 10000 - 7 - 361 - 73
+
+
+def test_scheduler_backs_off_rate_limits_and_respects_allowance():
+    ig_service = FakeIGService(allowance=30, requests_per_window=2, window=0.2)
+    allowance = DataPointAllowance()
+    scheduler = FetchScheduler(
+        RealHistoricalDataFetcher(ig_service, allowance),
+        requests_per_minute=6000, burst=5, allowance=allowance, workers=2,
+        backoff=0.2, seed=0)
+    start = datetime.datetime(2020, 1, 6, 9, 0)
+    scheduler.start()
+    try:
+        threads = [
+            threading.Thread(target=scheduler.fetch, args=(
+                "EPIC.{}".format(i), "1H", start,
+                start + datetime.timedelta(hours=2)))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each fetch got 3 data points, after any refused requests were
+        # retried
+        assert ig_service.allowance == allowance.remaining == 15
+        assert len(ig_service.calls) > 5
+
+        # IG refuses a fetch beyond the allowance, and none are made after
+        with pytest.raises(HistoryAllowanceExceeded):
+            scheduler.fetch(
+                "EPIC.0", "1H", start, start + datetime.timedelta(days=1))
+        assert allowance.remaining == 0
+        calls = len(ig_service.calls)
+        with pytest.raises(HistoryAllowanceExceeded):
+            scheduler.fetch(
+                "EPIC.1", "1H", start, start + datetime.timedelta(hours=1))
+        assert len(ig_service.calls) == calls
+    finally:
+        scheduler.stop()
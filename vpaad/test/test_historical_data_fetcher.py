@@ -1,7 +1,15 @@
 import datetime
 
-from vpaad.historical_data_fetcher import InterpolatedHistoricalDataFetcher
-from vpaad.constants import DATETIME_STR_FORMAT, START_TIME_MULIPLIER
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.candle import CompositeCandle
+from vpaad.historical_data_fetcher import (
+    IHistoricalDataFetcher, InterpolatedHistoricalDataFetcher,
+    load_epic_history, resample_historic_data)
+from vpaad.constants import (
+    CANDLE_RES_TO_TIMEDELTA, START_TIME_MULIPLIER)
 
 
 def test_interpolated_hdf():
@@ -18,17 +26,12 @@ def test_interpolated_hdf():
             }
         }
     }
-    ihdf = InterpolatedHistoricalDataFetcher(ihdf_params)
+    ihdf = InterpolatedHistoricalDataFetcher(ihdf_params, seed=0)
 
-    now = datetime.datetime.now()
+    now = datetime.datetime(2020, 1, 8, 12, 31)
     start_time = now - datetime.timedelta(minutes=5) * START_TIME_MULIPLIER
 
-    df = ihdf.fetch(
-        "CS.D.CFDGOLD.CFDGC.IP",
-        "5Min",
-        start_time.strftime(DATETIME_STR_FORMAT),
-        now.strftime(DATETIME_STR_FORMAT)
-    )
+    df = ihdf.fetch("CS.D.CFDGOLD.CFDGC.IP", "5Min", start_time, now)
     assert len(df[df["Volume"] > 0]) > 0
     assert len(df[df["AbsSpread"] > 0]) > 0
 
@@ -46,3 +49,113 @@ def test_interpolated_hdf():
 
     assert described_df["AbsSpread"]["std"] < spread_std + epsilon
     assert described_df["AbsSpread"]["std"] > spread_std - epsilon
+
+
+def test_interpolated_hdf_candles_are_aligned_and_seeded():
+    params = {
+        "EPIC": {
+            "1H": {
+                "volume": {"mean": 100.0, "std": 30.0},
+                "spread": {"mean": 2.0, "std": 1.0}
+            }
+        }
+    }
+    end_time = datetime.datetime(2020, 1, 8, 12, 31)
+    start_time = end_time - datetime.timedelta(hours=START_TIME_MULIPLIER)
+    fetch_args = ("EPIC", "1H", start_time, end_time)
+
+    df = InterpolatedHistoricalDataFetcher(params, seed=1).fetch(*fetch_args)
+
+    assert len(df) == START_TIME_MULIPLIER
+    # The last finished candle started at 11:00
+    assert df.index[-1] == datetime.datetime(2020, 1, 8, 11)
+    assert (df["High"] >= df[["Open", "Close"]].max(axis=1)).all()
+    assert (df["Low"] <= df[["Open", "Close"]].min(axis=1)).all()
+    assert (df["AbsSpread"] == (df["Open"] - df["Close"]).abs()).all()
+    pd.testing.assert_frame_equal(
+        df, InterpolatedHistoricalDataFetcher(params, seed=1).fetch(
+            *fetch_args))
+
+
+def make_5min_history(start, size, seed=0):
+    rng = np.random.RandomState(seed)
+    opens = rng.uniform(100, 110, size)
+    closes = rng.uniform(100, 110, size)
+    df = pd.DataFrame({
+        "Open": opens,
+        "High": np.maximum(opens, closes) + rng.exponential(2, size),
+        "Low": np.minimum(opens, closes) - rng.exponential(2, size),
+        "Close": closes,
+        "Volume": rng.randint(1, 500, size).astype(float),
+    }, index=pd.date_range(start, periods=size, freq="5min"))
+    df["AbsSpread"] = (df["Open"] - df["Close"]).abs()
+    return df
+
+
+def test_resample_historic_data_matches_composite_candle():
+    start = datetime.datetime(2020, 1, 6, 9, 0)
+    df = make_5min_history(start, 36)
+
+    resampled = resample_historic_data(df, "15Min")
+
+    assert len(resampled) == 12
+    for i in range(12):
+        composite_candle = CompositeCandle(datetime.timedelta(minutes=15))
+        for _, row in df.iloc[3 * i:3 * i + 3].iterrows():
+            composite_candle.add_5min_candle({
+                "BID_HIGH": row["High"],
+                "BID_LOW": row["Low"],
+                "BID_CLOSE": row["Close"],
+                "BID_OPEN": row["Open"],
+                "CONS_TICK_COUNT": row["Volume"],
+                "UTM": 0,
+            })
+        row = resampled.iloc[i]
+        data = composite_candle.data
+        assert resampled.index[i] == df.index[3 * i]
+        assert row["Open"] == data["open"]
+        assert row["High"] == data["high"]
+        assert row["Low"] == data["low"]
+        assert row["Close"] == data["close"]
+        assert row["Volume"] == pytest.approx(data["volume"])
+        assert row["AbsSpread"] == data["spread_size"]
+
+
+def test_resample_historic_data_skips_gaps_and_unfinished_candle():
+    start = datetime.datetime(2020, 1, 6, 9, 0)
+    df = make_5min_history(start, 30)
+    df = df.drop(df.index[12:24])
+
+    end_time = start + datetime.timedelta(minutes=5 * 30 - 2)
+    resampled = resample_historic_data(df, "1H", end_time)
+
+    # 09:00 is complete, 10:00 is missing, 11:00 hasn't finished yet
+    assert list(resampled.index) == [start]
+
+
+class CountingHistoricalDataFetcher(IHistoricalDataFetcher):
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        self.calls.append((epic, resolution, start_time, end_time))
+        start = pd.Timestamp(start_time).floor("5min")
+        size = int((end_time - start) / datetime.timedelta(minutes=5))
+        return make_5min_history(start, size)
+
+
+def test_load_epic_history_fetches_once():
+    fetcher = CountingHistoricalDataFetcher()
+    end_time = datetime.datetime(2020, 1, 8, 12, 31)
+    spans = {
+        res: CANDLE_RES_TO_TIMEDELTA[res] * START_TIME_MULIPLIER
+        for res in ("5MINUTE", "15MINUTE", "30MINUTE", "HOUR")
+    }
+
+    histories = load_epic_history(fetcher, "EPIC", spans, end_time)
+
+    assert len(fetcher.calls) == 1
+    assert fetcher.calls[0][1] == "5Min"
+    for res, df in histories.items():
+        assert len(df) == START_TIME_MULIPLIER
+    assert histories["HOUR"].index[-1] == datetime.datetime(2020, 1, 8, 11)
@@ -0,0 +1,115 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from vpaad.historical_data_fetcher import IHistoricalDataFetcher
+from vpaad.history_cache import CachingHistoricalDataFetcher
+
+
+class FakeHistoricalDataFetcher(IHistoricalDataFetcher):
+    """
+    Returns a deterministic 5 minute candle for every slot in the requested
+    range, including the one still in progress at the end time.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        self.calls.append((start_time, end_time))
+        times = pd.date_range(
+            pd.Timestamp(start_time).ceil("5min"), end_time, freq="5min")
+        values = np.asarray(times.minute + times.hour * 60, dtype=float)
+        df = pd.DataFrame({
+            "Open": values,
+            "High": values + 2,
+            "Low": values - 2,
+            "Close": values + 1,
+            "Volume": values * 10,
+        }, index=times)
+        df["AbsSpread"] = (df["Open"] - df["Close"]).abs()
+        return df
+
+
+def fetch(fetcher, start, end):
+    return fetcher.fetch("EPIC", "5Min", start, end)
+
+
+def test_cache_only_fetches_gap(tmpdir):
+    fake = FakeHistoricalDataFetcher()
+    start = datetime.datetime(2020, 1, 6, 9, 0, 0)
+    end = datetime.datetime(2020, 1, 6, 15, 2, 0)
+
+    cold = fetch(CachingHistoricalDataFetcher(fake, str(tmpdir)), start, end)
+    assert len(fake.calls) == 1
+    # The candle still in progress isn't returned
+    assert cold.index[-1] == datetime.datetime(2020, 1, 6, 14, 55, 0)
+
+    # A warm restart a few seconds later needs nothing new
+    warm = fetch(
+        CachingHistoricalDataFetcher(fake, str(tmpdir)),
+        start + datetime.timedelta(seconds=30),
+        end + datetime.timedelta(seconds=30))
+    assert len(fake.calls) == 1
+    # Cached times come back in milliseconds, whatever they were fetched in
+    pd.testing.assert_frame_equal(
+        cold.iloc[1:], warm, check_freq=False, check_index_type=False)
+
+    # Later on, only the candles since the last fetch are requested
+    later = end + datetime.timedelta(minutes=20)
+    topped_up = fetch(
+        CachingHistoricalDataFetcher(fake, str(tmpdir)), start, later)
+    assert len(fake.calls) == 2
+    assert fake.calls[1][0] == datetime.datetime(2020, 1, 6, 15, 0, 0)
+    expected = fake.fetch("EPIC", "5Min", start, later).iloc[:-1]
+    pd.testing.assert_frame_equal(
+        topped_up, expected, check_freq=False, check_index_type=False)
+
+
+def test_cache_discards_corrupt_file(tmpdir):
+    fake = FakeHistoricalDataFetcher()
+    start = datetime.datetime(2020, 1, 6, 9, 0, 0)
+    end = datetime.datetime(2020, 1, 6, 10, 0, 0)
+    fetcher = CachingHistoricalDataFetcher(fake, str(tmpdir))
+    fetch(fetcher, start, end)
+
+    path = fetcher._path("EPIC", "5Min")
+    with open(path, "r+b") as cache_file:
+        cache_file.truncate(os.path.getsize(path) // 2)
+
+    df = fetch(fetcher, start, end)
+    assert len(fake.calls) == 2
+    assert len(df) == 12
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    fake = FakeHistoricalDataFetcher()
+    start = datetime.datetime(2020, 1, 6, 9, 0, 0)
+    end = datetime.datetime(2020, 1, 6, 10, 0, 0)
+    fetcher = CachingHistoricalDataFetcher(fake, str(tmpdir))
+    fetcher.fetch("OLD", "5Min", start, end)
+    size = os.path.getsize(fetcher._path("OLD", "5Min"))
+    os.utime(fetcher._path("OLD", "5Min"), (0, 0))
+
+    fetcher._max_bytes = int(size * 1.5)
+    fetcher.fetch("NEW", "5Min", start, end)
+
+    assert not os.path.exists(fetcher._path("OLD", "5Min"))
+    assert os.path.exists(fetcher._path("NEW", "5Min"))
+
+
+def test_cache_eviction_skips_files_gone_meanwhile(tmpdir, monkeypatch):
+    fake = FakeHistoricalDataFetcher()
+    fetcher = CachingHistoricalDataFetcher(fake, str(tmpdir), max_bytes=0)
+    listdir = os.listdir
+    # As if another fetch discarded a corrupt file after it was listed
+    monkeypatch.setattr(
+        os, "listdir", lambda path: listdir(path) + ["GONE_5Min.npz"])
+
+    df = fetch(
+        fetcher, datetime.datetime(2020, 1, 6, 9, 0, 0),
+        datetime.datetime(2020, 1, 6, 10, 0, 0))
+
+    assert len(df) == 12
+    assert not os.path.exists(fetcher._path("EPIC", "5Min"))
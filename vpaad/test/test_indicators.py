@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from vpaad.indicators import (
+    EMA, RollingMinMax, RollingSlope, ema, rolling_min_max, rolling_slope)
+
+
+def test_ema_matches_vectorised():
+    values = np.random.RandomState(0).lognormal(3.0, 1.0, 500)
+    average = EMA(20)
+    expected = ema(values, 20)
+
+    for i, value in enumerate(values[:300]):
+        assert average.add(value) == pytest.approx(expected[i])
+    average.extend(values[300:])
+    assert len(average) == len(values)
+    assert average.value == pytest.approx(expected[-1])
+
+
+def test_rolling_slope_matches_polyfit_over_window():
+    window = 20
+    values = np.random.RandomState(1).normal(1e4, 50.0, 500)
+    slope = RollingSlope(window)
+    slope.RESYNC_INTERVAL = 77
+    expected = rolling_slope(values, window)
+
+    assert np.isnan(slope.slope)
+    for i, value in enumerate(values):
+        slope.add(value)
+        in_window = values[max(0, i + 1 - window):i + 1]
+        if len(in_window) < 2:
+            assert np.isnan(slope.slope) and np.isnan(expected[i])
+            continue
+        fitted = np.polyfit(np.arange(len(in_window)), in_window, 1)[0]
+        assert slope.slope == pytest.approx(fitted, abs=1e-6)
+        assert expected[i] == pytest.approx(fitted, abs=1e-6)
+
+    extended = RollingSlope(window)
+    extended.extend(values)
+    np.testing.assert_array_equal(extended.values(), values[-window:])
+    assert extended.slope == pytest.approx(slope.slope, abs=1e-6)
+
+    with pytest.raises(ValueError):
+        RollingSlope(1)
+
+
+def test_rolling_min_max_matches_vectorised():
+    window = 20
+    values = np.random.RandomState(2).normal(0.0, 1.0, 500)
+    min_max = RollingMinMax(window)
+    lowest, highest = rolling_min_max(values, window)
+
+    assert np.isnan(min_max.min) and np.isnan(min_max.max)
+    for i, value in enumerate(values[:300]):
+        min_max.add(value)
+        assert min_max.min == lowest[i]
+        assert min_max.max == highest[i]
+    min_max.extend(values[300:])
+    assert len(min_max) == window
+    assert min_max.min == lowest[-1] == values[-window:].min()
+    assert min_max.max == highest[-1] == values[-window:].max()
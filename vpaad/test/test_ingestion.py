@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from vpaad.ingestion import CandleDispatcher
+
+
+def make_event(epic, number, cons_end=u"1"):
+    return {
+        "name": "CHART:{}:5MINUTE".format(epic),
+        "values": {"CONS_END": cons_end, "UTM": str(number)},
+    }
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_dispatcher_keeps_order_per_epic():
+    handled = {}
+    lock = threading.Lock()
+
+    def handler(volume_trackers, event):
+        epic = event["name"].split(":")[1]
+        with lock:
+            handled.setdefault(epic, []).append(int(event["values"]["UTM"]))
+
+    dispatcher = CandleDispatcher(
+        workers=3, max_queue_size=10, handler=handler)
+    dispatcher.start({})
+    epics = ["EPIC.{}".format(i) for i in range(5)]
+    for number in range(100):
+        for epic in epics:
+            assert dispatcher.submit(make_event(epic, number))
+    # Unfinished candles aren't queued
+    assert not dispatcher.submit(make_event(epics[0], 100, cons_end=u"0"))
+    dispatcher.stop()
+
+    assert sorted(handled) == epics
+    for epic in epics:
+        assert handled[epic] == list(range(100))
+    metrics = dispatcher.metrics()
+    assert metrics["submitted"] == metrics["processed"] == 500
+    assert metrics["dropped"] == 0
+    assert metrics["queue_depth"] == 0
+
+
+@pytest.mark.parametrize("overflow_policy, expected", [
+    ("drop_newest", [0, 1, 2]),
+    ("drop_oldest", [0, 3, 4]),
+])
+def test_dispatcher_overflow(overflow_policy, expected):
+    release = threading.Event()
+    handled = []
+
+    def handler(volume_trackers, event):
+        release.wait()
+        handled.append(int(event["values"]["UTM"]))
+
+    dispatcher = CandleDispatcher(
+        workers=1, max_queue_size=2, overflow_policy=overflow_policy,
+        handler=handler)
+    dispatcher.start({})
+    dispatcher.submit(make_event("EPIC", 0))
+    # The worker holds the first candle, so the others wait in the queue
+    assert wait_for(lambda: dispatcher.metrics()["queue_depth"] == 0)
+    for number in range(1, 5):
+        dispatcher.submit(make_event("EPIC", number))
+
+    metrics = dispatcher.metrics()
+    assert metrics["queue_depth"] == 2
+    assert metrics["dropped"] == 2
+    release.set()
+    dispatcher.stop()
+
+    assert handled == expected
+    assert dispatcher.metrics()["max_lag"] > 0
+
+
+def test_dispatcher_survives_handler_failure():
+    handled = []
+
+    def handler(volume_trackers, event):
+        number = int(event["values"]["UTM"])
+        if number == 1:
+            raise ValueError("Bad candle")
+        handled.append(number)
+
+    dispatcher = CandleDispatcher(handler=handler)
+    dispatcher.start({})
+    for number in range(3):
+        dispatcher.submit(make_event("EPIC", number))
+    dispatcher.stop()
+
+    assert handled == [0, 2]
+    assert dispatcher.metrics()["failed"] == 1
@@ -0,0 +1,81 @@
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from vpaad import metrics
+from vpaad.volume_tracker import CANDLE_SECONDS, VolumeTracker
+
+
+def test_registry_renders_prometheus_text():
+    registry = metrics.Registry()
+    events = metrics.counter(
+        "events_total", "Events.", ("epic",), registry=registry)
+    depth = metrics.gauge("queue_depth", "Depth.", registry=registry)
+    latency = metrics.histogram(
+        "latency_seconds", "Latency.", buckets=(0.1, 1.0), registry=registry)
+
+    events.labels("CS.D.\"GOLD\"").inc()
+    events.labels("IX.FTSE").inc(2)
+    depth.set_function(lambda: 3)
+    for value in (0.05, 0.1, 0.5, 5.0):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP events_total Events.",
+        "# TYPE events_total counter",
+        "events_total{epic=\"CS.D.\\\"GOLD\\\"\"} 1",
+        "events_total{epic=\"IX.FTSE\"} 2",
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        "latency_seconds_bucket{le=\"0.1\"} 2",
+        "latency_seconds_bucket{le=\"1.0\"} 3",
+        "latency_seconds_bucket{le=\"+Inf\"} 4",
+        "latency_seconds_sum 5.65",
+        "latency_seconds_count 4",
+        "# HELP queue_depth Depth.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+    ]
+    assert registry.summary() == [
+        "events_total=3",
+        "latency_seconds count=4 mean=1.412500 p99<=inf",
+        "queue_depth=3",
+    ]
+    with pytest.raises(ValueError):
+        metrics.counter("events_total", "Again.", registry=registry)
+    with pytest.raises(ValueError):
+        events.labels()
+
+
+def test_metrics_server():
+    registry = metrics.Registry()
+    metrics.counter("events_total", "Events.", registry=registry).inc()
+    server = metrics.MetricsServer(0, registry=registry)
+    server.start()
+    try:
+        url = "http://127.0.0.1:{}".format(server.port)
+        response = urlopen(url + "/metrics")
+        assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+        assert "events_total 1" in response.read().decode("utf-8")
+        with pytest.raises(HTTPError):
+            urlopen(url + "/other")
+    finally:
+        server.stop()
+
+
+def test_volume_tracker_times_candles():
+    vt = VolumeTracker(
+        "Gold", "EPIC", "30MINUTE", None, None, pre_calculate=False)
+    count = CANDLE_SECONDS.labels("30MINUTE").count
+    assert vt.last_candle_age is None
+
+    for i in range(12):
+        vt.add_5min_candle({
+            "BID_OPEN": 100, "BID_CLOSE": 101, "BID_HIGH": 102,
+            "BID_LOW": 99, "CONS_TICK_COUNT": 10,
+            "UTM": 1500001200000 + i * 300000,
+        }, notify_on_anomaly=False)
+
+    assert CANDLE_SECONDS.labels("30MINUTE").count == count + 2
+    assert 0 <= vt.last_candle_age < 60
@@ -0,0 +1,98 @@
+import numpy as np
+
+from vpaad.backtest import run_backtest
+from vpaad.constants import (
+    CANDLE_TYPE_CODES, PATTERNS, SHAPE_TYPE_CODES, SPREAD_TYPE_CODES,
+    VOLUME_TYPE_CODES)
+from vpaad.patterns import PatternDetector, detect_patterns, pattern_names
+from vpaad.rules import RuleSet
+from vpaad.test.test_backtest import make_history
+from vpaad.volume_tracker import VolumeTracker
+
+
+def make_candles(count, seed=0):
+    rng = np.random.RandomState(seed)
+    # Trending, so that there are patterns to find
+    closes = 1000.0 + np.cumsum(
+        rng.normal(0.0, 1.0, count) + 0.5 * np.sin(np.arange(count) / 30.0))
+    opens = np.concatenate(([1000.0], closes[:-1]))
+    return (
+        np.maximum(opens, closes) + rng.exponential(0.5, count),
+        np.minimum(opens, closes) - rng.exponential(0.5, count),
+        closes,
+        np.ceil(rng.lognormal(4.0, 0.6, count)),
+        rng.randint(0, len(SHAPE_TYPE_CODES), count),
+        rng.randint(0, len(VOLUME_TYPE_CODES), count),
+        rng.randint(0, len(SPREAD_TYPE_CODES), count),
+        rng.randint(0, len(CANDLE_TYPE_CODES), count),
+        np.full(count, 1.0),
+    )
+
+
+def test_pattern_detector_matches_vectorised():
+    candles = make_candles(2000)
+    expected = detect_patterns(*candles)
+
+    detector = PatternDetector()
+    masks = [detector.update(*row) for row in zip(*candles)]
+    assert masks == list(expected)
+    found = set(name for mask in masks for name in pattern_names(mask))
+    assert found == set(PATTERNS)
+
+    extended = PatternDetector()
+    extended.extend(*[column[:1500] for column in candles[:4]])
+    assert [extended.update(*row) for row in zip(
+        *[column[1500:] for column in candles])] == masks[1500:]
+
+
+def test_selling_climax():
+    detector = PatternDetector()
+    for i in range(30):
+        close = 100.0 - i
+        detector.update(
+            close + 1.2, close - 0.2, close, 100.0,
+            SHAPE_TYPE_CODES["AVERAGE_SHAPE"],
+            VOLUME_TYPE_CODES["AVERAGE_VOLUME"],
+            SPREAD_TYPE_CODES["AVERAGE_SPREAD"],
+            CANDLE_TYPE_CODES["BEARISH"], 1.0)
+
+    # A hammer on high volume, making a new low
+    mask = detector.update(
+        71.0, 65.0, 70.8, 500.0, SHAPE_TYPE_CODES["STRONG_HAMMER"],
+        VOLUME_TYPE_CODES["HIGH_VOLUME"], SPREAD_TYPE_CODES["WIDE_SPREAD"],
+        CANDLE_TYPE_CODES["BULLISH"], 1.0)
+    assert pattern_names(mask) == ("SELLING_CLIMAX",)
+
+
+def test_pattern_rules_match_in_backtest_and_volume_tracker():
+    df = make_history(2000, seed=4)
+    rules = RuleSet({"pattern": "patterns in {{{}}}".format(
+        ", ".join(PATTERNS))})
+
+    reports = []
+    vt = VolumeTracker(
+        "A", "EPIC.A", "5MINUTE", None, None,
+        notification_callbacks=(reports.append,), pre_calculate=False,
+        rules=rules)
+    for time, row in zip(df.index, df.itertuples()):
+        vt.add_5min_candle({
+            "BID_OPEN": row.Open,
+            "BID_CLOSE": row.Close,
+            "BID_HIGH": row.High,
+            "BID_LOW": row.Low,
+            "CONS_TICK_COUNT": row.Volume,
+            "UTM": int(time.value // 10 ** 6),
+        }, notify_on_anomaly=True)
+
+    result = run_backtest(
+        {"EPIC.A": df}, ["5MINUTE"], warm_up=0,
+        rules={"pattern": rules.expressions["pattern"]})
+
+    assert reports
+    assert all(report.patterns for report in reports)
+    assert [
+        (report.candle.utm, ",".join(report.patterns))
+        for report in reports] == [
+        (int(time.value // 10 ** 6), patterns)
+        for time, patterns in zip(
+            result.anomalies.index, result.anomalies["Patterns"])]
@@ -0,0 +1,63 @@
+import os
+import time
+
+from vpaad.replay import (
+    CandleRecorder, generate_synthetic_events, read_events, replay_events)
+from vpaad.volume_tracker import create_volume_trackers
+
+MARKETS = [
+    {"name": "A", "epic": "EPIC.A", "resolutions": ["5MINUTE", "15MINUTE"]},
+    {"name": "B", "epic": "EPIC.B", "resolutions": ["5MINUTE"]},
+]
+
+
+def make_volume_trackers(anomalies):
+    return create_volume_trackers(
+        MARKETS, None, None,
+        (anomalies.append,), False)
+
+
+def test_recorder_round_trip(tmpdir):
+    path = os.path.join(str(tmpdir), "events.jsonl")
+    events = list(generate_synthetic_events(
+        ["EPIC.A", "EPIC.B"], 10, seed=1))
+
+    recorder = CandleRecorder(path)
+    for event in events:
+        recorder.record(event)
+    recorder.close()
+
+    assert recorder.count == 20
+    assert list(read_events(path)) == events
+
+
+def test_replay_synthetic_events():
+    anomalies = []
+    volume_trackers = make_volume_trackers(anomalies)
+    events = list(generate_synthetic_events(
+        ["EPIC.A", "EPIC.B"], 300, start_utm=1500000000000, seed=2))
+    incomplete = dict(events[0], values=dict(
+        events[0]["values"], CONS_END=u"0"))
+
+    result = replay_events(
+        volume_trackers, [incomplete] + events, anomalies=anomalies)
+
+    assert result.event_count == 601
+    assert len(result.latencies) == 600
+    assert result.events_per_second > 0
+    assert result.latency_percentile(50) <= result.latency_percentile(99)
+    assert result.anomalies is anomalies
+    assert len(volume_trackers["EPIC.A"][0].candles) == 72
+    assert len(volume_trackers["EPIC.A"][1].candles) == 72
+    assert "Events replayed: 601" in result.summary()
+
+
+def test_replay_at_speed():
+    volume_trackers = make_volume_trackers([])
+    events = list(generate_synthetic_events(
+        ["EPIC.A"], 4, start_utm=1500000000000, seed=3))
+
+    start = time.time()
+    # 15 minutes of candles at 3000x real time should take 0.3 seconds
+    replay_events(volume_trackers, events, speed=3000)
+    assert 0.25 < time.time() - start < 1.0
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from vpaad.candle import Candle
+from vpaad.report import CandleReport
+
+
+def make_report():
+    candle = Candle({
+        "BID_HIGH": 100,
+        "BID_LOW": 50,
+        "BID_CLOSE": 98,
+        "BID_OPEN": 96,
+        "CONS_TICK_COUNT": 500,
+        "UTM": 1500000000000,
+    })
+    return CandleReport(
+        "Spot Gold", "CS.D.CFDGOLD.CFDGC.IP", "15MINUTE", candle,
+        ("HIGH_VOLUME", "NARROW_SPREAD", "BULLISH"), (100.0, 50.0),
+        (10.0, 4.0))
+
+
+def test_report_representations():
+    report = make_report()
+
+    assert report.summary.startswith("Spot Gold, 15MINUTE, ")
+    assert report.summary.endswith(
+        "STRONG_HAMMER, ('HIGH_VOLUME', 'NARROW_SPREAD', 'BULLISH')")
+    assert report.content.startswith(
+        "VPAAD has detected an anomaly candle in: Spot Gold.\n\n")
+    assert str(report) == report.render("text")
+    assert "'shape_type': 'STRONG_HAMMER'" in report.to_text()
+
+    details = json.loads(report.render("json"))
+    assert details["epic"] == "CS.D.CFDGOLD.CFDGC.IP"
+    assert details["data"]["volume"] == 500
+    assert details["overall_volume_stats"] == [100.0, 50.0]
+
+    assert report.render("compact").split(" ")[-4:] == [
+        "STRONG_HAMMER", "HIGH_VOLUME", "NARROW_SPREAD", "BULLISH"]
+
+    with pytest.raises(ValueError):
+        report.render("xml")
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from vpaad.rolling_stats import RollingStats, rolling_mean_std
+
+
+def test_rolling_stats_matches_numpy_over_window():
+    window = 72
+    values = np.random.RandomState(0).lognormal(3.0, 1.0, 1000)
+    rolling_stats = RollingStats(window)
+
+    for i, value in enumerate(values):
+        rolling_stats.add(value)
+        expected = values[max(0, i + 1 - window):i + 1]
+        assert len(rolling_stats) == len(expected)
+        assert rolling_stats.mean == pytest.approx(np.mean(expected))
+        assert rolling_stats.std == pytest.approx(np.std(expected))
+
+    np.testing.assert_array_equal(rolling_stats.values(), values[-window:])
+
+
+def test_rolling_stats_large_window_after_resync():
+    window = 5000
+    values = np.random.RandomState(1).normal(1e4, 50.0, 3 * window)
+    rolling_stats = RollingStats(window)
+    rolling_stats.RESYNC_INTERVAL = 1234
+    rolling_stats.extend(values)
+
+    assert rolling_stats.mean == pytest.approx(np.mean(values[-window:]))
+    assert rolling_stats.std == pytest.approx(np.std(values[-window:]))
+
+
+def test_rolling_stats_empty_and_invalid_window():
+    rolling_stats = RollingStats(3)
+    assert len(rolling_stats) == 0
+    assert np.isnan(rolling_stats.mean)
+    assert np.isnan(rolling_stats.std)
+
+    with pytest.raises(ValueError):
+        RollingStats(0)
+
+
+def test_rolling_mean_std_matches_rolling_stats():
+    window = 30
+    rng = np.random.RandomState(2)
+    history = rng.normal(100.0, 10.0, 12)
+    values = rng.normal(100.0, 10.0, 200)
+
+    rolling_stats = RollingStats(window)
+    rolling_stats.extend(history)
+    means, stds = rolling_mean_std(values, window, rolling_stats.values())
+
+    for i, value in enumerate(values):
+        rolling_stats.add(value)
+        assert means[i] == pytest.approx(rolling_stats.mean)
+        assert stds[i] == pytest.approx(rolling_stats.std)
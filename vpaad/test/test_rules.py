@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from vpaad.constants import (
+    CANDLE_TYPE_CODES, PATTERN_CODES, SHAPE_TYPE_CODES, SPREAD_TYPE_CODES,
+    VOLUME_TYPE_CODES)
+from vpaad.rules import DEFAULT_RULES, RuleSet, market_rules, z_scores
+from vpaad.volume_tracker import NOTABLE_SHAPES, create_volume_trackers
+
+
+def features(shape="AVERAGE_SHAPE", volume="AVERAGE_VOLUME",
+             spread="AVERAGE_SPREAD", sentiment="BULLISH", volume_z=0.0,
+             spread_z=0.0, upper_wick=0.1, lower_wick=0.1, patterns=()):
+    return (
+        SHAPE_TYPE_CODES[shape], VOLUME_TYPE_CODES[volume],
+        SPREAD_TYPE_CODES[spread], CANDLE_TYPE_CODES[sentiment],
+        volume_z, spread_z, upper_wick, lower_wick,
+        sum(1 << PATTERN_CODES[pattern] for pattern in patterns))
+
+
+def test_default_rule_matches_notable_shapes_with_high_volume():
+    rules = RuleSet(DEFAULT_RULES)
+    for shape in SHAPE_TYPE_CODES:
+        for volume in VOLUME_TYPE_CODES:
+            matched = bool(rules.matches(features(shape, volume)))
+            assert matched == (
+                shape in NOTABLE_SHAPES and volume == "HIGH_VOLUME")
+
+
+def test_rule_language():
+    rules = RuleSet({
+        "wide_hammer": (
+            "shape in {STRONG_HAMMER, WEAK_HAMMER} and volume_z > 1.5 "
+            "AND spread == WIDE"),
+        "not_narrow": "NOT spread == NARROW AND (type == BEARISH OR "
+                      "lower_wick >= .5)",
+        "quiet": "volume not in {HIGH} and spread_z <= -1",
+    })
+
+    assert rules.names == ("not_narrow", "quiet", "wide_hammer")
+    assert rules.matches(features(
+        "WEAK_HAMMER", spread="WIDE_SPREAD", volume_z=2.0)) == (
+            "wide_hammer",)
+    assert rules.matches(features(
+        "STRONG_HAMMER", spread="WIDE_SPREAD", volume_z=1.0)) == ()
+    assert rules.matches(features(sentiment="BEARISH")) == ("not_narrow",)
+    assert rules.matches(features(
+        spread="NARROW_SPREAD", sentiment="BEARISH")) == ()
+    assert rules.matches(features(lower_wick=0.5, spread_z=-1.0)) == (
+        "not_narrow", "quiet")
+
+
+def test_rules_over_arrays_match_rules_per_candle():
+    rules = RuleSet({
+        "default": DEFAULT_RULES["notable_shape_high_volume"],
+        "strong": "volume_z > 2 OR NOT shape == AVERAGE",
+        "climax": "patterns in {SELLING_CLIMAX, BUYING_CLIMAX}",
+    })
+    rng = np.random.RandomState(0)
+    arrays = [
+        rng.randint(0, 6, 100).astype(np.int8),
+        rng.randint(0, 3, 100).astype(np.int8),
+        rng.randint(0, 3, 100).astype(np.int8),
+        rng.randint(0, 3, 100).astype(np.int8),
+        rng.normal(0, 2, 100), rng.normal(0, 2, 100),
+        rng.uniform(0, 1, 100), rng.uniform(0, 1, 100),
+        rng.randint(0, 64, 100),
+    ]
+
+    matches = rules.match_arrays(arrays)
+    for i in range(100):
+        candle_matches = rules.matches([array[i] for array in arrays])
+        assert candle_matches == tuple(
+            name for name, match in zip(rules.names, matches) if match[i])
+    assert (rules.any_arrays(arrays) == (
+        matches[0] | matches[1] | matches[2])).all()
+
+
+@pytest.mark.parametrize("rule", [
+    "shape == HAMMER",
+    "shape in {STRONG_HAMMER",
+    "colour == RED",
+    "volume_z > HIGH",
+    "volume > 1",
+    "volume == HIGH AND",
+    "volume == HIGH;",
+    "patterns == NO_DEMAND",
+    "patterns in {NO_VOLUME}",
+])
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        RuleSet({"invalid": rule})
+
+
+def test_pattern_rules():
+    rules = RuleSet({
+        "climax": "patterns in {SELLING_CLIMAX, BUYING_CLIMAX}",
+        "not_quiet": "patterns not in {NO_DEMAND, NO_SUPPLY}",
+    })
+    assert rules.matches(features()) == ("not_quiet",)
+    assert rules.matches(features(
+        patterns=("SELLING_CLIMAX", "BULLISH_DIVERGENCE"))) == (
+        "climax", "not_quiet")
+    assert rules.matches(features(patterns=("NO_SUPPLY",))) == ()
+
+
+def test_z_scores():
+    z = z_scores([1.0, 3.0, 2.0, 1.0], [2.0, 2.0, 2.0, 2.0],
+                 [0.5, 0.0, 0.0, 0.0])
+    assert list(z) == [-2.0, np.inf, 0.0, -np.inf]
+
+
+def test_market_rules_override_config_rules():
+    config_rules = {"a": "volume == HIGH", "b": "spread == WIDE"}
+    market = {
+        "name": "Gold", "epic": "EPIC", "resolutions": ["5MINUTE"],
+        "rules": {"b": None, "c": "shape == STRONG_HAMMER"},
+    }
+
+    assert market_rules(None, {}) == DEFAULT_RULES
+    assert market_rules(config_rules, market) == {
+        "a": "volume == HIGH", "c": "shape == STRONG_HAMMER"}
+
+    volume_trackers = create_volume_trackers(
+        [market], None, None, (), False, config_rules)
+    assert volume_trackers["EPIC"][0].rules.names == ("a", "c")
@@ -0,0 +1,70 @@
+from vpaad.ingestion import epic_of, partition
+from vpaad.replay import generate_synthetic_events, replay_events
+from vpaad.sharding import ShardedDispatcher, partition_volume_trackers
+from vpaad.volume_tracker import create_volume_trackers
+
+EPICS = ["EPIC.{}".format(i) for i in range(6)]
+MARKETS = [
+    {"name": epic, "epic": epic, "resolutions": ["5MINUTE", "15MINUTE"]}
+    for epic in EPICS
+]
+
+
+def make_volume_trackers(anomalies):
+    return create_volume_trackers(
+        MARKETS, None, None, (anomalies.append,), False)
+
+
+def test_partition_volume_trackers():
+    volume_trackers = make_volume_trackers([])
+    partitions = partition_volume_trackers(volume_trackers, 3)
+
+    assert len(partitions) == 3
+    assert sorted(
+        epic for shard in partitions for epic in shard) == EPICS
+    assert partitions == partition_volume_trackers(volume_trackers, 3)
+
+
+def test_sharded_replay_matches_single_process():
+    # A fake stream, fed through the volume trackers in this process and
+    # in shards
+    events = list(generate_synthetic_events(
+        EPICS, 300, start_utm=1500000000000, seed=4))
+
+    anomalies = []
+    replay_events(make_volume_trackers(anomalies), events)
+
+    sharded_anomalies = []
+    dispatcher = ShardedDispatcher(3)
+    result = replay_events(
+        make_volume_trackers(sharded_anomalies), events,
+        anomalies=sharded_anomalies, dispatcher=dispatcher)
+
+    assert anomalies
+    assert sorted(report.summary for report in sharded_anomalies) == sorted(
+        report.summary for report in anomalies)
+    assert result.event_count == len(events)
+    metrics = dispatcher.metrics()
+    assert sum(metrics["submitted"]) == len(events)
+    assert metrics["anomalies"] == len(anomalies)
+
+
+def test_sharded_dispatcher_drops_candles_of_dead_shards():
+    events = list(generate_synthetic_events(
+        EPICS, 20, start_utm=1500000000000, seed=4))
+    dispatcher = ShardedDispatcher(2, max_queue_size=1)
+    dispatcher.start(make_volume_trackers([]))
+    dead = dispatcher._processes[0]
+    dead.terminate()
+    dead.join()
+
+    try:
+        sent = [dispatcher.submit(event) for event in events]
+    finally:
+        dispatcher.stop()
+
+    shards = [partition(epic_of(event), 2) for event in events]
+    assert sent == [shard == 1 for shard in shards]
+    metrics = dispatcher.metrics()
+    assert metrics["dropped"] == [shards.count(0), 0]
+    assert metrics["submitted"] == [0, shards.count(1)]
@@ -0,0 +1,50 @@
+from vpaad.backtest import run_backtest
+from vpaad.sweep import run_sweep
+from vpaad.test.test_backtest import make_history
+
+RESOLUTIONS = ["5MINUTE", "15MINUTE"]
+
+
+def make_histories():
+    return {
+        "EPIC.A": make_history(3000, seed=1),
+        "EPIC.B": make_history(3000, seed=2),
+    }
+
+
+def test_sweep_default_parameters_match_backtest():
+    histories = make_histories()
+    table = run_sweep(
+        histories, RESOLUTIONS, windows=(72,), numbers_of_stds=(1.0,),
+        strong_wick_percentages=(0.75,))
+    result = run_backtest(histories, RESOLUTIONS, warm_up=72)
+
+    assert len(table) == 1
+    assert table.loc[0, "Hits"] == len(result.anomalies)
+    assert table.loc[0, "Candles"] == result.candle_count - 4 * 72
+
+
+def test_sweep_ranks_combinations():
+    histories = make_histories()
+    table = run_sweep(histories, RESOLUTIONS, numbers_of_stds=(0.5, 2.0))
+
+    assert len(table) == 3 * 2 * 3
+    assert list(table["Hits"]) == sorted(table["Hits"], reverse=True)
+    # Lower thresholds can only find more anomalies
+    for _, group in table.groupby(["Window", "StrongWick"]):
+        by_stds = group.set_index("NumberOfStds")["Hits"]
+        assert by_stds[0.5] >= by_stds[2.0]
+    assert ((table["ReversalRate"] >= 0) & (table["ReversalRate"] <= 1)).all()
+
+
+def test_sweep_in_worker_processes_per_epic():
+    histories = make_histories()
+    kwargs = dict(
+        windows=(36, 72), numbers_of_stds=(1.0, 1.5), per_epic=True,
+        sort_by="ReversalRate")
+    in_process = run_sweep(histories, RESOLUTIONS, **kwargs)
+    in_pool = run_sweep(histories, RESOLUTIONS, workers=2, **kwargs)
+
+    assert in_pool.equals(in_process)
+    assert list(in_process["Epic"].unique()) == ["EPIC.A", "EPIC.B"]
+    assert len(in_process) == 2 * 2 * 2 * 3
@@ -0,0 +1,64 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.synthetic import generate_candles, intraday_seasonality
+
+
+def test_generate_candles():
+    start = datetime.datetime(2020, 1, 6)
+    df = generate_candles(
+        200000, start, volume_mean=50.0, volume_std=40.0, spread_mean=2.0,
+        spread_std=1.5, seed=0)
+
+    assert isinstance(df.index, pd.DatetimeIndex)
+    assert df.index[0] == start
+    assert (np.diff(df.index) == pd.Timedelta(minutes=5)).all()
+    assert list(df.columns) == ["Open", "High", "Low", "Close", "Volume"]
+
+    # Each candle opens where the last one closed
+    np.testing.assert_array_equal(df["Open"].values[1:], df["Close"][:-1])
+    assert (df["High"] >= df[["Open", "Close"]].max(axis=1)).all()
+    assert (df["Low"] <= df[["Open", "Close"]].min(axis=1)).all()
+    assert (df["Low"] > 0).all()
+
+    spread_sizes = (df["Close"] - df["Open"]).abs()
+    assert spread_sizes.mean() == pytest.approx(2.0, rel=0.02)
+    assert spread_sizes.std() == pytest.approx(1.5, rel=0.05)
+    assert df["Volume"].mean() == pytest.approx(50.0, rel=0.02)
+    assert df["Volume"].std() == pytest.approx(40.0, rel=0.05)
+
+    # Busier in the afternoon than at night
+    by_hour = df["Volume"].groupby(df.index.hour).mean()
+    assert by_hour[14] > 1.2 * by_hour[2]
+
+
+def test_generate_candles_is_seeded():
+    start = datetime.datetime(2020, 1, 6)
+    df = generate_candles(1000, start, datetime.timedelta(hours=1), seed=3)
+
+    assert df.index[-1] == start + datetime.timedelta(hours=999)
+    pd.testing.assert_frame_equal(df, generate_candles(
+        1000, start, datetime.timedelta(hours=1), seed=3))
+    assert not df.equals(generate_candles(
+        1000, start, datetime.timedelta(hours=1), seed=4))
+
+
+def test_generate_candles_with_means_not_above_zero():
+    df = generate_candles(
+        100, datetime.datetime(2020, 1, 6), volume_mean=0.0, volume_std=2.0,
+        spread_mean=-1.0, spread_std=0.5, seed=0)
+
+    assert len(df) == 100
+    assert np.isfinite(df.values).all()
+    assert (df["Volume"] >= 0).all()
+    assert (df["High"] >= df[["Open", "Close"]].max(axis=1)).all()
+
+
+def test_intraday_seasonality_averages_one():
+    index = pd.date_range("2020-01-06", periods=288, freq="5min")
+    activity = intraday_seasonality(index)
+    assert activity.mean() == pytest.approx(1.0)
+    assert index[np.argmax(activity)].strftime("%H:%M") == "14:30"
@@ -0,0 +1,39 @@
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.times import (
+    from_epoch_ms, local_to_utc, minute_of_hour, to_epoch_ms, utc_to_local)
+
+
+@pytest.fixture
+def london(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/London")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_epoch_ms_round_trip():
+    times = pd.date_range("2020-03-29 00:00", periods=5, freq="15min")
+    utms = to_epoch_ms(times)
+
+    assert utms.dtype == np.int64
+    assert utms[0] == 1585440000000
+    assert to_epoch_ms(times[0]) == 1585440000000
+    assert to_epoch_ms(datetime.datetime(2020, 3, 29)) == 1585440000000
+    assert (from_epoch_ms(utms) == times).all()
+    assert [minute_of_hour(utm) for utm in utms] == [0, 15, 30, 45, 0]
+
+
+def test_local_times_are_only_converted_at_the_edges(london):
+    # The clocks went forward at 01:00 UTC
+    local = pd.DatetimeIndex(["2020-03-29 00:30", "2020-03-29 02:30"])
+    assert list(local_to_utc(local)) == [
+        pd.Timestamp("2020-03-29 00:30"), pd.Timestamp("2020-03-29 01:30")]
+    assert utc_to_local(datetime.datetime(2020, 3, 29, 1, 30)) == (
+        datetime.datetime(2020, 3, 29, 2, 30))
@@ -0,0 +1,272 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from vpaad.candle import Candle
+from vpaad.candle_store import COLUMN_NAMES
+from vpaad.constants import START_TIME_MULIPLIER
+from vpaad.historical_data_fetcher import (
+    IHistoricalDataFetcher, InterpolatedHistoricalDataFetcher)
+from vpaad.report import CandleReport
+from vpaad.times import to_epoch_ms
+from vpaad.volume_tracker import (
+    VolumeTracker, add_candle_to_volume_trackers, create_volume_trackers,
+    initiate_volume_trackers)
+
+
+def make_candle_data(utm, open_, close, high, low, volume):
+    return {
+        "BID_OPEN": open_,
+        "BID_CLOSE": close,
+        "BID_HIGH": high,
+        "BID_LOW": low,
+        "CONS_TICK_COUNT": volume,
+        "UTM": utm,
+    }
+
+
+def test_volume_tracker_rolling_stats_match_window():
+    window = 10
+    vt = VolumeTracker(
+        "Gold", "CS.D.CFDGOLD.CFDGC.IP", "5MINUTE", None, None,
+        pre_calculate=False, window=window)
+
+    rng = np.random.RandomState(0)
+    volumes = rng.randint(1, 500, 50)
+    opens = rng.uniform(100, 110, 50)
+    closes = rng.uniform(100, 110, 50)
+    for i in range(50):
+        vt._add_candle(Candle(make_candle_data(
+            1500000000000 + i * 300000, opens[i], closes[i],
+            max(opens[i], closes[i]) + 1, min(opens[i], closes[i]) - 1,
+            volumes[i])))
+
+    spreads = np.abs(closes - opens)
+    assert vt._volume_stats[0] == pytest.approx(np.mean(volumes[-window:]))
+    assert vt._volume_stats[1] == pytest.approx(np.std(volumes[-window:]))
+    assert vt._candle_spread_stats[0] == pytest.approx(
+        np.mean(spreads[-window:]))
+    assert vt._candle_spread_stats[1] == pytest.approx(
+        np.std(spreads[-window:]))
+    assert len(vt._candles) == window
+
+
+def test_add_candles_from_historic_data_matches_candle_by_candle():
+    window = 20
+    rng = np.random.RandomState(3)
+    size = 60
+    opens = rng.uniform(100, 110, size)
+    closes = rng.uniform(100, 110, size)
+    highs = np.maximum(opens, closes) + rng.exponential(2, size)
+    lows = np.minimum(opens, closes) - rng.exponential(2, size)
+    volumes = rng.randint(1, 500, size).astype(float)
+    times = pd.date_range("2020-01-06 09:00", periods=size, freq="5min")
+    df = pd.DataFrame({
+        "Open": opens, "High": highs, "Low": lows, "Close": closes,
+        "Volume": volumes,
+    }, index=times)
+
+    bulk = VolumeTracker(
+        "Gold", "EPIC", "5MINUTE", None, None, window=window)
+    single = VolumeTracker(
+        "Gold", "EPIC", "5MINUTE", None, None, window=window)
+    bulk._candle_spreads.extend(np.abs(closes - opens)[:5])
+    single._candle_spreads.extend(np.abs(closes - opens)[:5])
+
+    bulk._add_candles_from_historic_data(df)
+    for i in range(size):
+        single._add_candle(Candle(make_candle_data(
+            to_epoch_ms(times[i]), opens[i], closes[i],
+            highs[i], lows[i], volumes[i])))
+
+    assert bulk._volume_stats == pytest.approx(single._volume_stats)
+    assert bulk._candle_spread_stats == pytest.approx(
+        single._candle_spread_stats)
+    for name in COLUMN_NAMES:
+        np.testing.assert_allclose(
+            bulk.candles.column(name), single.candles.column(name))
+
+
+class SlowHistoricalDataFetcher(IHistoricalDataFetcher):
+    """
+    Interpolated history, delivered after some latency. Epics listed in
+    failing raise, and epics listed in hanging take far too long.
+    """
+    def __init__(self, latency, failing=(), hanging=()):
+        params = {
+            epic: {
+                "5Min": {
+                    "volume": {"mean": 10.0, "std": 3.0},
+                    "spread": {"mean": 15.0, "std": 5.0}
+                }
+            }
+            for epic in ("A", "B", "C", "D", "E", "F", "G", "H")
+        }
+        self._fetcher = InterpolatedHistoricalDataFetcher(params)
+        self._latency = latency
+        self._failing = failing
+        self._hanging = hanging
+
+    def fetch(self, epic, resolution, start_time, end_time):
+        if epic in self._failing:
+            raise KeyError(epic)
+        time.sleep(10 * self._latency if epic in self._hanging
+                   else self._latency)
+        return self._fetcher.fetch(epic, resolution, start_time, end_time)
+
+
+def make_volume_trackers(epics, fetcher):
+    return {
+        epic: [VolumeTracker(epic, epic, "5MINUTE", None, fetcher)]
+        for epic in epics
+    }
+
+
+def test_initiate_volume_trackers_concurrently():
+    latency = 0.2
+    epics = ("A", "B", "C", "D", "E", "F", "G", "H")
+    volume_trackers = make_volume_trackers(
+        epics, SlowHistoricalDataFetcher(latency))
+
+    start = time.time()
+    failed = initiate_volume_trackers(volume_trackers, max_workers=8)
+    elapsed = time.time() - start
+
+    assert failed == []
+    assert elapsed < latency * len(epics) / 2
+    for epic in epics:
+        assert len(volume_trackers[epic][0].candles) == START_TIME_MULIPLIER
+
+
+def test_initiate_volume_trackers_isolates_failures():
+    latency = 0.1
+    epics = ("A", "B", "C", "D")
+    volume_trackers = make_volume_trackers(
+        epics,
+        SlowHistoricalDataFetcher(latency, failing=("B",), hanging=("C",)))
+
+    start = time.time()
+    failed = initiate_volume_trackers(
+        volume_trackers, max_workers=2, timeout=3 * latency)
+    elapsed = time.time() - start
+
+    assert sorted(vt.epic for vt in failed) == ["B", "C"]
+    assert elapsed < 10 * latency
+    assert volume_trackers["B"] == []
+    assert volume_trackers["C"] == []
+    assert len(volume_trackers["A"][0].candles) == START_TIME_MULIPLIER
+    assert len(volume_trackers["D"][0].candles) == START_TIME_MULIPLIER
+    # The hung initiation is left on a thread that won't block exit
+    initiating = [thread for thread in threading.enumerate()
+                  if thread.name.startswith("Initiation")]
+    assert initiating and all(thread.daemon for thread in initiating)
+
+
+def test_initiate_volume_trackers_isolates_each_tracker():
+    fetcher = SlowHistoricalDataFetcher(0.0)
+    fetch = fetcher.fetch
+
+    def failing_fetch(epic, resolution, start_time, end_time):
+        if resolution == "15Min":
+            raise KeyError(resolution)
+        return fetch(epic, resolution, start_time, end_time)
+
+    fetcher.fetch = failing_fetch
+    volume_trackers = {
+        "A": [
+            VolumeTracker("A", "A", resolution, None, fetcher)
+            for resolution in ("5MINUTE", "15MINUTE")
+        ]
+    }
+
+    failed = initiate_volume_trackers(volume_trackers)
+
+    assert [vt.resolution for vt in failed] == ["15MINUTE"]
+    assert [vt.resolution for vt in volume_trackers["A"]] == ["5MINUTE"]
+    assert len(volume_trackers["A"][0].candles)
+
+
+def test_initiate_volume_trackers_with_shared_history():
+    fetcher = SlowHistoricalDataFetcher(0.0)
+    calls = []
+    fetch = fetcher.fetch
+
+    def counting_fetch(*args):
+        calls.append(args)
+        return fetch(*args)
+
+    fetcher.fetch = counting_fetch
+    volume_trackers = {
+        "A": [
+            VolumeTracker("A", "A", resolution, None, fetcher)
+            for resolution in ("5MINUTE", "15MINUTE")
+        ]
+    }
+
+    failed = initiate_volume_trackers(
+        volume_trackers, historical_data_fetcher=fetcher)
+
+    assert failed == []
+    assert len(calls) == 1
+    five_minute_vt, fifteen_minute_vt = volume_trackers["A"]
+    assert len(five_minute_vt.candles) == START_TIME_MULIPLIER
+    assert len(fifteen_minute_vt.candles) > 0
+
+
+def test_reports_are_only_rendered_for_anomalies(monkeypatch):
+    rendered = []
+    to_text = CandleReport.to_text
+
+    def counting_to_text(report):
+        rendered.append(report)
+        return to_text(report)
+
+    monkeypatch.setattr(CandleReport, "to_text", counting_to_text)
+    reports = []
+    vt = VolumeTracker(
+        "Gold", "EPIC", "5MINUTE", None, None,
+        notification_callbacks=(reports.append,), pre_calculate=False)
+
+    for i in range(20):
+        vt.add_5min_candle(make_candle_data(
+            1500000000000 + i * 300000, 100, 101, 102, 99, 10),
+            notify_on_anomaly=True)
+    assert rendered == []
+    assert reports == []
+
+    # A strong hammer with high volume
+    vt.add_5min_candle(make_candle_data(
+        1500000000000 + 20 * 300000, 100, 101, 101.5, 90, 1000),
+        notify_on_anomaly=True)
+    assert len(reports) == 1
+    assert reports[0].shape_type == "STRONG_HAMMER"
+    assert reports[0].relative_data[0] == "HIGH_VOLUME"
+
+
+def test_composite_candles_stay_aligned_after_a_missed_candle():
+    volume_trackers = create_volume_trackers(
+        [{"name": "Gold", "epic": "EPIC",
+          "resolutions": ["5MINUTE", "15MINUTE", "HOUR"]}],
+        None, None, (), pre_calculate=False)
+    five_minute_vt, fifteen_minute_vt, hour_vt = volume_trackers["EPIC"]
+    assert fifteen_minute_vt.aggregator is hour_vt.aggregator
+
+    # Two hours from the top of an hour, missing the candle at 0:20
+    start = 1500000000000 - 1500000000000 % 3600000
+    for i in range(24):
+        if i == 4:
+            continue
+        values = make_candle_data(start + i * 300000, 100, 101, 102, 99, 10)
+        values["CONS_END"] = u"1"
+        add_candle_to_volume_trackers(
+            volume_trackers, {"name": "CHART:EPIC:5MINUTE", "values": values})
+
+    assert len(five_minute_vt.candles) == 23
+    assert list(fifteen_minute_vt.candles.column("time")) == [
+        start + i * 900000 for i in range(8)]
+    assert list(fifteen_minute_vt.candles.column("volume")) == [
+        30, 20] + [30] * 6
+    assert list(hour_vt.candles.column("volume")) == [110, 120]
@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+"""
+Times are kept in UTC throughout: as epoch milliseconds, like the UTM field
+of the stream's candles, or as naive numpy datetime64 values (and pandas
+DatetimeIndexes) for history. Local time only appears at the edges: the
+dates of IG's historical prices API and what is shown to people.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+
+MINUTE_MS = 60 * 1000
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def to_epoch_ms(times):
+    """
+    Convert naive UTC times (a DatetimeIndex, datetime64 array, datetime or
+    Timestamp) to epoch milliseconds.
+    """
+    if isinstance(times, (pd.Index, pd.Series, np.ndarray, list, tuple)):
+        return np.asarray(times, dtype="datetime64[ms]").astype(np.int64)
+    return int(np.datetime64(times, "ms").astype(np.int64))
+
+
+def from_epoch_ms(epoch_ms):
+    """
+    Convert epoch milliseconds to a DatetimeIndex of naive UTC times.
+    """
+    return pd.DatetimeIndex(
+        np.asarray(epoch_ms, dtype=np.int64).astype("datetime64[ms]"))
+
+
+def minute_of_hour(epoch_ms):
+    return (int(epoch_ms) // MINUTE_MS) % 60
+
+
+def local_to_utc(times):
+    """
+    Convert a DatetimeIndex of naive local times to naive UTC times. Times
+    repeated when the clocks go back are taken as the earlier of the two.
+    """
+    times = pd.DatetimeIndex(times)
+    return times.tz_localize(
+        tzlocal(), ambiguous=np.ones(len(times), dtype=bool),
+        nonexistent="shift_forward").tz_convert("UTC").tz_localize(None)
+
+
+def utc_to_local(time):
+    """Convert a naive UTC datetime to a naive local one."""
+    return pd.Timestamp(time).tz_localize("UTC").tz_convert(
+        tzlocal()).tz_localize(None).to_pydatetime()
+
+
+def local_datetime(epoch_ms):
+    """The local datetime of epoch milliseconds, for display."""
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000)
@@ -1,19 +1,61 @@
 # -*- coding:utf-8 -*-
-import datetime
 import logging
-import pprint
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import numpy as np
 from trading_ig.lightstreamer import Subscription
 
 from vpaad.constants import (
-    CANDLE_RES_TO_TIMEDELTA, CANDLE_RES_TO_HISTORICAL_RES, DATETIME_STR_FORMAT,
-    START_TIME_MULIPLIER, DF_DATETIME_FORMAT, INTERESTING_FIELDS)
-from vpaad.candle import Candle, CompositeCandle
+    CANDLE_RES_TO_TIMEDELTA, CANDLE_RES_TO_HISTORICAL_RES,
+    START_TIME_MULIPLIER, INTERESTING_FIELDS,
+    INITIATION_TIMEOUT, INITIATION_WORKERS, SHAPE_TYPE_CODES, SPREAD_TYPES,
+    VOLUME_TYPES)
+from vpaad.candle import (
+    Candle, CandleAggregator, calculate_wicks, classify_shapes,
+    classify_spread_volume)
+from vpaad import metrics
+from vpaad.candle_store import COLUMN_NAMES, CandleStore
+from vpaad.historical_data_fetcher import (
+    HISTORY_FETCH_SECONDS, load_epic_history)
+from vpaad.patterns import (
+    PatternDetector, PATTERN_WINDOW, detect_patterns, pattern_names)
+from vpaad.report import CandleReport
+from vpaad.rolling_stats import RollingStats, rolling_mean_std
+from vpaad.rules import (
+    DEFAULT_RULES, RuleSet, market_rules, z_score, z_scores)
+from vpaad.times import to_epoch_ms, utc_now
 
 LOGGER = logging.getLogger(__name__)
 
+NOTABLE_SHAPES = ("STRONG_HAMMER", "STRONG_SHOOTING_STAR")
+NOTABLE_SHAPE_CODES = tuple(SHAPE_TYPE_CODES[name] for name in NOTABLE_SHAPES)
+DEFAULT_RULE_SET = RuleSet(DEFAULT_RULES)
+
+CANDLE_SECONDS = metrics.histogram(
+    "vpaad_candle_seconds", "Time taken to add a candle to a volume tracker.",
+    ("resolution",))
+ANOMALIES = metrics.counter(
+    "vpaad_anomalies_total", "Anomalies detected in new candles.",
+    ("epic", "resolution"))
+INITIATE_SECONDS = metrics.histogram(
+    "vpaad_initiate_seconds", "Time taken to initiate a volume tracker.")
+LAST_CANDLE_AGE = metrics.gauge(
+    "vpaad_last_candle_age_seconds",
+    "Time since a volume tracker was last given a candle.",
+    ("epic", "resolution"))
+STREAM_EVENTS = metrics.counter(
+    "vpaad_stream_events_total", "Events received from the stream.",
+    ("epic",))
+STREAM_EVENT_SECONDS = metrics.histogram(
+    "vpaad_stream_event_seconds",
+    "Time taken to handle an event on the stream listener's thread.")
+
 
 class VolumeTracker(object):
     """
@@ -22,8 +64,10 @@ class VolumeTracker(object):
     def __init__(
             self, name, epic, resolution, ig_service,
             historical_data_fetcher, notification_callbacks=(),
-            pre_calculate=True):
+            pre_calculate=True, window=START_TIME_MULIPLIER, rules=None,
+            aggregator=None):
         self._name = name
+        self._window = window
         self._pre_calculate = pre_calculate
 
         self._epic = epic
@@ -34,21 +78,84 @@ class VolumeTracker(object):
         self._ig_service = ig_service
         self._historical_data_fetcher = historical_data_fetcher
 
-        self._candles = []
+        self._candles = CandleStore(window)
 
-        # Only applies for resolutions greater than 5MINUTE
-        self._current_composite_candle = None
+        # Usually shared with the epic's other trackers
+        if aggregator is None:
+            aggregator = CandleAggregator(epic)
+        aggregator.add_resolution(resolution)
+        self._aggregator = aggregator
 
-        self._volumes = []
+        self._volumes = RollingStats(window)
         self._volume_stats = None
 
-        self._candle_spreads = []
+        self._candle_spreads = RollingStats(window)
         self._candle_spread_stats = None
 
+        self._patterns = PatternDetector()
+
         self._log_prefix = "VT:{} ({})".format(self._name, self._candle_res)
         self._notification_callbacks = notification_callbacks
+        self._rules = DEFAULT_RULE_SET if rules is None else rules
+
+        self._candle_seconds = CANDLE_SECONDS.labels(resolution)
+        self._last_candle_at = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def epic(self):
+        return self._epic
+
+    @property
+    def resolution(self):
+        return self._candle_res
+
+    @property
+    def pre_calculate(self):
+        return self._pre_calculate
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def history_span(self):
+        """How far back the historical data used to initiate goes"""
+        return self._timedelta * self._window
+
+    @property
+    def candles(self):
+        return self._candles
+
+    @property
+    def rules(self):
+        return self._rules
+
+    @property
+    def aggregator(self):
+        return self._aggregator
 
-        self._started = False
+    @property
+    def historical_data_fetcher(self):
+        return self._historical_data_fetcher
+
+    @property
+    def last_candle_age(self):
+        """Seconds since a candle was last added, if one has been."""
+        if self._last_candle_at is None:
+            return None
+        return time.perf_counter() - self._last_candle_at
+
+    @property
+    def notification_callbacks(self):
+        return self._notification_callbacks
+
+    @notification_callbacks.setter
+    def notification_callbacks(self, notification_callbacks):
+        self._notification_callbacks = notification_callbacks
 
     def log(self, msg, *args):
         LOGGER.info(" ".join((self._log_prefix, msg)), *args)
@@ -65,7 +172,7 @@ class VolumeTracker(object):
         std = desc.loc["std"]
 
         self._volume_stats = (mean, std)
-        self._volumes = vol_series.tolist()
+        self._volumes.extend(vol_series.values)
 
         self.log("Mean Volume: %s", mean)
         self.log("Volume Standard Deviation: %s", std)
@@ -77,15 +184,16 @@ class VolumeTracker(object):
         std = desc.loc["std"]
 
         self._candle_spread_stats = (mean, std)
-        self._candle_spreads = spread_series.tolist()
+        self._candle_spreads.extend(spread_series.values)
 
         self.log("Mean Spread: %s", mean)
         self.log("Spread Standard Deviation: %s", std)
         self.log("Anomaly Spread Threshold: %s", mean + std)
 
-    def initiate(self):
+    def initiate(self, history=None):
         """
-        Populate average volume from historical price data
+        Populate average volume from historical price data. The data is
+        fetched unless a history DataFrame is given.
         """
         self.log("Initiating")
 
@@ -93,188 +201,555 @@ class VolumeTracker(object):
             self.log("Not pre-calculating stats, as specified")
             return
 
-        now = datetime.datetime.now()
-        start_time = now - self._timedelta * START_TIME_MULIPLIER
+        with INITIATE_SECONDS.time():
+            self._initiate(history)
 
-        self.log("Start time: %s, End time: %s", start_time, now)
+    def _initiate(self, history):
+        if history is None:
+            now = utc_now()
+            start_time = now - self.history_span
 
-        df = self._historical_data_fetcher.fetch(
-            self._epic,
-            self._historical_res,
-            start_time.strftime(DATETIME_STR_FORMAT),
-            now.strftime(DATETIME_STR_FORMAT)
-        )
+            self.log("Start time: %s, End time: %s (UTC)", start_time, now)
+
+            with HISTORY_FETCH_SECONDS.time():
+                df = self._historical_data_fetcher.fetch(
+                    self._epic, self._historical_res, start_time, now)
+        else:
+            df = history
         self.log_debug(str(df))
         self._initiate_volume_stats(df["Volume"])
         self._initiate_candle_spread_stats(df["AbsSpread"])
         self._add_candles_from_historic_data(df)
 
     def _add_candles_from_historic_data(self, df):
-        for i, row in df.iterrows():
-            candle_date = datetime.datetime.strptime(
-                row.name, DF_DATETIME_FORMAT)
-            utm_time = time.mktime(candle_date.timetuple()) * 1000
-            candle_data = {
-                "BID_OPEN": row["Open"],
-                "BID_CLOSE": row["Close"],
-                "BID_HIGH": row["High"],
-                "BID_LOW": row["Low"],
-                "CONS_TICK_COUNT": row["Volume"],
-                "UTM": utm_time,
-            }
-            candle = Candle(candle_data)
-            self._add_candle(candle, notify_on_anomaly=False)
+        """
+        Add historical candles in bulk. Equivalent to calling _add_candle for
+        every row, but classifies the whole frame at once instead of building
+        a Candle per row.
+        """
+        if not len(df):
+            return
+
+        opens = df["Open"].values.astype(np.float64)
+        highs = df["High"].values.astype(np.float64)
+        lows = df["Low"].values.astype(np.float64)
+        closes = df["Close"].values.astype(np.float64)
+        volumes = df["Volume"].values.astype(np.float64)
+        utms = to_epoch_ms(df.index)
+
+        spreads, spread_types, upper, lower = calculate_wicks(
+            opens, highs, lows, closes)
+        shape_types = classify_shapes(upper, lower)
+        spread_sizes = np.abs(spreads)
+
+        # The stats each candle would have been weighed against
+        volume_stats = rolling_mean_std(
+            volumes, self._window, self._volumes.values())
+        spread_stats = rolling_mean_std(
+            spread_sizes, self._window, self._candle_spreads.values())
+        volume_types, spread_weights = classify_spread_volume(
+            volumes, spread_sizes, volume_stats, spread_stats)
+        patterns = self._detect_patterns(
+            highs, lows, closes, volumes, shape_types, volume_types,
+            spread_weights, spread_types, spread_stats[0])
+        is_anomaly = self._rules.any_arrays((
+            shape_types, volume_types, spread_weights, spread_types,
+            z_scores(volumes, *volume_stats),
+            z_scores(spread_sizes, *spread_stats), upper, lower, patterns))
+
+        self._patterns.extend(highs, lows, closes, volumes)
+
+        self._volumes.extend(volumes)
+        self._candle_spreads.extend(spread_sizes)
+        self._volume_stats = self._volumes.stats
+        self._candle_spread_stats = self._candle_spreads.stats
+
+        self._candles.extend({
+            "time": utms,
+            "open": opens,
+            "high": highs,
+            "low": lows,
+            "close": closes,
+            "volume": volumes,
+            "spread": spreads,
+            "upper_wick_percentage": upper,
+            "lower_wick_percentage": lower,
+            "spread_type": spread_types,
+            "shape_type": shape_types,
+        })
+
+        for i in np.flatnonzero(is_anomaly):
+            candle = Candle({
+                "BID_OPEN": opens[i],
+                "BID_CLOSE": closes[i],
+                "BID_HIGH": highs[i],
+                "BID_LOW": lows[i],
+                "CONS_TICK_COUNT": volumes[i],
+                "UTM": utms[i],
+            })
+            row_volume_stats = (volume_stats[0][i], volume_stats[1][i])
+            row_spread_stats = (spread_stats[0][i], spread_stats[1][i])
+            weights = (int(volume_types[i]), int(spread_weights[i]))
+            report = self._report(
+                candle, weights, row_volume_stats, row_spread_stats,
+                patterns=pattern_names(patterns[i]))
+            report.rules = self._rules.matches(
+                self._features(candle, weights, row_volume_stats,
+                               row_spread_stats, patterns[i]))
+            self.log("Anomaly detected")
+            self.log("%s", report)
+
+    def state(self):
+        """
+        The candles in the window, oldest first, as arrays by column. They
+        are all that's needed to carry on where this tracker left off.
+        """
+        return {name: self._candles.column(name).copy()
+                for name in COLUMN_NAMES}
+
+    def restore(self, state):
+        """
+        Carry on from a state returned by state(), instead of initiating.
+        """
+        columns = {
+            name: np.asarray(state[name])[-self._window:]
+            for name in COLUMN_NAMES}
+        self._candles.extend(columns)
+        self._volumes.extend(columns["volume"])
+        self._candle_spreads.extend(np.abs(columns["spread"]))
+        self._volume_stats = self._volumes.stats
+        self._candle_spread_stats = self._candle_spreads.stats
+        self._patterns.extend(
+            columns["high"], columns["low"], columns["close"],
+            columns["volume"])
+        self.log("Restored %d candles", len(columns["time"]))
 
     def _update_stats(self, new_candle):
         """
         Update the mean and standard deviation of volume and candle spread
         sizes
         """
-        # Add new data, remove oldest
-        self._volumes.append(new_candle.volume)
-        self._candle_spreads.append(new_candle.spread_size)
-
-        if len(self._volumes) > START_TIME_MULIPLIER:
-            self._volumes.pop(0)
-        if len(self._candle_spreads) > START_TIME_MULIPLIER:
-            self._candle_spreads.pop(0)
+        # Add new data, the oldest drops out of the window
+        self._volumes.add(new_candle.volume)
+        self._candle_spreads.add(new_candle.spread_size)
 
-        v_npa = np.array(self._volumes)
-        s_npa = np.array(self._candle_spreads)
-        self._volume_stats = (np.mean(v_npa), np.std(v_npa))
-        self._candle_spread_stats = (np.mean(s_npa), np.std(s_npa))
+        self._volume_stats = self._volumes.stats
+        self._candle_spread_stats = self._candle_spreads.stats
 
-    def _notify_callbacks(self, candle, relative_data, full_details):
+    def _notify_callbacks(self, report):
         """
-        Notify callbacks with candle data
+        Notify callbacks with the report of an anomaly candle
         """
-        if not self._notification_callbacks:
-            return
-
-        summary = ", ".join((
-            self._name,
-            self._candle_res,
-            candle.time.strftime(DATETIME_STR_FORMAT),
-            candle.shape["shape_type"],
-            str(relative_data)
-        ))
-        content = (
-            "VPAAD has detected an anomaly candle in: {}.\n\n"
-            "{}"
-        ).format(self._name, full_details)
         for cb in self._notification_callbacks:
-            cb(summary, content)
+            cb(report)
 
     def add_5min_candle(self, candle_data, notify_on_anomaly):
-        if not self._started:
-            minutes_in_hour = datetime.datetime.fromtimestamp(
-                int(candle_data["UTM"]) / 1000).minute
-            resolution_in_minutes = self._timedelta.total_seconds() / 60
-            if minutes_in_hour % resolution_in_minutes == 0:
-                self._started = True
-            else:
-                self.log(
-                    "Not starting VolumeTracker yet as time resolution has "
-                    "not been reached.")
-                return
-
-        if self._candle_res == "5MINUTE":
-            self._add_candle(Candle(candle_data), notify_on_anomaly)
-        else:
-            if self._current_composite_candle is None:
-                self._current_composite_candle = CompositeCandle(
-                    self._timedelta)
+        """
+        Add a 5 minute candle through this tracker's aggregator. Trackers
+        sharing an aggregator are given their candles by
+        add_candle_to_volume_trackers instead.
+        """
+        self.add_candles(
+            self._aggregator.add(candle_data), notify_on_anomaly)
 
-            self._current_composite_candle.add_5min_candle(candle_data)
-            self.log_debug("Added data to sub candle.")
+    def add_candles(self, completed, notify_on_anomaly):
+        """
+        Add the candles of this tracker's resolution, of those completed by
+        its aggregator.
+        """
+        for candle in completed.get(self._candle_res, ()):
+            self._add_candle(candle, notify_on_anomaly=notify_on_anomaly)
 
-            if self._current_composite_candle.complete:
-                self.log_debug("Composite candle completed.")
-                self._add_candle(
-                    self._current_composite_candle,
-                    notify_on_anomaly=notify_on_anomaly)
-                self._current_composite_candle = None
+    def _report(
+            self, candle, weights, volume_stats, spread_stats, rules=(),
+            patterns=()):
+        """
+        The report of a candle, given its volume and spread type codes.
+        """
+        volume, spread = weights
+        return CandleReport(
+            self._name, self._epic, self._candle_res, candle,
+            (VOLUME_TYPES[volume], SPREAD_TYPES[spread], candle.type),
+            volume_stats, spread_stats, rules, patterns)
+
+    def _detect_patterns(
+            self, highs, lows, closes, volumes, shape_types, volume_types,
+            spread_weights, spread_types, spread_means):
+        """
+        The patterns completed by new candles, with the candles already
+        stored in front of them as context.
+        """
+        context = {
+            name: self._candles.column(name)[-(PATTERN_WINDOW + 2):]
+            for name in ("high", "low", "close", "volume")}
+        count = len(context["high"])
+        no_codes = np.zeros(count, dtype=np.int64)
+        masks = detect_patterns(
+            np.concatenate((context["high"], highs)),
+            np.concatenate((context["low"], lows)),
+            np.concatenate((context["close"], closes)),
+            np.concatenate((context["volume"], volumes)),
+            np.concatenate((no_codes, shape_types)),
+            np.concatenate((no_codes, volume_types)),
+            np.concatenate((no_codes, spread_weights)),
+            np.concatenate((no_codes, spread_types)),
+            np.concatenate((np.full(count, np.nan), spread_means)))
+        return masks[count:]
+
+    @staticmethod
+    def _features(candle, weights, volume_stats, spread_stats, patterns=0):
+        """
+        The features of a candle that rules are evaluated against, in the
+        order of rules.FEATURES, given its volume and spread type codes.
+        """
+        volume, spread = weights
+        upper_wick_percentage, lower_wick_percentage = (
+            candle.wick_percentages)
+        return (
+            candle.shape_code,
+            volume,
+            spread,
+            candle.type_code,
+            z_score(candle.volume, *volume_stats),
+            z_score(candle.spread_size, *spread_stats),
+            upper_wick_percentage,
+            lower_wick_percentage,
+            int(patterns),
+        )
 
     def _add_candle(self, new_candle, notify_on_anomaly=False):
         """Add a candle to this volume tracker"""
+        start = time.perf_counter()
         self._update_stats(new_candle)
 
-        relative_data = new_candle.get_spread_volume_weight(
+        weights = new_candle.spread_volume_codes(
             self._volume_stats, self._candle_spread_stats)
-        volume, spread, sentiment = relative_data
-
-        self._candles.append(new_candle)
-
-        if len(self._candles) > START_TIME_MULIPLIER:
-            self._candles.pop(0)
-
-        full_details = pprint.pformat({
-            "time": new_candle.time.strftime(DATETIME_STR_FORMAT),
-            "name": self._name,
-            "epic": self._epic,
-            "resolution": self._candle_res,
-            "relative_data": (volume, spread, sentiment),
-            "data": new_candle.data,
-            "overall_volume_stats": self._volume_stats,
-            "overall_spread_stats": self._candle_spread_stats,
-            "shape": new_candle.shape
-        })
 
-        is_anomaly = False
-        notable_shapes = (
-            "STRONG_HAMMER", "STRONG_SHOOTING_STAR",
-        )
-        if (volume == "HIGH_VOLUME"
-                and new_candle.shape["shape_type"] in notable_shapes):
-            is_anomaly = True
-
-        if is_anomaly:
+        self._candles.append_candle(new_candle)
+
+        features = self._features(
+            new_candle, weights, self._volume_stats,
+            self._candle_spread_stats)
+        patterns = self._patterns.update(
+            new_candle.high, new_candle.low, new_candle.close,
+            new_candle.volume, *features[:4],
+            spread_mean=self._candle_spread_stats[0])
+        matched_rules = self._rules.matches(features[:-1] + (patterns,))
+
+        if matched_rules:
+            ANOMALIES.labels(self._epic, self._candle_res).inc()
+            report = self._report(
+                new_candle, weights, self._volume_stats,
+                self._candle_spread_stats, matched_rules,
+                pattern_names(patterns))
             self.log("Anomaly detected")
-            self.log(full_details)
+            self.log("%s", report)
 
             if notify_on_anomaly:
-                self._notify_callbacks(
-                    new_candle, relative_data, full_details)
-        else:
-            self.log_debug(full_details)
+                self._notify_callbacks(report)
+        elif LOGGER.isEnabledFor(logging.DEBUG):
+            self.log_debug("%s", self._report(
+                new_candle, weights, self._volume_stats,
+                self._candle_spread_stats,
+                patterns=pattern_names(patterns)))
 
+        self._last_candle_at = time.perf_counter()
+        self._candle_seconds.observe(self._last_candle_at - start)
 
-def add_volume_trackers(
-        ig_service, ig_stream_service, markets, historical_data_fetcher,
-        notification_callbacks, pre_calculate):
+
+class _DaemonExecutor(object):
+    """
+    Runs functions on a pool of daemon threads. Unlike ThreadPoolExecutor,
+    whose threads are joined when the interpreter exits, a function that
+    never returns doesn't keep the process alive.
+    """
+    def __init__(self, max_workers, name):
+        self._queue = Queue()
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(
+                target=self._work, name="{}-{}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, function, *args):
+        future = Future()
+        self._queue.put((future, function, args))
+        return future
+
+    def shutdown(self):
+        """Stop the threads once they're idle, without waiting for them."""
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, function, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+def _initiate_epic_volume_trackers(
+        epic, volume_trackers, historical_data_fetcher):
     """
-    Add Volume trackers to an IG stream session.
+    Initiate all of an epic's trackers from a single fetch of its finest
+    resolution.
+    """
+    spans = {
+        vt.resolution: vt.history_span
+        for vt in volume_trackers if vt.pre_calculate
+    }
+    histories = {}
+    if spans:
+        histories = load_epic_history(
+            historical_data_fetcher, epic, spans, utc_now())
+    for vt in volume_trackers:
+        vt.initiate(histories.get(vt.resolution))
+
+
+def initiate_volume_trackers(
+        volume_trackers, max_workers=INITIATION_WORKERS,
+        timeout=INITIATION_TIMEOUT, historical_data_fetcher=None,
+        checkpoint=None):
+    """
+    Initiate volume trackers concurrently, with at most max_workers
+    fetching history at the same time.
+
+    When a historical_data_fetcher is given, each epic's history is fetched
+    once and shared by its trackers, so they are initiated together.
+    Otherwise every tracker fetches its own, and is initiated on its own.
+    When a Checkpoint is given, the epics it can restore are restored from
+    it instead.
+
+    If initiating a tracker, or an epic's trackers together, raises or is
+    still going on timeout seconds after it started, those trackers are
+    removed from volume_trackers so that the rest can carry on without
+    them. Returns the list of removed trackers.
+    """
+    started_at = {}
+    tracker_count = sum(len(vts) for vts in volume_trackers.values())
+
+    def initiate(key, epic, vts):
+        """
+        Initiate trackers. Returns the trackers to initiate one at a time
+        instead, when an epic's couldn't be restored from the checkpoint.
+        """
+        started_at[key] = time.time()
+        if checkpoint is not None and len(vts) == len(
+                volume_trackers[epic]):
+            if checkpoint.restore(epic, vts, historical_data_fetcher):
+                return []
+            if historical_data_fetcher is None:
+                return vts
+        if historical_data_fetcher is None:
+            for vt in vts:
+                vt.initiate()
+        else:
+            _initiate_epic_volume_trackers(
+                epic, vts, historical_data_fetcher)
+        return []
+
+    LOGGER.info(
+        "Initiating %d volume trackers for %d epics with %d workers.",
+        tracker_count, len(volume_trackers), max_workers)
+    start_time = time.time()
+    executor = _DaemonExecutor(max_workers, "Initiation")
+    futures = {}
+
+    def submit(epic, vts):
+        key = len(futures)
+        future = executor.submit(initiate, key, epic, vts)
+        futures[future] = (key, epic, vts)
+        return future
+
+    for epic, vts in volume_trackers.items():
+        if checkpoint is not None or historical_data_fetcher is not None:
+            submit(epic, vts)
+        else:
+            for vt in vts:
+                submit(epic, [vt])
+    pending = set(futures)
+    failed = []
+    finished = 0
+
+    while pending:
+        done, pending = wait(
+            pending,
+            timeout=None if timeout is None else min(timeout, 1.0),
+            return_when=FIRST_COMPLETED)
+
+        for future in done:
+            _, epic, vts = futures[future]
+            exc = future.exception()
+            if exc is not None:
+                LOGGER.error(
+                    "Could not initiate %s (%s), it will not be monitored: "
+                    "%r", epic, ", ".join(vt.resolution for vt in vts), exc)
+                failed.extend(vts)
+                finished += len(vts)
+            else:
+                retry = future.result()
+                for vt in retry:
+                    pending.add(submit(epic, [vt]))
+                finished += len(vts) - len(retry)
+            LOGGER.info(
+                "Initiated %d/%d volume trackers (%.1fs)",
+                finished, tracker_count, time.time() - start_time)
+
+        if timeout is not None:
+            now = time.time()
+            for future in list(pending):
+                key, epic, vts = futures[future]
+                if key in started_at and now - started_at[key] > timeout:
+                    LOGGER.error(
+                        "Timed out initiating %s (%s) after %ss, it will not "
+                        "be monitored.", epic,
+                        ", ".join(vt.resolution for vt in vts), timeout)
+                    pending.remove(future)
+                    failed.extend(vts)
+                    finished += len(vts)
+
+    # Timed out initiations are abandoned, on daemon threads that won't
+    # keep the process from exiting
+    executor.shutdown()
+
+    for vt in failed:
+        volume_trackers[vt.epic] = [
+            other for other in volume_trackers[vt.epic] if other is not vt]
+
+    LOGGER.info(
+        "Initiated %d/%d volume trackers in %.2f seconds.",
+        tracker_count - len(failed), tracker_count, time.time() - start_time)
+    return failed
+
+
+def create_volume_trackers(
+        markets, ig_service, historical_data_fetcher, notification_callbacks,
+        pre_calculate, rules=None):
+    """
+    Create a list of volume trackers for each market's epic, one per
+    resolution, sharing a CandleAggregator. Each market's trackers look for
+    anomalies with the given rules, by name, overridden by the market's own
+    rules.
     """
     volume_trackers = {}
     for market in markets:
         name = market["name"]
         epic = market["epic"]
         resolutions = market["resolutions"]
+        rule_set = RuleSet(market_rules(rules, market))
+        aggregator = CandleAggregator(epic)
         volume_trackers[epic] = [
             VolumeTracker(
                 name, epic, resolution, ig_service, historical_data_fetcher,
                 notification_callbacks=notification_callbacks,
-                pre_calculate=pre_calculate)
+                pre_calculate=pre_calculate, rules=rule_set,
+                aggregator=aggregator)
             for resolution in resolutions
         ]
-        for vt in volume_trackers[epic]:
-            vt.initiate()
+    return volume_trackers
+
+
+def add_candle_data(volume_trackers, values, notify_on_anomaly=True):
+    """
+    Add the values of a completed 5 minute candle to the volume trackers of
+    an epic, aggregated once for the trackers sharing an aggregator.
+    """
+    by_aggregator = {}
+    for vt in volume_trackers:
+        by_aggregator.setdefault(vt.aggregator, []).append(vt)
+
+    for aggregator, vts in by_aggregator.items():
+        with aggregator.lock:
+            try:
+                completed = aggregator.add(values)
+            except ValueError:
+                LOGGER.error(
+                    "Could not add candle data for %s: %s",
+                    vts[0].epic, values)
+                continue
+            for vt in vts:
+                vt.add_candles(completed, notify_on_anomaly)
+
+
+def add_candle_to_volume_trackers(volume_trackers, event):
+    """
+    Add the candle of a CHART stream event to the volume trackers of its
+    epic. Returns whether the event held a completed candle.
+    """
+    values = event["values"]
+    sub_type, epic, resolution = event["name"].split(":")
+    if values["CONS_END"] != u"1":
+        return False
+
+    # Only add completed candles
+    add_candle_data(volume_trackers[epic], values)
+    return True
+
+
+def track_last_candle_ages(volume_trackers):
+    """
+    Report how long ago each volume tracker was given a candle, as a gauge.
+    Only useful for trackers in this process, so not for sharded ones.
+    """
+    for vts in volume_trackers.values():
+        for vt in vts:
+            LAST_CANDLE_AGE.labels(vt.epic, vt.resolution).set_function(
+                lambda vt=vt: vt.last_candle_age)
+
+
+def add_volume_trackers(
+        ig_service, ig_stream_service, markets, historical_data_fetcher,
+        notification_callbacks, pre_calculate,
+        max_workers=INITIATION_WORKERS, initiate_timeout=INITIATION_TIMEOUT,
+        shared_history=False, recorder=None, dispatcher=None, rules=None,
+        archive_writer=None, checkpoint=None):
+    """
+    Add Volume trackers to an IG stream session, and return them by epic.
+
+    When shared_history is set, each epic's history is fetched once at its
+    finest resolution and resampled for the coarser ones. When a recorder is
+    given, every event received from the stream is recorded. When a
+    dispatcher is given, such as a CandleDispatcher or ShardedDispatcher,
+    candles are added to the trackers by it rather than on the stream
+    listener's thread. rules are the anomaly rules of the config. When an
+    ArchiveWriter is given, every completed candle is submitted to it. When
+    a Checkpoint is given, trackers are restored from it where possible.
+    """
+    volume_trackers = create_volume_trackers(
+        markets, ig_service, historical_data_fetcher, notification_callbacks,
+        pre_calculate, rules)
+
+    initiate_volume_trackers(
+        volume_trackers, max_workers, initiate_timeout,
+        historical_data_fetcher if shared_history else None, checkpoint)
+
+    if dispatcher is not None:
+        dispatcher.start(volume_trackers)
 
     def add_candle_to_vt(event):
         # LOGGER.log("Received event: %s", pprint.pformat(event["name"]))
-        values = event["values"]
-        item = event["name"]
-        sub_type, epic, resolution = item.split(":")
-        if values["CONS_END"] == u"1":
-            # Only add completed candles
-            for vt in volume_trackers[epic]:
-                try:
-                    vt.add_5min_candle(
-                        values, notify_on_anomaly=True)
-                except ValueError:
-                    LOGGER.error(
-                        "Could not add candle data for %s: %s",
-                        item, values)
+        start = time.perf_counter()
+        STREAM_EVENTS.labels(event["name"].split(":")[1]).inc()
+        if recorder is not None:
+            recorder.record(event)
+        if archive_writer is not None:
+            archive_writer.submit(event)
+        if dispatcher is not None:
+            dispatcher.submit(event)
+        else:
+            add_candle_to_volume_trackers(volume_trackers, event)
+        STREAM_EVENT_SECONDS.observe(time.perf_counter() - start)
 
     # Making a new Subscription in MERGE mode
     items = [
@@ -293,3 +768,4 @@ def add_volume_trackers(
 
     # Registering the Subscription
     ig_stream_service.ls_client.subscribe(subscription_prices)
+    return volume_trackers